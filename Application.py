@@ -1,11 +1,13 @@
 from PyQt5.QtWidgets import QApplication
 from UI.UI import UI
+from Core.TileServer import register_scheme
 import sys
 
 
 class Application:
     def __init__(self, args):
         args.append("--disable-web-security")
+        register_scheme()
         self.app = QApplication(args)
         self.ui = UI()
 
@@ -0,0 +1,59 @@
+import numpy as np
+import shapely
+
+# Synthetic data for the benchmarks. Every generator takes a seed, so runs are comparable.
+
+# lon/lat area the features are spread over: [min x, min y, max x, max y]
+DEFAULT_EXTENT = [37.0, 55.0, 38.0, 56.0]
+
+
+def random_polygons(count, vertices=32, size=0.01, extent=DEFAULT_EXTENT, seed=0):
+    """Star-shaped simple polygons of about size degrees with random centers."""
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(extent[:2], extent[2:], (count, 2))
+    angles = np.sort(rng.uniform(0, 2 * np.pi, (count, vertices)), axis=1)
+    radii = rng.uniform(0.3, 1.0, (count, vertices)) * size / 2
+    rings = centers[:, None, :] + np.stack((np.cos(angles), np.sin(angles)), axis=2) * radii[:, :, None]
+    rings = np.concatenate((rings, rings[:, :1]), axis=1)
+    return shapely.polygons(rings)
+
+
+def random_lines(count, vertices=32, step=0.001, extent=DEFAULT_EXTENT, seed=0):
+    """Random walks of the given number of vertices starting at random points."""
+    rng = np.random.default_rng(seed)
+    starts = rng.uniform(extent[:2], extent[2:], (count, 1, 2))
+    steps = rng.normal(0, step, (count, vertices - 1, 2))
+    return shapely.linestrings(np.concatenate((starts, starts + np.cumsum(steps, axis=1)), axis=1))
+
+
+def random_points(count, extent=DEFAULT_EXTENT, seed=0):
+    rng = np.random.default_rng(seed)
+    return shapely.points(rng.uniform(extent[:2], extent[2:], (count, 2)))
+
+
+def random_properties(count, seed=0):
+    rng = np.random.default_rng(seed)
+    values = rng.random(count).tolist()
+    return [{"id": i, "value": value, "name": "feature %d" % i} for i, value in enumerate(values)]
+
+
+def random_raster(width, height, bands=1, dtype='float32', seed=0):
+    """Smooth noise (a sum of random waves) as a height x width (x bands) array.
+
+    Floats are in [0, 1], integer types are scaled to their full range.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype('float32')
+    data = np.zeros((bands, height, width), dtype='float32')
+    for band in range(bands):
+        for _ in range(4):
+            frequency = rng.uniform(0.002, 0.05, 2)
+            phase = rng.uniform(0, 2 * np.pi)
+            data[band] += np.sin(x * frequency[0] + y * frequency[1] + phase)
+    data = (data - data.min()) / max(float(data.max() - data.min()), 1e-9)
+    if np.dtype(dtype).kind in "ui":
+        data = data * np.iinfo(dtype).max
+    data = data.astype(dtype)
+    if bands == 1:
+        return data[0]
+    return data.transpose((1, 2, 0))
@@ -0,0 +1,251 @@
+import datetime
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import numpy as np
+import shapely
+from Benchmarks.Generators import random_polygons, random_lines, random_points, random_properties, random_raster
+
+# Every case gets the run configuration and returns (run, parameters, cleanup or None). run is
+# timed repeat times after one warm-up call; cases that need missing modules are reported as skipped.
+
+DEFAULT_CONFIG = {"features": 10000, "vertices": 32, "raster_size": 2048, "layers": 20, "workers": None,
+                  "repeat": 5}
+# lookups of every kind timed by the spatial_queries case
+SPATIAL_QUERIES = 1000
+
+
+def vector_layer(name, geometries, properties=None):
+    from Core.Layers import VectorLayer
+    from Core.Storage import GeometryStore
+    layer = VectorLayer(name)
+    layer.store = GeometryStore(geometries, properties)
+    return layer
+
+
+def buffer_polygons(config):
+    from Core import Computing
+    layer = vector_layer("polygons", random_polygons(config["features"], config["vertices"]))
+    return (lambda: Computing.buffer(layer, 0.001, 8, workers=config["workers"]),
+            {"features": config["features"], "vertices": config["vertices"], "workers": config["workers"]}, None)
+
+
+def buffer_lines(config):
+    from Core import Computing
+    layer = vector_layer("lines", random_lines(config["features"], config["vertices"]))
+    return (lambda: Computing.buffer(layer, 0.001, 8, workers=config["workers"]),
+            {"features": config["features"], "vertices": config["vertices"], "workers": config["workers"]}, None)
+
+
+def intersection(config):
+    from Core import Computing
+    first_layer = vector_layer("first", random_polygons(config["features"], config["vertices"], seed=1))
+    second_layer = vector_layer("second", random_polygons(config["features"], config["vertices"], seed=2))
+    return (lambda: Computing.intersection(first_layer, second_layer, False, config["workers"]),
+            {"features": config["features"], "vertices": config["vertices"], "workers": config["workers"]}, None)
+
+
+def spatial_queries(config):
+    from Core.SpatialIndex import LayerIndex
+    from Core.Storage import GeometryStore
+    index = LayerIndex(GeometryStore(random_polygons(config["features"], config["vertices"])))
+    points = shapely.get_coordinates(random_points(SPATIAL_QUERIES, seed=1)).tolist()
+
+    def run():
+        for x, y in points:
+            index.bbox(x - 0.01, y - 0.01, x + 0.01, y + 0.01)
+            index.at_point(x, y)
+            index.nearest(x, y, 5)
+
+    return run, {"features": config["features"], "queries": SPATIAL_QUERIES}, None
+
+
+def write_png_colormap(config):
+    from Core.Utilities import write_png
+    data = random_raster(config["raster_size"], config["raster_size"])
+    return lambda: write_png(data, colormap="viridis"), {"size": config["raster_size"], "bands": 1}, None
+
+
+def write_png_rgb(config):
+    from Core.Utilities import write_png
+    data = random_raster(config["raster_size"], config["raster_size"], 3, 'uint8')
+    return lambda: write_png(data), {"size": config["raster_size"], "bands": 3}, None
+
+
+def image_to_data_array(config):
+    from Core.Utilities import image_to_data
+    data = random_raster(config["raster_size"], config["raster_size"], 3, 'uint8')
+    return lambda: image_to_data(data), {"size": config["raster_size"], "bands": 3}, None
+
+
+def image_to_data_file(config):
+    from Core.Utilities import image_to_data, write_png
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "raster.png")
+    with open(path, 'wb') as file:
+        file.write(write_png(random_raster(config["raster_size"], config["raster_size"], 3, 'uint8')))
+    return (lambda: image_to_data(path), {"size": config["raster_size"], "bytes": os.path.getsize(path)},
+            lambda: shutil.rmtree(directory))
+
+
+class StubSignal:
+    def connect(self, slot):
+        pass
+
+
+class StubPage:
+    """Web page that drops scripts, counting how many bytes were sent to it."""
+
+    def __init__(self):
+        self.sent_bytes = 0
+
+    def runJavaScript(self, script, callback=None):
+        self.sent_bytes += len(script)
+
+    def profile(self):
+        return self
+
+    def urlSchemeHandler(self, scheme):
+        return None
+
+    def installUrlSchemeHandler(self, scheme, handler):
+        pass
+
+    def setWebChannel(self, channel):
+        pass
+
+
+class StubWebView:
+    def __init__(self):
+        self.loadFinished = StubSignal()
+        self._page = StubPage()
+
+    def page(self):
+        return self._page
+
+    def setHtml(self, html):
+        pass
+
+
+class StubUI:
+    def show_message(self, *args):
+        pass
+
+    def project_opened(self, *args):
+        pass
+
+
+def application():
+    from PyQt5.QtCore import QCoreApplication
+    return QCoreApplication.instance() or QCoreApplication([])
+
+
+def stub_view(path):
+    from Core.View import View
+    application()
+    return View(StubWebView(), save_file_path=path, ui=StubUI())
+
+
+def wait_for_layers(view):
+    """Runs the event loop until every visible layer is created and its features are sent."""
+    app = application()
+    while any(layer.is_visible and not layer.on_map for layer in view.layers) or \
+            any(len(transfers) > 0 for transfers in view.transfers.values()):
+        app.processEvents()
+
+
+def project_layers(config):
+    features = max(config["features"] // config["layers"], 1)
+    return [vector_layer("layer %d" % i, random_polygons(features, config["vertices"], seed=i),
+                         random_properties(features, seed=i)) for i in range(config["layers"])]
+
+
+def view_save(config):
+    directory = tempfile.mkdtemp()
+    view = stub_view(os.path.join(directory, "project.gismin"))
+    for layer in project_layers(config):
+        view.layers.add(layer)
+    return (view.save, {"layers": config["layers"], "features": config["features"], "vertices": config["vertices"]},
+            lambda: shutil.rmtree(directory))
+
+
+def view_load(config):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "project.gismin")
+    writer = stub_view(path)
+    for layer in project_layers(config):
+        writer.layers.add(layer)
+    writer.save()
+
+    def run():
+        view = stub_view(path)
+        view.load(path)
+        wait_for_layers(view)
+
+    return run, {"layers": config["layers"], "features": config["features"], "vertices": config["vertices"]},\
+        lambda: shutil.rmtree(directory)
+
+
+CASES = [("buffer_polygons", buffer_polygons), ("buffer_lines", buffer_lines), ("intersection", intersection),
+         ("spatial_queries", spatial_queries),
+         ("write_png_colormap", write_png_colormap), ("write_png_rgb", write_png_rgb),
+         ("image_to_data_array", image_to_data_array), ("image_to_data_file", image_to_data_file),
+         ("view_save", view_save), ("view_load", view_load)]
+
+
+def measure(run, repeat):
+    run()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": statistics.median(times), "mean": statistics.mean(times), "runs": times}
+
+
+def environment():
+    return {"python": sys.version.split()[0], "platform": platform.platform(), "machine": platform.machine(),
+            "cpus": os.cpu_count(), "numpy": np.__version__, "shapely": shapely.__version__}
+
+
+def run_suite(config=None, names=None, log=None):
+    """Runs the cases (all of them or the named ones) and returns the report as a JSON-ready dict."""
+    config = dict(DEFAULT_CONFIG, **(config or {}))
+    results = []
+    for name, case in CASES:
+        if names is not None and name not in names:
+            continue
+        result = {"name": name}
+        try:
+            run, parameters, cleanup = case(config)
+        except ImportError as ex:
+            result["skipped"] = str(ex)
+        else:
+            result["parameters"] = parameters
+            try:
+                result["seconds"] = measure(run, config["repeat"])
+            finally:
+                if cleanup is not None:
+                    cleanup()
+        if log is not None:
+            log(result)
+        results.append(result)
+    return {"suite": "GISmin benchmarks", "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "environment": environment(), "config": config, "results": results}
+
+
+def compare(report, baseline, tolerance):
+    """Returns (name, baseline median, median) of the cases that got slower than the baseline by more than tolerance."""
+    baseline_medians = {result["name"]: result["seconds"]["median"] for result in baseline["results"]
+                        if "seconds" in result}
+    regressions = []
+    for result in report["results"]:
+        if "seconds" in result and result["name"] in baseline_medians:
+            baseline_median = baseline_medians[result["name"]]
+            if result["seconds"]["median"] > baseline_median * (1 + tolerance):
+                regressions.append((result["name"], baseline_median, result["seconds"]["median"]))
+    return regressions
@@ -0,0 +1,187 @@
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from Core import Computing
+from Core.Exceptions import BatchJobException, FileOpeningException
+from Core.GeoJSONReader import iter_features
+from Core.Layers import VectorLayer
+from Core.Project import ProjectFile
+from Core.Storage import GeometryStore
+
+# Runs buffer/intersection pipelines without the GUI. Nothing here may import PyQt5, so the module
+# works on servers without a display or Qt installed.
+#
+# A job is a JSON file:
+# {
+#     "inputs": {"roads": "roads.geojson", "zones": {"project": "city.gismin", "layer": "zones"}},
+#     "steps": [{"operation": "buffer", "layer": "roads", "distance": 0.001, "result": "roads_buffer"},
+#               {"operation": "intersection", "first": "roads_buffer", "second": "zones", "dissolve": false,
+#                "result": "roads_in_zones"}],
+#     "outputs": {"roads_in_zones": "roads_in_zones.ndjson"}
+# }
+# Relative paths are taken from the directory of the job file. Outputs ending with .ndjson or
+# .geojsonl are written one feature per line, other paths as a FeatureCollection, "-" to stdout.
+
+NDJSON_EXTENSIONS = [".ndjson", ".geojsonl", ".jsonl"]
+STDOUT = "-"
+
+
+def run_buffer(layers, step, workers):
+    return Computing.buffer(step_layer(layers, step, "layer"), step["distance"], step.get("segments", 1),
+                            step.get("cap_style", 1), step.get("join_style", 1), step.get("mitre_limit", 5.0),
+                            workers)
+
+
+def run_intersection(layers, step, workers):
+    return Computing.intersection(step_layer(layers, step, "first"), step_layer(layers, step, "second"),
+                                  step.get("dissolve", True), workers)
+
+
+OPERATIONS = {"buffer": run_buffer, "intersection": run_intersection}
+# keys every step of the operation must have besides "operation" and "result"
+REQUIRED_KEYS = {"buffer": ["layer", "distance"], "intersection": ["first", "second"]}
+
+
+def step_layer(layers, step, key):
+    if step.get(key) not in layers:
+        raise BatchJobException("Step '%s' refers to an undefined layer: %s" % (step["operation"], step.get(key)))
+    return layers[step[key]]
+
+
+def read_job(path):
+    try:
+        with open(path, 'r') as file:
+            job = json.load(file)
+    except (OSError, ValueError):
+        raise BatchJobException("Job file can't be read: %s" % path)
+    if not isinstance(job, dict):
+        raise BatchJobException("Job is not a JSON object: %s" % path)
+    for key, key_type in [("inputs", dict), ("steps", list), ("outputs", dict)]:
+        if key not in job:
+            raise BatchJobException("Job has no '%s': %s" % (key, path))
+        if not isinstance(job[key], key_type):
+            raise BatchJobException("Job '%s' has a wrong type: %s" % (key, path))
+    for name, source in job["inputs"].items():
+        if not isinstance(source, str) and not (isinstance(source, dict) and "project" in source and "layer" in source):
+            raise BatchJobException("Input '%s' is neither a file path nor a project and a layer" % name)
+    for step in job["steps"]:
+        if not isinstance(step, dict) or step.get("operation") not in OPERATIONS:
+            raise BatchJobException("Undefined operation: %s" % (step.get("operation") if isinstance(step, dict)
+                                                                 else step))
+        for key in REQUIRED_KEYS[step["operation"]] + ["result"]:
+            if key not in step:
+                raise BatchJobException("Step '%s' has no '%s'" % (step["operation"], key))
+    return job
+
+
+def job_path(job_file, path):
+    if path == STDOUT:
+        return path
+    return os.path.join(os.path.dirname(os.path.abspath(job_file)), path)
+
+
+def open_input(name, source, job_file, projects):
+    """Returns a VectorLayer read from a GeoJSON file or from a layer of a saved project."""
+    if isinstance(source, str):
+        layer = VectorLayer(name)
+        try:
+            layer.store = GeometryStore.from_features(iter_features(job_path(job_file, source)))
+            return layer
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            raise FileOpeningException("File can't be read: %s" % source)
+    project_path = job_path(job_file, source["project"])
+    if project_path not in projects:
+        projects[project_path] = ProjectFile(project_path)
+    project = projects[project_path]
+    for description in project.layers:
+        if description["name"] == source["layer"]:
+            if description["type"] != "vector":
+                raise BatchJobException("Layer is not the vector layer: %s" % source["layer"])
+            layer = VectorLayer(name)
+            layer.source = (project, description)
+            return layer
+    raise BatchJobException("Layer %s not found in %s" % (source["layer"], source["project"]))
+
+
+def write_features(store, file, ndjson):
+    """Writes the store feature by feature, so the output is never built as one string."""
+    if ndjson:
+        for feature in store.features():
+            file.write(feature)
+            file.write("\n")
+        return
+    file.write('{"type": "FeatureCollection", "features": [')
+    for i, feature in enumerate(store.features()):
+        if i > 0:
+            file.write(", ")
+        file.write(feature)
+    file.write("]}\n")
+
+
+def write_output(store, path):
+    ndjson = os.path.splitext(path)[1].lower() in NDJSON_EXTENSIONS
+    if path == STDOUT:
+        write_features(store, sys.stdout, True)
+        sys.stdout.flush()
+        return
+    temporary_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(temporary_path, 'w') as file:
+        write_features(store, file, ndjson)
+    os.replace(temporary_path, path)
+
+
+def run_job(job_file, workers=None):
+    """Runs the steps of a job file and writes its outputs. Returns {output layer: features count}."""
+    job = read_job(job_file)
+    projects = {}
+    try:
+        layers = {name: open_input(name, source, job_file, projects) for name, source in job["inputs"].items()}
+        for step in job["steps"]:
+            store = OPERATIONS[step["operation"]](layers, step, workers)
+            result = VectorLayer(step["result"])
+            result.store = store
+            layers[step["result"]] = result
+        counts = {}
+        for name, path in job["outputs"].items():
+            if name not in layers:
+                raise BatchJobException("Output refers to an undefined layer: %s" % name)
+            write_output(layers[name].store, job_path(job_file, path))
+            counts[name] = len(layers[name].store)
+        return counts
+    finally:
+        for project in projects.values():
+            project.close()
+
+
+def _run_job_safely(job_file, workers):
+    """Runs a job, returning its error message instead of raising, so one bad job does not stop the others."""
+    try:
+        return job_file, run_job(job_file, workers), None
+    except (BatchJobException, FileOpeningException) as e:
+        return job_file, None, e.message
+    except Exception as e:
+        # GEOS errors, wrong parameter values and the like
+        return job_file, None, getattr(e, "message", None) or "%s: %s" % (type(e).__name__, e)
+
+
+def _writes_stdout(job_file):
+    try:
+        return STDOUT in read_job(job_file)["outputs"].values()
+    except BatchJobException:
+        # reported when the job runs
+        return False
+
+
+def run_jobs(job_files, processes=None, workers=None):
+    """Runs job files in parallel processes. Yields (job file, output counts, error message) per job."""
+    stdout_jobs = [job_file for job_file in job_files if _writes_stdout(job_file)]
+    if len(stdout_jobs) > 0 and len(job_files) > 1:
+        raise BatchJobException("Only a single job can write to stdout")
+    if processes is None or processes <= 1 or len(job_files) <= 1:
+        for job_file in job_files:
+            yield _run_job_safely(job_file, workers)
+        return
+    with ProcessPoolExecutor(processes) as executor:
+        for result in executor.map(_run_job_safely, job_files, [workers] * len(job_files)):
+            yield result
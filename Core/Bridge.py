@@ -0,0 +1,17 @@
+from PyQt5.QtCore import QObject, pyqtSlot
+
+
+class MapBridge(QObject):
+    """Object the map page calls through QWebChannel, registered as "bridge"."""
+
+    def __init__(self, view):
+        super().__init__()
+        self.view = view
+
+    @pyqtSlot(float, float, int)
+    def map_clicked(self, lat, lng, zoom):
+        self.view.on_map_clicked(lat, lng, zoom)
+
+    @pyqtSlot(str, int)
+    def level_requested(self, layer_name, level):
+        self.view.push_level(layer_name, level)
@@ -0,0 +1,84 @@
+import numpy as np
+
+# color stops of the named ramps, evenly spaced from the lowest to the highest value
+NAMED_RAMPS = {
+    "gray": [(0, 0, 0), (255, 255, 255)],
+    "viridis": [(68, 1, 84), (59, 82, 139), (33, 145, 140), (94, 201, 98), (253, 231, 37)],
+    "terrain": [(51, 51, 153), (0, 153, 255), (0, 204, 102), (255, 255, 153), (128, 92, 84), (255, 255, 255)],
+    "ndvi": [(165, 0, 38), (244, 109, 67), (254, 224, 139), (217, 239, 139), (102, 189, 99), (0, 104, 55)],
+    "heat": [(0, 0, 0), (230, 0, 0), (255, 210, 0), (255, 255, 255)],
+}
+
+
+def ramp_table(name, size=256):
+    """Builds a size x 4 RGBA lookup table by linear interpolation of the named ramp stops."""
+    if name not in NAMED_RAMPS:
+        raise ValueError('Undefined color ramp: {}'.format(name))
+    stops = np.array(NAMED_RAMPS[name], dtype='float64')
+    positions = np.linspace(0, 1, len(stops))
+    samples = np.linspace(0, 1, size)
+    table = np.empty((size, 4), dtype='uint8')
+    for channel in range(3):
+        table[:, channel] = np.round(np.interp(samples, positions, stops[:, channel]))
+    table[:, 3] = 255
+    return table
+
+
+class Colormap:
+    """Maps single band values to RGBA colors with array operations over a lookup table.
+
+    Values between vmin and vmax are spread over the table rows; values outside are clipped.
+    When vmin or vmax is None it is taken from the valid values of the data. Values equal to
+    nodata and NaNs get nodata_color, an RGBA or an opaque RGB color.
+    """
+
+    def __init__(self, table="gray", vmin=None, vmax=None, nodata=None, nodata_color=(0, 0, 0, 0)):
+        if isinstance(table, str):
+            table = ramp_table(table)
+        table = np.asarray(table, dtype='uint8')
+        if table.ndim != 2 or table.shape[1] not in [3, 4]:
+            raise ValueError('Lookup table must be Nx3 (RGB) or Nx4 (RGBA)')
+        if table.shape[1] == 3:
+            table = np.concatenate((table, np.full((len(table), 1), 255, dtype='uint8')), axis=1)
+        self.table = table
+        self.vmin = vmin
+        self.vmax = vmax
+        self.nodata = nodata
+        nodata_color = np.asarray(nodata_color, dtype='uint8')
+        if nodata_color.shape not in [(3,), (4,)]:
+            raise ValueError('No data color must be RGB or RGBA')
+        if len(nodata_color) == 3:
+            nodata_color = np.append(nodata_color, np.uint8(255))
+        self.nodata_color = nodata_color
+
+    def valid_mask(self, values):
+        mask = np.ones(values.shape, dtype=bool)
+        if values.dtype.kind == 'f':
+            mask &= np.isfinite(values)
+        if self.nodata is not None:
+            mask &= values != self.nodata
+        return mask
+
+    def value_range(self, values, mask):
+        vmin, vmax = self.vmin, self.vmax
+        if vmin is None or vmax is None:
+            valid_values = values[mask]
+            if valid_values.size == 0:
+                return 0.0, 1.0
+            if vmin is None:
+                vmin = valid_values.min()
+            if vmax is None:
+                vmax = valid_values.max()
+        return float(vmin), float(vmax)
+
+    def __call__(self, values):
+        """Returns an uint8 array of shape values.shape + (4,)."""
+        values = np.asarray(values)
+        mask = self.valid_mask(values)
+        vmin, vmax = self.value_range(values, mask)
+        scale = (len(self.table) - 1) / (vmax - vmin) if vmax > vmin else 0.0
+        indexes = np.zeros(values.shape, dtype='intp')
+        indexes[mask] = np.clip((values[mask] - vmin) * scale, 0, len(self.table) - 1).astype('intp')
+        colors = self.table[indexes]
+        colors[~mask] = self.nodata_color
+        return colors
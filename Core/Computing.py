@@ -1,51 +1,186 @@
-from shapely.geometry import shape, mapping
+import math
+import numpy as np
+import shapely
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from shapely.ops import unary_union
+from shapely.prepared import prep
+from shapely.strtree import STRtree
 from Core.Layers import VectorLayer
-from Core.Exceptions import NotVectorLayer
-import geojson
+from Core.Exceptions import NotVectorLayer, OperationCancelledException
+from Core.Storage import GeometryStore
+from Core.Profiling import profiler, profiled
 
+# Layers with fewer features than this are always processed in the calling process
+PARALLEL_THRESHOLD = 5000
+# features processed in the calling process between progress reports and cancellation checks
+CHUNK_FEATURES = 1000
+# chunks sent to every worker process, more of them give finer progress
+CHUNKS_PER_WORKER = 4
 
-def buffer(layer, distance, segments=1, cap_style=1, join_style=1, mitre_limit=5.0):
+
+@profiled("computing")
+def buffer(layer, distance, segments=1, cap_style=1, join_style=1, mitre_limit=5.0, workers=None,
+           progress=None, cancelled=None):
+    """Buffers every feature of the layer, keeping its properties.
+
+    progress is called with the processed and the total features count after every chunk;
+    when cancelled returns True the operation stops with OperationCancelledException.
+    """
     if type(layer) is not VectorLayer:
         raise NotVectorLayer("Layer is not the vector layer!")
     if layer.type != "vector":
         raise NotVectorLayer("Layer type is not vector")
-    geo_data = geojson.loads(layer.data)
-    for feature in geo_data['features']:
-        shapely_feature = shape(feature['geometry'])
-        shapely_feature = shapely_feature.buffer(distance, resolution=segments, cap_style=cap_style,
-                                                 join_style=join_style, mitre_limit=mitre_limit)
-        mapped_feature = mapping(shapely_feature)
-        feature['geometry']['coordinates'] = mapped_feature['coordinates']
-        feature['geometry']['type'] = mapped_feature['type']
-    return geo_data
-
-
-def intersection(first_layer, second_layer):
+    geometries = layer.store.geometries
+    parameters = (distance, segments, cap_style, join_style, mitre_limit)
+    if profiler.enabled:
+        profiler.annotate(layer=layer.name, features=len(geometries), vertices=layer.store.vertex_count(),
+                          workers=workers)
+    if _use_pool(workers, len(geometries)):
+        executor = ProcessPoolExecutor(workers)
+        chunks = _split(geometries, workers * CHUNKS_PER_WORKER)
+        futures = _submit(executor, _buffer_chunk, [shapely.to_wkb(chunk) for chunk in chunks], repeat(parameters))
+        try:
+            buffered_chunks = _collect((shapely.from_wkb(future.result()) for future in futures), chunks,
+                                       progress, cancelled)
+        finally:
+            _shutdown(executor, futures)
+    else:
+        chunks = _split(geometries, math.ceil(len(geometries) / CHUNK_FEATURES))
+        results = (buffer_geometries(chunk, *parameters) for chunk in chunks)
+        buffered_chunks = _collect(results, chunks, progress, cancelled)
+    buffered_geometries = np.concatenate(buffered_chunks) if len(buffered_chunks) > 0 else []
+    result = GeometryStore(buffered_geometries, [dict(properties) for properties in layer.store.properties])
+    if profiler.enabled:
+        profiler.annotate(result_vertices=result.vertex_count())
+    return result
+
+
+def buffer_geometries(geometries, distance, segments=1, cap_style=1, join_style=1, mitre_limit=5.0):
+    return shapely.buffer(geometries, distance, quad_segs=segments, cap_style=cap_style,
+                          join_style=join_style, mitre_limit=mitre_limit)
+
+
+@profiled("computing")
+def intersection(first_layer, second_layer, dissolve=True, workers=None, progress=None, cancelled=None):
+    """Intersects every feature of the first layer with the second layer.
+
+    progress and cancelled work as in buffer, counting the features of the first layer.
+    """
+    result_features = [geometry for geometry in intersect_by_feature(first_layer, second_layer, workers,
+                                                                     progress, cancelled)
+                       if geometry is not None]
+    if dissolve and len(result_features) > 0:
+        with profiler.span("Computing.intersection dissolve", "computing", features=len(result_features)):
+            result_features = [unary_union(result_features)]
+    profiler.annotate(result_features=len(result_features))
+    return GeometryStore(result_features)
+
+
+@profiled("computing")
+def intersect_by_feature(first_layer, second_layer, workers=None, progress=None, cancelled=None):
+    """Returns the intersection of every feature of the first layer with the second layer, in the order
+    of the first layer, with None for features that intersect nothing.
+    """
     if type(first_layer) is not VectorLayer or type(second_layer) is not VectorLayer:
         raise NotVectorLayer("Layer is not the vector layer!")
     if first_layer.type != "vector" or second_layer.type != "vector":
         raise NotVectorLayer("Layer type is not vector")
-    first_geo_data = geojson.loads(first_layer.data)
-    second_geo_data = geojson.loads(second_layer.data)
+    first_geometries = first_layer.store.geometries
+    second_geometries = second_layer.store.geometries
+    if profiler.enabled:
+        profiler.annotate(first_layer=first_layer.name, second_layer=second_layer.name,
+                          first_features=len(first_geometries), second_features=len(second_geometries),
+                          first_vertices=first_layer.store.vertex_count(),
+                          second_vertices=second_layer.store.vertex_count(), workers=workers)
+    if _use_pool(workers, len(first_geometries)):
+        executor = ProcessPoolExecutor(workers, initializer=_init_intersection_worker,
+                                       initargs=(shapely.to_wkb(second_geometries),))
+        chunks = _split(first_geometries, workers * CHUNKS_PER_WORKER)
+        futures = _submit(executor, _intersection_chunk, [shapely.to_wkb(chunk) for chunk in chunks])
+        try:
+            result_chunks = _collect((shapely.from_wkb(future.result()) for future in futures), chunks,
+                                     progress, cancelled)
+        finally:
+            _shutdown(executor, futures)
+    else:
+        second_tree = STRtree(second_geometries)
+        chunks = _split(first_geometries, math.ceil(len(first_geometries) / CHUNK_FEATURES))
+        results = (intersect_geometries(chunk, second_geometries, second_tree, keep_empty=True) for chunk in chunks)
+        result_chunks = _collect(results, chunks, progress, cancelled)
+    return [geometry for chunk in result_chunks for geometry in chunk]
+
+
+def _split(geometries, chunks_count):
+    return [chunk for chunk in np.array_split(geometries, max(chunks_count, 1)) if len(chunk) > 0]
+
+
+def _submit(executor, function, *iterables):
+    """Like executor.map, but returns the futures, so the chunks not started yet can be cancelled."""
+    return [executor.submit(function, *arguments) for arguments in zip(*iterables)]
+
+
+def _shutdown(executor, futures):
+    """Cancels the chunks not started yet and shuts the pool down without waiting for the running ones.
+
+    Cancelling by hand keeps this working before Python 3.9, which added cancel_futures to shutdown.
+    """
+    for future in futures:
+        future.cancel()
+    executor.shutdown(wait=False)
+
+
+def _collect(results, chunks, progress, cancelled):
+    """Gathers the results of chunks in order, reporting progress and checking for cancellation between them."""
+    total_count = sum(len(chunk) for chunk in chunks)
+    collected = []
+    processed_count = 0
+    for result, chunk in zip(results, chunks):
+        collected.append(result)
+        processed_count += len(chunk)
+        if progress is not None:
+            progress(processed_count, total_count)
+        if cancelled is not None and cancelled():
+            raise OperationCancelledException("Operation is cancelled")
+    return collected
+
+
+def intersect_geometries(first_geometries, second_geometries, second_tree, keep_empty=False):
     result_features = []
-    for first_feature in first_geo_data["features"]:
-        first_shapely_feature = shape(first_feature["geometry"])
+    for first_shapely_feature in first_geometries:
+        prepared_feature = prep(first_shapely_feature)
         intersected_features = []
-        for second_feature in second_geo_data["features"]:
-            second_shapely_feature = shape(second_feature["geometry"])
-            intersected_features.append(first_shapely_feature.intersection(second_shapely_feature))
+        for index in sorted(second_tree.query(first_shapely_feature)):
+            second_shapely_feature = second_geometries[index]
+            if prepared_feature.intersects(second_shapely_feature):
+                intersected_feature = first_shapely_feature.intersection(second_shapely_feature)
+                if not intersected_feature.is_empty:
+                    intersected_features.append(intersected_feature)
         if len(intersected_features) > 0:
-            union_feature = intersected_features[0]
-            for i in range(1, len(intersected_features)):
-                union_feature = union_feature.union(intersected_features[i])
-            result_features.append(union_feature)
-    result_geo_data = {"type": "FeatureCollection", "features": []}
-    if len(result_features) > 0:
-        result_feature = result_features[0]
-        for i in range(1, len(result_features)):
-            result_feature = result_feature.union(result_features[i])
-        mapped_feature = mapping(result_feature)
-        result_geo_data["features"].append({"type": "Feature",
-                                            "geometry": {"coordinates": mapped_feature["coordinates"],
-                                                         "type": mapped_feature["type"]}})
-    return result_geo_data
+            result_features.append(unary_union(intersected_features))
+        elif keep_empty:
+            result_features.append(None)
+    return result_features
+
+
+def _use_pool(workers, features_count):
+    return workers is not None and workers > 1 and features_count >= PARALLEL_THRESHOLD
+
+
+def _buffer_chunk(wkb_chunk, parameters):
+    return shapely.to_wkb(buffer_geometries(shapely.from_wkb(wkb_chunk), *parameters))
+
+
+_worker_state = {}
+
+
+def _init_intersection_worker(second_wkb):
+    second_geometries = shapely.from_wkb(second_wkb)
+    _worker_state["second_geometries"] = second_geometries
+    _worker_state["second_tree"] = STRtree(second_geometries)
+
+
+def _intersection_chunk(wkb_chunk):
+    result_features = intersect_geometries(shapely.from_wkb(wkb_chunk), _worker_state["second_geometries"],
+                                           _worker_state["second_tree"], keep_empty=True)
+    return shapely.to_wkb(GeometryStore.to_array(result_features))
@@ -32,3 +32,21 @@ class LayerNotFoundException(Exception):
     def __init__(self, message):
         super().__init__(message)
         self.message = message
+
+
+class BatchJobException(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+class OperationCancelledException(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+class TileSeedingException(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
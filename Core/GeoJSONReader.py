@@ -0,0 +1,156 @@
+import json
+import os
+
+CHUNK_SIZE = 1024 * 1024
+# the first line is parsed to tell newline-delimited files from collections if it is not longer than this
+SNIFF_SIZE = 1024 * 1024
+NDJSON_EXTENSIONS = [".ndjson", ".geojsonl", ".jsonl", ".geojsons"]
+# RFC 8142 GeoJSON text sequences prefix every feature with the record separator
+RECORD_SEPARATOR = "\x1e"
+WHITESPACE = " \t\n\r" + RECORD_SEPARATOR
+
+
+class StreamBuffer:
+    """Text read from a file in chunks, of which only the part that was not consumed yet is kept."""
+
+    def __init__(self, file, chunk_size=CHUNK_SIZE):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.text = ""
+        self.position = 0
+        self.eof = False
+        # characters consumed and dropped from text so far
+        self.consumed = 0
+
+    def read_more(self):
+        """Reads the next chunk, at least as long as the kept text, so long values are not re-parsed often."""
+        chunk = self.file.read(max(self.chunk_size, len(self.text) - self.position))
+        if len(chunk) == 0:
+            self.eof = True
+            return False
+        self.consumed += self.position
+        self.text = self.text[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def skip_whitespace(self):
+        while True:
+            while self.position < len(self.text) and self.text[self.position] in WHITESPACE:
+                self.position += 1
+            if self.position < len(self.text) or not self.read_more():
+                return
+
+    def peek(self):
+        self.skip_whitespace()
+        return self.text[self.position] if self.position < len(self.text) else None
+
+    def expect(self, character):
+        if self.peek() != character:
+            raise ValueError("Expected '%s' at character %d" % (character, self.consumed + self.position))
+        self.position += 1
+
+    def decode(self, decoder):
+        """Decodes the next JSON value, reading more text until the value is complete."""
+        self.skip_whitespace()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.text, self.position)
+                # a number at the end of the text may continue in the next chunk
+                if end < len(self.text) or self.eof:
+                    self.position = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            if not self.read_more() and self.position >= len(self.text):
+                raise ValueError("Unexpected end of file")
+
+
+def iter_collection(buffer):
+    """Yields the features of a FeatureCollection without holding more than one of them as text.
+
+    A single top-level Feature is yielded as it is.
+    """
+    decoder = json.JSONDecoder()
+    # members other than features, which make up the feature if the object is a single one
+    members = {}
+    buffer.expect("{")
+    while buffer.peek() != "}":
+        key = buffer.decode(decoder)
+        buffer.expect(":")
+        if key == "features":
+            buffer.expect("[")
+            if buffer.peek() != "]":
+                while True:
+                    yield buffer.decode(decoder)
+                    if buffer.peek() != ",":
+                        break
+                    buffer.expect(",")
+            buffer.expect("]")
+        else:
+            members[key] = buffer.decode(decoder)
+        if buffer.peek() != ",":
+            break
+        buffer.expect(",")
+    buffer.expect("}")
+    if members.get("type") == "Feature":
+        yield members
+
+
+def iter_lines(buffer):
+    """Yields the features of newline-delimited GeoJSON (one feature per line)."""
+    decoder = json.JSONDecoder()
+    while buffer.peek() is not None:
+        feature = buffer.decode(decoder)
+        if not isinstance(feature, dict) or feature.get("type") != "Feature":
+            raise ValueError("Line is not a GeoJSON feature")
+        yield feature
+
+
+def is_newline_delimited(path, first_chunk):
+    if os.path.splitext(path)[1].lower() in NDJSON_EXTENSIONS:
+        return True
+    stripped = first_chunk.lstrip(" \t\r\n")
+    if stripped.startswith(RECORD_SEPARATOR):
+        return True
+    try:
+        feature = json.loads(stripped.split("\n", 1)[0])
+    except ValueError:
+        return False
+    return isinstance(feature, dict) and feature.get("type") == "Feature"
+
+
+def iter_features(path, chunk_size=CHUNK_SIZE):
+    """Yields the GeoJSON feature dicts of a FeatureCollection, a single Feature or a newline-delimited
+    GeoJSON file.
+
+    The file is read in chunks of chunk_size characters, so memory use does not grow with the file.
+    """
+    for features, _ in read_feature_batches(path, None, chunk_size):
+        yield from features
+
+
+def read_feature_batches(path, max_batch_bytes, chunk_size=CHUNK_SIZE):
+    """Yields (features, read characters) pairs with about max_batch_bytes of file text in each batch.
+
+    With max_batch_bytes set to None every feature is yielded as a batch of its own.
+    """
+    with open(path, 'r', encoding="utf-8") as file:
+        buffer = StreamBuffer(file, chunk_size)
+        while "\n" not in buffer.text and len(buffer.text) < SNIFF_SIZE and buffer.read_more():
+            pass
+        if is_newline_delimited(path, buffer.text):
+            features = iter_lines(buffer)
+        else:
+            features = iter_collection(buffer)
+        batch = []
+        batch_start = 0
+        for feature in features:
+            batch.append(feature)
+            read = buffer.consumed + buffer.position
+            if max_batch_bytes is None or read - batch_start >= max_batch_bytes:
+                yield batch, read
+                batch = []
+                batch_start = read
+        if len(batch) > 0:
+            yield batch, buffer.consumed + buffer.position
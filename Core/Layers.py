@@ -1,4 +1,11 @@
+import hashlib
+from collections import OrderedDict
+import math
+import os
+import shapely
 from Core.Exceptions import LayerCreatingException
+from Core.Storage import GeometryStore
+from Core.Utilities import data_url_to_bytes, image_to_data, file_hash
 
 
 class Layer:
@@ -8,27 +15,238 @@ class Layer:
         self.name = name
         self.type = layer_type
         self.is_visible = True
+        # whether the layer object exists in the web view
+        self.on_map = False
+        # (ProjectFile, layer description) the data is read from on first use
+        self.source = None
 
-    def to_save(self):
-        return "%s|splitter|%s|splitter|%s" % (self.type, self.name, self.is_visible)
+    @property
+    def is_loaded(self):
+        return self.source is None
+
+    def to_manifest(self):
+        return {"type": self.type, "name": self.name, "visible": self.is_visible, "bounds": self.bounds}
+
+    def has_payload(self):
+        return True
+
+    def write_payload(self, file):
+        project, description = self.source
+        project.copy_layer(description, file)
 
 
 class RasterLayer(Layer):
-    def __init__(self, name, data, bounds):
+    """Raster shown on the map.
+
+    A raster added from a file only keeps its path, bounds and content hash; the image is read
+    through GDAL windows and encoded as a data url only when it is rendered as a single image.
+    Rasters without a file (legacy projects, generated images) keep their data url.
+    """
+
+    def __init__(self, name, data, bounds, file_path=None, tiled=False, content_hash=None, signature=None):
         super().__init__(name, "raster")
-        self.data = data
+        self._data = data
         self.bounds = bounds
+        self.file_path = file_path
+        # whether the raster is shown as a tile pyramid instead of a single image
+        self.tiled = tiled
+        self.pyramid = None
+        # (sha256, size, mtime) of the file the hash was computed for
+        self._content_hash = None
+        if content_hash is not None and signature is not None:
+            # a saved hash is trusted only while the file has the saved size and mtime
+            self._content_hash = (content_hash,) + tuple(signature)
+
+    @property
+    def data(self):
+        if self._data is not None:
+            return self._data
+        if self.source is not None:
+            project, description = self.source
+            return project.read_layer(description)
+        if self.file_path is not None:
+            return image_to_data(self.file_path)
+        return None
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self.file_path = None
+        self.source = None
+
+    @staticmethod
+    def file_signature(path):
+        file_stat = os.stat(path)
+        return file_stat.st_size, file_stat.st_mtime_ns
+
+    @property
+    def content_hash(self):
+        if self.file_path is None:
+            return None
+        signature = RasterLayer.file_signature(self.file_path)
+        if self._content_hash is None or self._content_hash[1:] != signature:
+            self._content_hash = (file_hash(self.file_path),) + signature
+        return self._content_hash[0]
 
-    def to_save(self):
-        return "%s|splitter|%s|splitter|%s|splitter|%s|splitter|%s|splitter|%s|splitter|%s|splitter|%s" %\
-               (self.type, self.name, self.is_visible, self.bounds[0][0], self.bounds[0][1],
-                self.bounds[1][0], self.bounds[1][1], self.data)
+    def has_payload(self):
+        return self._data is not None or self.source is not None
+
+    def to_manifest(self):
+        manifest = super().to_manifest()
+        if self.has_payload():
+            manifest["format"] = self.payload_extension()
+        else:
+            manifest["path"] = os.path.abspath(self.file_path)
+            manifest["hash"] = self.content_hash
+            manifest["size"], manifest["mtime"] = self._content_hash[1:]
+        if self.tiled:
+            manifest["tiled"] = True
+        return manifest
+
+    def payload_extension(self):
+        if not self.is_loaded and "format" in self.source[1]:
+            return self.source[1]["format"]
+        return data_url_to_bytes(self.data)[0]
+
+    def write_payload(self, file):
+        if not self.is_loaded and not self.source[0].legacy:
+            super().write_payload(file)
+        else:
+            file.write(data_url_to_bytes(self.data)[1])
+
+    def gdal_path(self):
+        """Returns a path GDAL can open the image from without decoding the layer data."""
+        if not self.is_loaded and not self.source[0].legacy:
+            project, description = self.source
+            return project.gdal_path(description)
+        if self.file_path is not None:
+            return self.file_path
+        return None
+
+    def tiles_key(self):
+        if not self.is_loaded and not self.source[0].legacy:
+            project, description = self.source
+            identity = project.entry_identity(description)
+        else:
+            identity = self.content_hash
+        return hashlib.sha1(("%s|%s" % (identity, self.bounds)).encode("utf-8")).hexdigest()
 
 
 class VectorLayer(Layer):
-    def __init__(self, name, data):
+    def __init__(self, name, data=None):
         super().__init__(name, "vector")
-        self.data = data
+        self._store = GeometryStore.from_geo_data(data) if data is not None else None
+        # whether the layer is shown with simplified copies at lower zooms
+        self.level_of_detail = False
+        # (min zoom, max zoom, tolerance) of the detail levels in the web view and the indexes of the
+        # levels whose features were sent
+        self.levels = None
+        self.sent_levels = set()
+        # render as vector tiles: True, False or None to decide by the features count
+        self.vector_tiles = None
+        # Lineage of a layer computed from other layers, kept up to date when they change
+        self.lineage = None
+
+    def to_manifest(self):
+        manifest = super().to_manifest()
+        if self.vector_tiles is not None:
+            manifest["vector_tiles"] = self.vector_tiles
+        if self.lineage is not None:
+            manifest["lineage"] = self.lineage.to_manifest()
+        return manifest
+
+    @property
+    def store(self):
+        if self._store is None:
+            if self.source is not None:
+                project, description = self.source
+                self._store = GeometryStore.from_geo_data(project.read_layer(description))
+                self.source = None
+            else:
+                self._store = GeometryStore()
+        return self._store
+
+    @store.setter
+    def store(self, store):
+        self._store = store
+        self.source = None
+
+    @property
+    def data(self):
+        return self.store.serialize()
+
+    @data.setter
+    def data(self, data):
+        self.store = GeometryStore.from_geo_data(data)
+
+    @property
+    def bounds(self):
+        if not self.is_loaded and "bounds" in self.source[1]:
+            return self.source[1]["bounds"]
+        min_x, min_y, max_x, max_y = shapely.total_bounds(self.store.geometries)
+        if math.isnan(min_x):
+            return None
+        return [[float(min_y), float(min_x)], [float(max_y), float(max_x)]]
+
+    @staticmethod
+    def payload_extension():
+        return "geojson"
+
+    def write_payload(self, file):
+        if not self.is_loaded and not self.source[0].legacy:
+            super().write_payload(file)
+        else:
+            file.write(self.data.encode("utf-8"))
+
+
+class LayerRegistry:
+    """Layers by name in z-order, from the bottom layer to the top one.
+
+    Lookup, adding, removing and moving a layer to the back or the front take constant time. Every
+    layer also gets a z-index: one above the top layer when it is added or brought to the front and
+    one below the bottom layer when it is sent to the back, so no other layer has to change.
+    """
+
+    # z-index of the first layer, far enough from 0 to be sent to the back any number of times
+    FIRST_Z_INDEX = 1000000000
+
+    def __init__(self):
+        self._layers = OrderedDict()
+        self._z_indexes = {}
+        self._bottom_z_index = LayerRegistry.FIRST_Z_INDEX
+        self._top_z_index = LayerRegistry.FIRST_Z_INDEX - 1
+
+    def __len__(self):
+        return len(self._layers)
+
+    def __iter__(self):
+        return iter(list(self._layers.values()))
+
+    def __contains__(self, layer_name):
+        return layer_name in self._layers
+
+    def get(self, layer_name):
+        return self._layers.get(layer_name)
+
+    def z_index(self, layer_name):
+        return self._z_indexes[layer_name]
+
+    def add(self, layer):
+        """Adds the layer on top of the others."""
+        self._layers[layer.name] = layer
+        self._top_z_index += 1
+        self._z_indexes[layer.name] = self._top_z_index
+
+    def remove(self, layer_name):
+        del self._z_indexes[layer_name]
+        return self._layers.pop(layer_name)
+
+    def move_to_back(self, layer_name):
+        self._layers.move_to_end(layer_name, last=False)
+        self._bottom_z_index -= 1
+        self._z_indexes[layer_name] = self._bottom_z_index
 
-    def to_save(self):
-        return "%s|splitter|%s|splitter|%s|splitter|%s" % (self.type, self.name, self.is_visible, self.data)
+    def move_to_front(self, layer_name):
+        self._layers.move_to_end(layer_name)
+        self._top_z_index += 1
+        self._z_indexes[layer_name] = self._top_z_index
@@ -0,0 +1,120 @@
+import numpy as np
+from shapely.strtree import STRtree
+from Core import Computing
+from Core.Layers import VectorLayer
+from Core.Storage import GeometryStore
+
+# A derived layer keeps the lineage of the operation it was computed by. Every result feature comes
+# from one feature of the first source layer, so when source features change only their results are
+# removed and computed again. Changes are read from the change logs of the source stores; a source
+# store that was replaced, or whose log no longer reaches back far enough, is computed again in full.
+
+class Lineage:
+    def __init__(self, operation, parameters, sources):
+        self.operation = operation
+        self.parameters = parameters
+        # names of the source layers
+        self.sources = sources
+        # (store id, version) of every source store at the last computation
+        self.seen = {}
+        # result feature id by the id of the first source feature it was computed from
+        self.outputs = {}
+
+    def to_manifest(self):
+        return {"operation": self.operation, "parameters": self.parameters, "sources": self.sources}
+
+    @staticmethod
+    def from_manifest(description):
+        return Lineage(description["operation"], description["parameters"], description["sources"])
+
+    def is_current(self, source_layers):
+        return all(self.seen.get(layer.name) == (layer.store.store_id, layer.store.version)
+                   for layer in source_layers)
+
+    def compute(self, source_layers, workers=None, progress=None, cancelled=None, cache=None):
+        """Runs the operation over the source layers, or takes its result from cache (a ResultCache).
+
+        Returns the result store and the ids of the first source features the results come from,
+        or None as ids when the results are dissolved into one feature.
+        """
+        first_layer = source_layers[0]
+        if cache is not None:
+            key = cache.key(self.operation, self.parameters, [layer.store for layer in source_layers])
+            cached = cache.get(key)
+            if cached is not None:
+                store, positions = cached
+                return store, first_layer.store.ids[positions] if positions is not None else None
+        if self.operation == "buffer":
+            parameters = self.parameters
+            store = Computing.buffer(first_layer, parameters["distance"], parameters["segments"],
+                                     parameters["cap_style"], parameters["join_style"], parameters["mitre_limit"],
+                                     workers, progress, cancelled)
+            positions = np.arange(len(store))
+        elif self.parameters["dissolve"]:
+            store = Computing.intersection(first_layer, source_layers[1], True, workers, progress, cancelled)
+            positions = None
+        else:
+            geometries = Computing.intersect_by_feature(first_layer, source_layers[1], workers, progress, cancelled)
+            positions = np.flatnonzero([geometry is not None for geometry in geometries])
+            store = GeometryStore([geometries[i] for i in positions.tolist()])
+        if cache is not None:
+            cache.put(key, store, positions)
+        return store, first_layer.store.ids[positions] if positions is not None else None
+
+    def record(self, source_layers, store, source_ids):
+        """Remembers the source versions a full result store was computed from."""
+        self.seen = {layer.name: (layer.store.store_id, layer.store.version) for layer in source_layers}
+        self.outputs = dict(zip(source_ids.tolist(), store.ids.tolist())) if source_ids is not None else {}
+
+    def changes(self, source_layers):
+        """Returns {source layer name: changed feature ids and their old geometries}, or None if a source
+        has to be read again in full.
+        """
+        changes = {}
+        for layer in source_layers:
+            seen = self.seen.get(layer.name)
+            if seen is None or seen[0] != layer.store.store_id:
+                return None
+            layer_changes = layer.store.changes_since(seen[1])
+            if layer_changes is None:
+                return None
+            changes[layer.name] = layer_changes
+        return changes
+
+    def affected(self, source_layers, changes):
+        """Returns the ids of the first source features whose results have to be computed again."""
+        first_layer = source_layers[0]
+        affected = set(changes[first_layer.name])
+        if self.operation == "intersection":
+            second_layer = source_layers[1]
+            second_changes = changes[second_layer.name]
+            # results of first features touching either the old or the new shape of a changed feature
+            geometries = [geometry for geometry in second_changes.values() if geometry is not None]
+            indexes = second_layer.store.indexes(list(second_changes))
+            geometries.extend(second_layer.store.geometries[indexes])
+            if len(geometries) > 0 and len(first_layer.store) > 0:
+                hits = STRtree(first_layer.store.geometries).query(GeometryStore.to_array(geometries))[1]
+                affected.update(first_layer.store.ids[np.unique(hits)].tolist())
+        return affected
+
+    def update(self, store, source_layers, workers=None):
+        """Applies the changes of the source layers since the last computation to the result store.
+
+        Returns the ids of the removed result features and a store of the added ones (with their ids
+        in the result store), or None when nothing can be updated incrementally.
+        """
+        if self.operation == "intersection" and self.parameters["dissolve"]:
+            return None
+        changes = self.changes(source_layers)
+        if changes is None:
+            return None
+        affected = self.affected(source_layers, changes)
+        removed_ids = [self.outputs.pop(feature_id) for feature_id in affected if feature_id in self.outputs]
+        changed_layer = VectorLayer(source_layers[0].name)
+        changed_layer.store = source_layers[0].store.select(sorted(affected))
+        added, source_ids = self.compute([changed_layer] + list(source_layers[1:]), workers)
+        store.remove(removed_ids)
+        added_ids = store.extend(added)
+        self.outputs.update(zip(source_ids.tolist(), added_ids.tolist()))
+        self.seen = {layer.name: (layer.store.store_id, layer.store.version) for layer in source_layers}
+        return removed_ids, GeometryStore(added.geometries, added.properties, added_ids)
@@ -0,0 +1,163 @@
+import math
+import numpy as np
+import shapely
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from shapely.errors import GEOSException
+from shapely.strtree import STRtree
+from Core.Computing import CHUNK_FEATURES, CHUNKS_PER_WORKER, _split, _use_pool, _submit, _shutdown
+from Core.Exceptions import NotVectorLayer, OperationCancelledException
+from Core.Layers import VectorLayer
+from Core.Storage import GeometryStore
+from Core.Profiling import profiler, profiled
+
+# Overlay of two vector layers. Candidate pairs come from an STRtree of the second layer queried with
+# the intersects predicate, which GEOS tests on prepared geometries, so only pairs that really
+# intersect are clipped. The first layer is processed in chunks and the result is yielded chunk by
+# chunk, so it can be shown while the rest is computed.
+
+# intersection: a feature per intersecting pair of features, with the properties of both
+# cut: the parts of the first layer features inside the second layer
+# difference: the parts of the first layer features outside the second layer
+OPERATIONS = ["intersection", "cut", "difference"]
+# added to the names of second layer properties that the first layer feature has too
+SECOND_SUFFIX = "_2"
+
+
+def overlay_geometries(operation, first_geometries, second_geometries, second_tree):
+    """Returns the result geometries of a chunk with the indexes of their first geometries in the chunk
+    and, for intersection, of their second geometries.
+    """
+    first_indexes, second_indexes = second_tree.query(first_geometries, predicate="intersects")
+    if operation == "intersection":
+        geometries = _robust(shapely.intersection, first_geometries[first_indexes], second_geometries[second_indexes])
+        keep = _same_dimension(geometries, first_geometries[first_indexes], second_geometries[second_indexes])
+        return geometries[keep], first_indexes[keep], second_indexes[keep]
+    # query results are sorted by the first index, so every first geometry gets a run of second ones
+    hit_indexes, starts = np.unique(first_indexes, return_index=True)
+    masks = GeometryStore.to_array([_robust_union(second_geometries[run])
+                                    for run in np.split(second_indexes, starts[1:])] if len(starts) > 0 else [])
+    if operation == "cut":
+        geometries = _robust(shapely.intersection, first_geometries[hit_indexes], masks)
+        keep = _same_dimension(geometries, first_geometries[hit_indexes], masks)
+        return geometries[keep], hit_indexes[keep], None
+    geometries = first_geometries.copy()
+    geometries[hit_indexes] = _robust(shapely.difference, first_geometries[hit_indexes], masks)
+    keep = ~shapely.is_empty(geometries)
+    return geometries[keep], np.flatnonzero(keep), None
+
+
+def _repaired(geometries):
+    invalid = ~shapely.is_valid(geometries)
+    if not invalid.any():
+        return geometries
+    geometries = geometries.copy()
+    geometries[invalid] = shapely.make_valid(geometries[invalid])
+    return geometries
+
+
+def _robust(function, first_geometries, second_geometries):
+    """Runs a GEOS overlay function, repairing invalid geometries only when it fails on them."""
+    try:
+        return function(first_geometries, second_geometries)
+    except GEOSException:
+        return function(_repaired(first_geometries), _repaired(second_geometries))
+
+
+def _robust_union(geometries):
+    try:
+        return shapely.union_all(geometries)
+    except GEOSException:
+        return shapely.union_all(_repaired(geometries))
+
+
+def _same_dimension(geometries, first_geometries, second_geometries):
+    """Drops empty results and the lower dimensional ones of geometries that only touch."""
+    dimensions = np.minimum(shapely.get_dimensions(first_geometries), shapely.get_dimensions(second_geometries))
+    return ~shapely.is_empty(geometries) & (shapely.get_dimensions(geometries) >= dimensions)
+
+
+def merge_properties(first_properties, second_properties):
+    properties = dict(first_properties)
+    for key, value in second_properties.items():
+        properties[key + SECOND_SUFFIX if key in properties else key] = value
+    return properties
+
+
+def overlay(operation, first_layer, second_layer, workers=None, progress=None, cancelled=None):
+    """Yields the result of overlaying the first layer with the second one as a GeometryStore per chunk
+    of the first layer, see OPERATIONS.
+
+    progress and cancelled work as in Computing.buffer, counting the features of the first layer.
+    """
+    if operation not in OPERATIONS:
+        raise ValueError("Undefined overlay operation: %s" % operation)
+    if type(first_layer) is not VectorLayer or type(second_layer) is not VectorLayer:
+        raise NotVectorLayer("Layer is not the vector layer!")
+    if first_layer.type != "vector" or second_layer.type != "vector":
+        raise NotVectorLayer("Layer type is not vector")
+    first_store = first_layer.store
+    second_store = second_layer.store
+    if _use_pool(workers, len(first_store)):
+        executor = ProcessPoolExecutor(workers, initializer=_init_overlay_worker,
+                                       initargs=(shapely.to_wkb(second_store.geometries),))
+        chunks = _split(first_store.geometries, workers * CHUNKS_PER_WORKER)
+        futures = _submit(executor, _overlay_chunk, repeat(operation), [shapely.to_wkb(chunk) for chunk in chunks])
+        try:
+            yield from _batches(operation, ((shapely.from_wkb(wkb), first_indexes, second_indexes)
+                                            for wkb, first_indexes, second_indexes
+                                            in (future.result() for future in futures)),
+                                chunks, first_store, second_store, progress, cancelled)
+        finally:
+            _shutdown(executor, futures)
+    else:
+        second_tree = STRtree(second_store.geometries)
+        chunks = _split(first_store.geometries, math.ceil(len(first_store) / CHUNK_FEATURES))
+        results = (overlay_geometries(operation, chunk, second_store.geometries, second_tree) for chunk in chunks)
+        yield from _batches(operation, results, chunks, first_store, second_store, progress, cancelled)
+
+
+def _batches(operation, results, chunks, first_store, second_store, progress, cancelled):
+    total_count = len(first_store)
+    processed_count = 0
+    for (geometries, first_indexes, second_indexes), chunk in zip(results, chunks):
+        first_indexes = first_indexes + processed_count
+        if operation == "intersection":
+            properties = [merge_properties(first_store.properties[i], second_store.properties[j])
+                          for i, j in zip(first_indexes.tolist(), second_indexes.tolist())]
+        else:
+            properties = [dict(first_store.properties[i]) for i in first_indexes.tolist()]
+        processed_count += len(chunk)
+        if progress is not None:
+            progress(processed_count, total_count)
+        if cancelled is not None and cancelled():
+            raise OperationCancelledException("Operation is cancelled")
+        yield GeometryStore(geometries, properties)
+
+
+@profiled("computing")
+def overlay_layers(operation, first_layer, second_layer, workers=None, progress=None, cancelled=None):
+    """Returns the whole result of overlay as one store."""
+    geometries = []
+    properties = []
+    for batch in overlay(operation, first_layer, second_layer, workers, progress, cancelled):
+        geometries.append(batch.geometries)
+        properties.extend(batch.properties)
+    profiler.annotate(operation=operation, result_features=len(properties))
+    return GeometryStore(np.concatenate(geometries) if len(geometries) > 0 else [], properties)
+
+
+_worker_state = {}
+
+
+def _init_overlay_worker(second_wkb):
+    second_geometries = shapely.from_wkb(second_wkb)
+    _worker_state["second_geometries"] = second_geometries
+    _worker_state["second_tree"] = STRtree(second_geometries)
+
+
+def _overlay_chunk(operation, wkb_chunk):
+    geometries, first_indexes, second_indexes = overlay_geometries(operation, shapely.from_wkb(wkb_chunk),
+                                                                   _worker_state["second_geometries"],
+                                                                   _worker_state["second_tree"])
+    return shapely.to_wkb(geometries), first_indexes, second_indexes
@@ -0,0 +1,146 @@
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Opt-in timing spans. While disabled, span() and the profiled decorator cost one attribute check.
+# Spans are kept as Chrome trace "complete" events, so the export opens in chrome://tracing or
+# https://ui.perfetto.dev. Bytes sent over the JS bridge are added to every open span of the thread.
+
+MAX_EVENTS = 200000
+# when set, profiling starts on import and the trace is written to this path at exit
+TRACE_PATH_VARIABLE = "GISMIN_TRACE"
+
+
+class Span:
+    def __init__(self, profiler, name, category, args):
+        self.profiler = profiler
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.profiler.stack().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter()
+        self.profiler.stack().pop()
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.profiler.record(self, end)
+        return False
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.js_bytes = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.origin = time.perf_counter()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        with self.lock:
+            self.events = []
+            self.js_bytes = 0
+
+    def stack(self):
+        if not hasattr(self.local, "spans"):
+            self.local.spans = []
+        return self.local.spans
+
+    def span(self, name, category="gismin", **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, category, args)
+
+    def annotate(self, **args):
+        """Adds values (feature counts, sizes...) to the innermost open span of the calling thread."""
+        if self.enabled and len(self.stack()) > 0:
+            self.stack()[-1].args.update(args)
+
+    def add_js_bytes(self, count):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.js_bytes += count
+        for span in self.stack():
+            span.args["js_bytes"] = span.args.get("js_bytes", 0) + count
+
+    def record(self, span, end):
+        event = {"name": span.name, "cat": span.category, "ph": "X", "pid": os.getpid(),
+                 "tid": threading.get_ident(), "ts": (span.start - self.origin) * 1e6,
+                 "dur": (end - span.start) * 1e6, "args": span.args}
+        with self.lock:
+            if len(self.events) < MAX_EVENTS:
+                self.events.append(event)
+
+    def trace(self):
+        with self.lock:
+            events = list(self.events)
+        return {"traceEvents": events, "displayTimeUnit": "ms",
+                "otherData": {"js_bytes": self.js_bytes}}
+
+    def export_trace(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.trace(), file)
+
+    def summary(self):
+        """Returns {span name: {"calls", "total_ms", "max_ms", "js_bytes"}} ordered by total time."""
+        totals = {}
+        with self.lock:
+            events = list(self.events)
+        for event in events:
+            total = totals.setdefault(event["name"], {"calls": 0, "total_ms": 0.0, "max_ms": 0.0, "js_bytes": 0})
+            total["calls"] += 1
+            total["total_ms"] += event["dur"] / 1000
+            total["max_ms"] = max(total["max_ms"], event["dur"] / 1000)
+            total["js_bytes"] += event["args"].get("js_bytes", 0)
+        return OrderedDict(sorted(totals.items(), key=lambda item: -item[1]["total_ms"]))
+
+
+profiler = Profiler()
+if os.environ.get(TRACE_PATH_VARIABLE):
+    profiler.enable()
+    atexit.register(profiler.export_trace, os.environ[TRACE_PATH_VARIABLE])
+
+
+def profiled(category):
+    """Decorator that wraps every call of the function in a span named after it."""
+    def decorator(function):
+        name = function.__qualname__
+        if "." not in name:
+            name = "%s.%s" % (function.__module__.split(".")[-1], name)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return function(*args, **kwargs)
+            with profiler.span(name, category):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
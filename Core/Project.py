@@ -0,0 +1,135 @@
+import json
+import os
+import shutil
+import zipfile
+from Core.Exceptions import FileOpeningException
+from Core.Utilities import bytes_to_data_url
+
+FORMAT_NAME = "GISmin project"
+FORMAT_VERSION = 1
+MANIFEST_ENTRY = "manifest.json"
+LEGACY_HEADER = "[GISmin save]\n"
+
+
+def save_project(path, map_tiles, layers):
+    """Writes layers to a zip container: a JSON manifest plus one entry per layer.
+
+    Layers that were never loaded are copied from their project entry without decoding and
+    are rebound to the written file afterwards.
+    """
+    manifest = {"format": FORMAT_NAME, "version": FORMAT_VERSION, "map_tiles": map_tiles, "layers": []}
+    temporary_path = path + ".tmp"
+    with zipfile.ZipFile(temporary_path, 'w') as container:
+        for i, layer in enumerate(layers):
+            description = layer.to_manifest()
+            if "path" in description:
+                # referenced files are found relative to the project first, so both can be moved together
+                description["relative_path"] = os.path.relpath(description["path"], os.path.dirname(
+                    os.path.abspath(path)))
+            if not layer.has_payload():
+                manifest["layers"].append(description)
+                continue
+            description["entry"] = "layers/%d.%s" % (i, layer.payload_extension())
+            entry_info = zipfile.ZipInfo(description["entry"])
+            # raster images are already compressed
+            entry_info.compress_type = zipfile.ZIP_DEFLATED if layer.type == "vector" else zipfile.ZIP_STORED
+            with container.open(entry_info, 'w', force_zip64=True) as entry:
+                layer.write_payload(entry)
+            manifest["layers"].append(description)
+        container.writestr(MANIFEST_ENTRY, json.dumps(manifest, indent=1), zipfile.ZIP_DEFLATED)
+    unloaded_layers = [layer for layer in layers if not layer.is_loaded]
+    for layer in unloaded_layers:
+        layer.source[0].close()
+    os.replace(temporary_path, path)
+    if len(unloaded_layers) > 0:
+        project = ProjectFile(path)
+        for layer, description in zip(layers, project.layers):
+            if not layer.is_loaded:
+                layer.source = (project, description)
+
+
+class ProjectFile:
+    """Read access to a saved project in either the zip or the legacy text format."""
+
+    def __init__(self, path):
+        self.path = path
+        self.container = None
+        self.legacy = not zipfile.is_zipfile(path)
+        try:
+            if self.legacy:
+                self.map_tiles, self.layers = ProjectFile.read_legacy(path)
+            else:
+                self.container = zipfile.ZipFile(path, 'r')
+                manifest = json.loads(self.container.read(MANIFEST_ENTRY).decode("utf-8"))
+                if manifest.get("format") != FORMAT_NAME:
+                    raise FileOpeningException("File is not save file")
+                if manifest.get("version", 0) > FORMAT_VERSION:
+                    raise FileOpeningException("Save file is created by a newer version")
+                self.map_tiles = manifest["map_tiles"]
+                self.layers = manifest["layers"]
+        except FileOpeningException:
+            self.close()
+            raise
+        except OSError:
+            self.close()
+            raise FileOpeningException("File can't be read!")
+        except Exception:
+            self.close()
+            raise FileOpeningException("Bad file!")
+
+    @staticmethod
+    def read_legacy(path):
+        layers = []
+        with open(path, 'r') as file:
+            if file.readline() != LEGACY_HEADER:
+                raise FileOpeningException("File is not save file")
+            map_tiles = file.readline().replace("\n", "")
+            for line in file:
+                splitted_line = line.replace("\n", "").split("|splitter|")
+                if splitted_line[0] == "raster":
+                    layers.append({"type": "raster", "name": splitted_line[1], "visible": splitted_line[2] != "False",
+                                   "bounds": [[splitted_line[3], splitted_line[4]],
+                                              [splitted_line[5], splitted_line[6]]],
+                                   "data": splitted_line[7]})
+                elif splitted_line[0] == "vector":
+                    layers.append({"type": "vector", "name": splitted_line[1], "visible": splitted_line[2] != "False",
+                                   "data": splitted_line[3]})
+        return map_tiles, layers
+
+    def read_layer(self, description):
+        """Returns the stored data of the layer: GeoJSON text or a raster data url."""
+        if self.legacy:
+            return description["data"]
+        try:
+            payload = self.container.read(description["entry"])
+        except Exception:
+            raise FileOpeningException("Bad file!")
+        if description["type"] == "vector":
+            return payload.decode("utf-8")
+        return bytes_to_data_url(payload, description["format"])
+
+    def copy_layer(self, description, file):
+        with self.container.open(description["entry"]) as entry:
+            shutil.copyfileobj(entry, file)
+
+    def resolve_path(self, description):
+        """Returns the existing file a raster description refers to, or None."""
+        relative_path = os.path.join(os.path.dirname(os.path.abspath(self.path)),
+                                     description.get("relative_path", ""))
+        for path in [relative_path, description["path"]]:
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def gdal_path(self, description):
+        return "/vsizip/%s/%s" % (os.path.abspath(self.path), description["entry"])
+
+    def entry_identity(self, description):
+        entry_info = self.container.getinfo(description["entry"])
+        return "%s|%s|%d|%08x" % (os.path.abspath(self.path), description["entry"],
+                                  entry_info.file_size, entry_info.CRC)
+
+    def close(self):
+        if self.container is not None:
+            self.container.close()
+            self.container = None
@@ -0,0 +1,353 @@
+import os
+import xml.etree.ElementTree as ElementTree
+import numpy as np
+from osgeo import gdal, osr
+from Core.Exceptions import OperationCancelledException
+from Core.Tiles import meters_to_lon_lat
+
+# Scenes are read through their metadata: an ESPA .xml file listing one GeoTIFF per band, or a single
+# (Geo)TIFF. Composites are read at the display resolution, never as full bands.
+
+# natural color bands of Landsat 8 surface reflectance products
+ESPA_COMPOSITE_BANDS = ["sr_band4", "sr_band3", "sr_band2"]
+# largest side of a composite in pixels
+COMPOSITE_SIZE = 2048
+# output rows read from the file at once
+STRIP_ROWS = 256
+# percentiles of the valid values stretched to the darkest and the brightest color
+STRETCH_PERCENTILES = (2, 98)
+# GDAL names of the ESPA data types
+ESPA_DATA_TYPES = {"UINT8": "Byte", "INT8": "Int8", "UINT16": "UInt16", "INT16": "Int16", "UINT32": "UInt32",
+                   "INT32": "Int32", "FLOAT32": "Float32", "FLOAT64": "Float64"}
+
+
+class RasterFile:
+    """Windowed read access to an image file through GDAL, without reading it as a whole.
+
+    nodata overrides the fill value the file declares, so resampled reads skip it.
+    """
+
+    def __init__(self, path, nodata=None):
+        self.path = path
+        self.nodata = nodata
+        self._dataset = None
+
+    @property
+    def dataset(self):
+        if self._dataset is None:
+            gdal.UseExceptions()
+            self._dataset = gdal.Open(self.path, gdal.GA_ReadOnly)
+            if self.nodata is not None and self._dataset.GetRasterBand(1).GetNoDataValue() != self.nodata:
+                # a virtual copy of the file declaring the fill value, it can't be memory mapped
+                self._dataset = gdal.Translate("", self._dataset, format="VRT", noData=self.nodata)
+        return self._dataset
+
+    @property
+    def width(self):
+        return self.dataset.RasterXSize
+
+    @property
+    def height(self):
+        return self.dataset.RasterYSize
+
+    @property
+    def bands_count(self):
+        return self.dataset.RasterCount
+
+    def read_window(self, x, y, width, height, out_width=None, out_height=None, bands=None):
+        """Reads a pixel window as a bands x height x width array.
+
+        With out_width/out_height the window is resampled while reading, using the overviews of
+        the file when it has them.
+        """
+        if bands is None:
+            bands = list(range(1, self.bands_count + 1))
+        return self.dataset.ReadAsArray(x, y, width, height, buf_xsize=out_width, buf_ysize=out_height,
+                                        band_list=bands, resample_alg=gdal.GRIORA_Average)
+
+    def memory_map(self, band=1):
+        """Returns a read-only array of the band mapped from the file, or None if the format can't be mapped.
+
+        Only uncompressed layouts can be mapped; read_window works for every format.
+        """
+        try:
+            return self.dataset.GetRasterBand(band).GetVirtualMemAutoArray(gdal.GF_Read)
+        except (RuntimeError, AttributeError):
+            return None
+
+    def close(self):
+        self._dataset = None
+
+
+class BandInfo:
+    """A band of a scene: the file and the band number in it, the GDAL name of its data type, the scale and
+    offset turning stored values into physical ones, the fill value and the range of valid stored values.
+    """
+
+    def __init__(self, name, path, band=1, data_type=None, scale=1.0, offset=0.0, nodata=None, valid_range=None):
+        self.name = name
+        self.path = path
+        self.band = band
+        self.data_type = data_type
+        self.scale = scale
+        self.offset = offset
+        self.nodata = nodata
+        self.valid_range = valid_range
+
+
+class SceneMetadata:
+    """Georeferencing and bands of a raster scene.
+
+    bounds are [[upper, left], [lower, right]] in degrees as for RasterLayer, crs is anything
+    osr.SpatialReference.SetFromUserInput takes and geo_transform is the GDAL one of the full
+    resolution grid; both are None for images without georeferencing.
+    """
+
+    def __init__(self, width, height, bands, bounds=None, crs=None, geo_transform=None):
+        self.width = width
+        self.height = height
+        self.bands = bands
+        self.bounds = bounds
+        self.crs = crs
+        self.geo_transform = geo_transform
+
+    def band(self, name):
+        for band in self.bands:
+            if band.name == name:
+                return band
+        raise KeyError(name)
+
+    def composite_bands(self):
+        """Returns the bands shown as red, green and blue by default."""
+        names = [band.name for band in self.bands]
+        if all(name in names for name in ESPA_COMPOSITE_BANDS):
+            return [self.band(name) for name in ESPA_COMPOSITE_BANDS]
+        if len(self.bands) >= 3:
+            return self.bands[:3]
+        return [self.bands[0]] * 3
+
+
+def is_espa_metadata(path):
+    return os.path.splitext(path)[1].lower() == ".xml"
+
+
+def read_metadata(path):
+    """Reads the metadata of an ESPA scene (its .xml file) or of an image GDAL can open."""
+    if is_espa_metadata(path):
+        return read_espa_metadata(path)
+    return read_image_metadata(path)
+
+
+def _espa_number(text):
+    # some ESPA writers use the decimal comma of their locale
+    return float(text.strip().replace(",", "."))
+
+
+def read_espa_metadata(path):
+    root = ElementTree.parse(path).getroot()
+    # {namespace} prefix of the root tag, the schema version changes it
+    namespace = root.tag[:root.tag.index("}") + 1] if root.tag.startswith("{") else ""
+
+    def find(element, tag_path):
+        return element.find("/".join(namespace + tag for tag in tag_path.split("/")))
+
+    global_metadata = find(root, "global_metadata")
+    coordinates = find(global_metadata, "bounding_coordinates")
+    bounds = [[_espa_number(find(coordinates, "north").text), _espa_number(find(coordinates, "west").text)],
+              [_espa_number(find(coordinates, "south").text), _espa_number(find(coordinates, "east").text)]]
+
+    directory = os.path.dirname(os.path.abspath(path))
+    bands = []
+    width = height = 0
+    pixel_size = None
+    for element in find(root, "bands").iter(namespace + "band"):
+        valid_range = find(element, "valid_range")
+        band = BandInfo(element.get("name"), os.path.join(directory, find(element, "file_name").text.strip()),
+                        data_type=ESPA_DATA_TYPES.get(element.get("data_type")),
+                        scale=_espa_number(element.get("scale_factor", "1")),
+                        offset=_espa_number(element.get("add_offset", "0")),
+                        nodata=_espa_number(element.get("fill_value")) if element.get("fill_value") else None,
+                        valid_range=(_espa_number(valid_range.get("min")), _espa_number(valid_range.get("max")))
+                        if valid_range is not None else None)
+        bands.append(band)
+        # QA bands may be coarser, the scene grid is the one of the largest band
+        samples, lines = int(element.get("nsamps")), int(element.get("nlines"))
+        if samples * lines > width * height:
+            width, height = samples, lines
+            size = find(element, "pixel_size")
+            pixel_size = (_espa_number(size.get("x")), _espa_number(size.get("y"))) if size is not None else None
+
+    crs, geo_transform = None, None
+    projection = find(global_metadata, "projection_information")
+    if projection is not None:
+        zone = find(projection, "utm_proj_params/zone_code")
+        if projection.get("projection") == "UTM" and zone is not None and projection.get("datum") == "WGS84":
+            zone = int(zone.text)
+            # negative zone codes are southern zones
+            crs = "EPSG:%d" % ((32600 if zone > 0 else 32700) + abs(zone))
+        corners = {point.get("location"): (_espa_number(point.get("x")), _espa_number(point.get("y")))
+                   for point in projection.iter(namespace + "corner_point")}
+        if "UL" in corners and "LR" in corners:
+            left, upper = corners["UL"]
+            right, lower = corners["LR"]
+            if pixel_size is None:
+                pixel_size = ((right - left) / (width - 1), (upper - lower) / (height - 1))
+            if find(projection, "grid_origin") is not None and find(projection, "grid_origin").text == "CENTER":
+                # corner points are the centers of the corner pixels
+                left, upper = left - pixel_size[0] / 2, upper + pixel_size[1] / 2
+            geo_transform = (left, pixel_size[0], 0.0, upper, 0.0, -pixel_size[1])
+    return SceneMetadata(width, height, bands, bounds, crs, geo_transform)
+
+
+def read_image_metadata(path):
+    """Reads the bands, nodata, scale and georeferencing of an image (GeoTIFF and the like)."""
+    raster = RasterFile(path)
+    dataset = raster.dataset
+    bands = []
+    for number in range(1, raster.bands_count + 1):
+        band = dataset.GetRasterBand(number)
+        bands.append(BandInfo(band.GetDescription() or "band%d" % number, path, number,
+                              gdal.GetDataTypeName(band.DataType), scale=band.GetScale() or 1.0, offset=band.GetOffset() or 0.0,
+                              nodata=band.GetNoDataValue()))
+    crs = dataset.GetProjection() or None
+    geo_transform = dataset.GetGeoTransform(can_return_null=True)
+    bounds = None
+    if crs is not None and geo_transform is not None:
+        left, upper, right, lower = _grid_extent(geo_transform, raster.width, raster.height)
+        corners = _transform_points(crs, "EPSG:4326", [(left, upper), (right, upper), (right, lower), (left, lower)])
+        lons, lats = zip(*corners)
+        bounds = [[max(lats), min(lons)], [min(lats), max(lons)]]
+    else:
+        crs, geo_transform = None, None
+    raster.close()
+    return SceneMetadata(raster.width, raster.height, bands, bounds, crs, geo_transform)
+
+
+def _grid_extent(geo_transform, width, height):
+    """Returns (left, upper, right, lower) of a north up grid."""
+    left, upper = geo_transform[0], geo_transform[3]
+    return left, upper, left + geo_transform[1] * width, upper + geo_transform[5] * height
+
+
+def _transform_points(source_crs, target_crs, points):
+    source = osr.SpatialReference()
+    source.SetFromUserInput(source_crs)
+    target = osr.SpatialReference()
+    target.SetFromUserInput(target_crs)
+    for reference in (source, target):
+        reference.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transformation = osr.CoordinateTransformation(source, target)
+    return [transformation.TransformPoint(x, y)[:2] for x, y in points]
+
+
+def display_size(width, height, max_size):
+    """Returns the size of the grid scaled down to fit max_size, keeping the aspect ratio."""
+    factor = min(1.0, max_size / max(width, height))
+    return max(1, round(width * factor)), max(1, round(height * factor))
+
+
+def strips_count(out_height):
+    return -(-out_height // STRIP_ROWS)
+
+
+def read_band(band_info, out_width, out_height, progress=None, cancelled=None):
+    """Reads a whole band resampled to out_width x out_height as float32 physical values, NaN where there is no data.
+
+    The band is read in strips of STRIP_ROWS output rows. At full resolution the strips are slices
+    of the band memory mapped from the file when its layout allows it; otherwise each strip is
+    a window of the file resampled while reading (RasterFile.read_window), so GDAL reads the
+    closest overview, or the blocks of the full resolution when the file has none, and the
+    full band never is in memory. progress is called with the number of strips read.
+    """
+    # averaging skips the fill values only if GDAL knows them
+    raster = RasterFile(band_info.path, band_info.nodata)
+    width, height = raster.width, raster.height
+    mapped = raster.memory_map(band_info.band) if (out_width, out_height) == (width, height) else None
+    result = np.empty((out_height, out_width), dtype='float32')
+    for first_row in range(0, out_height, STRIP_ROWS):
+        if cancelled is not None and cancelled():
+            raise OperationCancelledException("Operation is cancelled")
+        last_row = min(first_row + STRIP_ROWS, out_height)
+        if mapped is not None:
+            result[first_row:last_row] = mapped[first_row:last_row]
+        else:
+            y = first_row * height // out_height
+            window_height = max(last_row * height // out_height - y, 1)
+            strip = raster.read_window(0, y, width, window_height, out_width, last_row - first_row,
+                                       [band_info.band])
+            result[first_row:last_row] = strip.reshape(last_row - first_row, out_width)
+        if progress is not None:
+            progress(first_row // STRIP_ROWS + 1)
+    invalid = np.zeros(result.shape, dtype=bool)
+    if band_info.nodata is not None:
+        invalid |= result == band_info.nodata
+    if band_info.valid_range is not None:
+        invalid |= (result < band_info.valid_range[0]) | (result > band_info.valid_range[1])
+    result = result * band_info.scale + band_info.offset
+    result[invalid] = np.nan
+    raster.close()
+    return result
+
+
+def stretch(values, percentiles=STRETCH_PERCENTILES):
+    """Maps the percentiles of the valid values to 0 and 255, returns uint8 values."""
+    valid = values[~np.isnan(values)]
+    if len(valid) == 0:
+        return np.zeros(values.shape, dtype='uint8')
+    low, high = np.percentile(valid, percentiles)
+    if high <= low:
+        high = low + 1
+    scaled = (np.nan_to_num(values, nan=low) - low) * (255.0 / (high - low))
+    return np.clip(scaled, 0, 255).astype('uint8')
+
+
+def is_display_range(band_info):
+    """Whether the stored values of the band are colors already, which are shown without stretching."""
+    return band_info.data_type == "Byte" and band_info.scale == 1.0 and band_info.offset == 0.0
+
+
+def composite(metadata, bands=None, max_size=COMPOSITE_SIZE, progress=None, cancelled=None):
+    """Builds an RGBA image of three bands of a scene at most max_size pixels wide and high.
+
+    Returns the image and its bounds. A georeferenced composite is warped to EPSG:3857, so it is
+    placed on the map exactly, and its bounds are the ones of the warped image; otherwise it is
+    returned as read with the bounds of the metadata. Pixels without data in any band are transparent.
+    Bands are contrast stretched unless all of them are 8-bit colors. progress and cancelled work
+    as in Computing.buffer, counting the strips read.
+    """
+    if bands is None:
+        bands = metadata.composite_bands()
+    out_width, out_height = display_size(metadata.width, metadata.height, max_size)
+    total_count = strips_count(out_height) * len(bands)
+    channels = []
+    for i, band in enumerate(bands):
+        band_progress = None
+        if progress is not None:
+            band_progress = lambda done_count, i=i: progress(i * strips_count(out_height) + done_count, total_count)
+        channels.append(read_band(band, out_width, out_height, band_progress, cancelled))
+    valid = ~np.any([np.isnan(channel) for channel in channels], axis=0)
+    if all(is_display_range(band) for band in bands):
+        colors = [np.clip(np.rint(np.nan_to_num(channel)), 0, 255).astype('uint8') for channel in channels]
+    else:
+        colors = [stretch(channel) for channel in channels]
+    image = np.dstack(colors + [valid.astype('uint8') * 255])
+    if metadata.crs is None or metadata.geo_transform is None:
+        return image, metadata.bounds
+
+    gdal.UseExceptions()
+    source = gdal.GetDriverByName("MEM").Create("", out_width, out_height, 4, gdal.GDT_Byte)
+    left, upper, right, lower = _grid_extent(metadata.geo_transform, metadata.width, metadata.height)
+    source.SetGeoTransform((left, (right - left) / out_width, 0.0, upper, 0.0, (lower - upper) / out_height))
+    reference = osr.SpatialReference()
+    reference.SetFromUserInput(metadata.crs)
+    source.SetProjection(reference.ExportToWkt())
+    for number in range(4):
+        source.GetRasterBand(number + 1).WriteArray(image[:, :, number])
+    source.GetRasterBand(4).SetColorInterpretation(gdal.GCI_AlphaBand)
+    warped = gdal.Warp("", source, format="MEM", dstSRS="EPSG:3857", srcAlpha=True, dstAlpha=True,
+                       resampleAlg="bilinear")
+    image = np.dstack([warped.GetRasterBand(number + 1).ReadAsArray() for number in range(4)])
+    left, upper, right, lower = _grid_extent(warped.GetGeoTransform(), warped.RasterXSize, warped.RasterYSize)
+    left, upper = meters_to_lon_lat(left, upper)
+    right, lower = meters_to_lon_lat(right, lower)
+    return image, [[upper, left], [lower, right]]
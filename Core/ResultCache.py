@@ -0,0 +1,160 @@
+import hashlib
+import json
+import os
+import struct
+import threading
+import numpy as np
+import shapely
+from Core.Storage import GeometryStore
+from Core.TileCache import LRUCache
+
+# Results are keyed by the operation, its parameters and the content hashes of the input stores, so
+# a result is found again for equal inputs whatever layer they are in. Entries are encoded as
+# a JSON header (geometry sizes, properties, source positions) followed by the WKB of the geometries.
+
+DEFAULT_RESULTS_PATH = os.path.join(os.path.expanduser("~"), ".gismin", "results")
+MEMORY_BYTES = 256 * 1024 * 1024
+DISK_BYTES = 2 * 1024 * 1024 * 1024
+ENTRY_EXTENSION = ".result"
+
+
+def encode_result(store, positions):
+    wkb = shapely.to_wkb(store.geometries)
+    header = json.dumps({"sizes": [len(geometry) for geometry in wkb], "properties": store.properties,
+                         "positions": positions.tolist() if positions is not None else None}).encode("utf-8")
+    return struct.pack("<I", len(header)) + header + b"".join(wkb)
+
+
+def decode_result(data):
+    header_size = struct.unpack_from("<I", data)[0]
+    header = json.loads(data[4:4 + header_size].decode("utf-8"))
+    wkb = []
+    offset = 4 + header_size
+    for size in header["sizes"]:
+        wkb.append(data[offset:offset + size])
+        offset += size
+    positions = np.array(header["positions"], dtype='intp') if header["positions"] is not None else None
+    return GeometryStore(shapely.from_wkb(wkb) if len(wkb) > 0 else [], header["properties"]), positions
+
+
+class ResultCache:
+    """Results of computing operations in memory, least recently used first out, and optionally on disk.
+
+    A result is a store and the positions of the first input features its features come from
+    (None for dissolved results). The directory tier is bounded by max_disk_bytes, the least
+    recently used entries are deleted first.
+    """
+
+    def __init__(self, max_memory_bytes=MEMORY_BYTES, directory=None, max_disk_bytes=DISK_BYTES):
+        self.memory = LRUCache(max_memory_bytes)
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def key(operation, parameters, stores):
+        digest = hashlib.sha256(json.dumps([operation, parameters], sort_keys=True).encode("utf-8"))
+        for store in stores:
+            digest.update(store.content_hash().encode("utf-8"))
+        return digest.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key + ENTRY_EXTENSION)
+
+    def get(self, key):
+        """Returns (store, positions) or None. Every call returns a new store the caller may change."""
+        data = self.memory.get(key)
+        if data is None and self.directory is not None:
+            data = self.read_entry(key)
+            if data is not None:
+                self.memory.put(key, data)
+                with self.lock:
+                    self.disk_hits += 1
+        with self.lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return decode_result(data)
+
+    def put(self, key, store, positions):
+        data = encode_result(store, positions)
+        self.memory.put(key, data)
+        if self.directory is not None:
+            self.write_entry(key, data)
+
+    def read_entry(self, key):
+        path = self.entry_path(key)
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+            # the modification time orders entries for eviction
+            os.utime(path)
+            return data
+        except OSError:
+            return None
+
+    def write_entry(self, key, data):
+        if len(data) > self.max_disk_bytes:
+            return
+        path = self.entry_path(key)
+        temporary_path = "%s.%d.tmp" % (path, threading.get_ident())
+        try:
+            with open(temporary_path, 'wb') as file:
+                file.write(data)
+            os.replace(temporary_path, path)
+        except OSError:
+            return
+        with self.lock:
+            self.evict()
+
+    def disk_entries(self):
+        """Returns (modification time, size, path) of the entries in the directory."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(ENTRY_EXTENSION):
+                path = os.path.join(self.directory, name)
+                try:
+                    file_stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((file_stat.st_mtime_ns, file_stat.st_size, path))
+        return entries
+
+    def evict(self):
+        entries = sorted(self.disk_entries())
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in entries:
+            if size <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+
+    def clear(self):
+        self.memory = LRUCache(self.memory.max_bytes)
+        if self.directory is not None:
+            for _, _, path in self.disk_entries():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        with self.lock:
+            self.hits = 0
+            self.disk_hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Returns the hits (of them read from disk), misses and the memory and disk sizes in bytes."""
+        disk_bytes = sum(entry[1] for entry in self.disk_entries()) if self.directory is not None else 0
+        with self.lock:
+            return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                    "memory_bytes": self.memory.size, "memory_entries": len(self.memory.items),
+                    "disk_bytes": disk_bytes}
@@ -0,0 +1,108 @@
+import math
+import numpy as np
+import shapely
+from shapely.strtree import STRtree
+
+# Feature lookups on a vector layer. The STRtree is built once per store; later edits are read from
+# the store change log and kept aside as pending features that are tested directly, until there are
+# too many of them and the tree is built again. Coordinates are the layer ones (lon/lat), so
+# distances are in degrees.
+
+# edited features tested one by one before the tree is built again
+MAX_PENDING = 1000
+
+
+class LayerIndex:
+    def __init__(self, store):
+        self.store_id = store.store_id
+        self.version = store.version
+        self.tree = STRtree(store.geometries)
+        # feature id of every tree item
+        self.tree_ids = store.ids
+        # ids of features changed since the tree was built, their tree items are skipped
+        self.stale_ids = np.array([], dtype='int64')
+        # current state of the changed features that still exist
+        self.pending_ids = np.array([], dtype='int64')
+        self.pending_geometries = np.array([], dtype=object)
+        bounds = shapely.total_bounds(store.geometries)
+        self.extent = None if math.isnan(bounds[0]) else bounds
+
+    def is_current(self, store):
+        return self.store_id == store.store_id and self.version == store.version
+
+    def update(self, store):
+        """Takes the changes of the store since the index was built. Returns False if it has to be built again."""
+        if self.store_id != store.store_id:
+            return False
+        changes = store.changes_since(self.version)
+        if changes is None:
+            return False
+        stale_ids = np.union1d(self.stale_ids, np.fromiter(changes, dtype='int64', count=len(changes)))
+        if len(stale_ids) > MAX_PENDING:
+            return False
+        self.stale_ids = stale_ids
+        pending = store.select(stale_ids.tolist())
+        self.pending_ids = pending.ids
+        self.pending_geometries = pending.geometries
+        if len(pending) > 0:
+            bounds = shapely.total_bounds(pending.geometries)
+            self.extent = bounds if self.extent is None else \
+                np.concatenate((np.minimum(self.extent[:2], bounds[:2]), np.maximum(self.extent[2:], bounds[2:])))
+        self.version = store.version
+        return True
+
+    def query(self, geometry, predicate="intersects", distance=None):
+        """Returns the ids and the geometries of the features for which predicate(feature, geometry) holds.
+
+        predicate is a shapely predicate name, "dwithin" takes the distance.
+        """
+        positions = self.tree.query(geometry, predicate, distance)
+        ids = self.tree_ids[positions]
+        geometries = self.tree.geometries[positions]
+        if len(self.stale_ids) > 0:
+            current = ~np.isin(ids, self.stale_ids)
+            ids, geometries = ids[current], geometries[current]
+        if len(self.pending_ids) > 0:
+            if predicate == "dwithin":
+                matches = shapely.dwithin(self.pending_geometries, geometry, distance)
+            else:
+                matches = getattr(shapely, predicate)(self.pending_geometries, geometry)
+            ids = np.concatenate((ids, self.pending_ids[matches]))
+            geometries = np.concatenate((geometries, self.pending_geometries[matches]))
+        return ids, geometries
+
+    def bbox(self, min_x, min_y, max_x, max_y):
+        """Returns the ids of the features intersecting the box."""
+        return self.query(shapely.box(min_x, min_y, max_x, max_y))[0]
+
+    def at_point(self, x, y, tolerance=0.0):
+        """Returns the ids of the features containing the point or, with a tolerance, closer to it than that."""
+        if tolerance > 0:
+            return self.query(shapely.Point(x, y), "dwithin", tolerance)[0]
+        return self.query(shapely.Point(x, y))[0]
+
+    def nearest(self, x, y, k=1, max_distance=None):
+        """Returns the ids and the distances of the k features nearest to the point, the nearest first.
+
+        The search area around the point grows until it holds k features, so the cost depends on k
+        and on the density of features near the point, not on the size of the layer.
+        """
+        if self.extent is None or k <= 0:
+            return np.array([], dtype='int64'), np.array([])
+        point = shapely.Point(x, y)
+        # distance to the farthest corner of the extent, every feature is within it
+        limit = math.hypot(max(abs(x - self.extent[0]), abs(x - self.extent[2])),
+                           max(abs(y - self.extent[1]), abs(y - self.extent[3])))
+        if max_distance is not None:
+            limit = min(limit, max_distance)
+        # start with the radius holding k features if they were spread evenly
+        area = max((self.extent[2] - self.extent[0]) * (self.extent[3] - self.extent[1]), 1e-18)
+        radius = min(math.sqrt(area * k / max(len(self.tree_ids), 1) / math.pi), limit)
+        while True:
+            ids, geometries = self.query(point, "dwithin", radius)
+            if len(ids) >= k or radius >= limit:
+                break
+            radius = min(radius * 2, limit)
+        distances = shapely.distance(geometries, point)
+        order = np.argsort(distances, kind="stable")[:k]
+        return ids[order], distances[order]
@@ -0,0 +1,251 @@
+import hashlib
+import itertools
+import json
+import struct
+import numpy as np
+import shapely
+from shapely.geometry import shape, mapping
+
+
+class GeometryStore:
+    """Parsed features of a vector layer with a lazily built GeoJSON string.
+
+    Every feature has an id that is unique within the store and does not change when other
+    features are added, updated or removed. Recent changes are logged by feature id, so derived
+    layers can find out what changed since the version they were computed from.
+    """
+
+    # changes kept in the log, older ones make changes_since report that the history is lost
+    MAX_LOGGED_CHANGES = 100000
+    _store_ids = itertools.count()
+
+    def __init__(self, geometries=None, properties=None, ids=None):
+        if geometries is None:
+            geometries = []
+        self.geometries = GeometryStore.to_array(geometries)
+        if properties is None:
+            properties = [{} for _ in range(len(self.geometries))]
+        self.properties = list(properties)
+        if ids is None:
+            ids = np.arange(len(self.geometries), dtype='int64')
+        self.ids = np.asarray(ids, dtype='int64')
+        self.next_id = int(self.ids.max()) + 1 if len(self.ids) > 0 else 0
+        # identifies the store (and its read-only copies) for the change log
+        self.store_id = next(GeometryStore._store_ids)
+        self._serialized = None
+        self._vertex_count = None
+        self._indexes = None
+        self._content_hash = None
+        # incremented on every change of the features
+        self.version = 0
+        # (version, feature id, geometry before the change or None if the feature was added)
+        self.changes = []
+        # changes before this version are not in the log
+        self.log_start = 0
+        # simplified copies of the store by tolerance
+        self._simplified = {}
+
+    @staticmethod
+    def to_array(geometries):
+        array = np.empty(len(geometries), dtype=object)
+        for i, geometry in enumerate(geometries):
+            array[i] = geometry
+        return array
+
+    @classmethod
+    def from_geo_data(cls, geo_data):
+        if isinstance(geo_data, GeometryStore):
+            return geo_data
+        serialized = None
+        if isinstance(geo_data, str):
+            serialized = geo_data
+            geo_data = json.loads(geo_data)
+        store = cls.from_features(geo_data["features"])
+        store._serialized = serialized
+        return store
+
+    @classmethod
+    def from_features(cls, features):
+        """Builds a store from an iterable of GeoJSON feature dicts."""
+        geometries = []
+        properties = []
+        for feature in features:
+            geometries.append(shape(feature["geometry"]))
+            feature_properties = feature.get("properties")
+            properties.append(dict(feature_properties) if feature_properties is not None else {})
+        return cls(geometries, properties)
+
+    def __len__(self):
+        return len(self.geometries)
+
+    def to_geo_data(self):
+        return {"type": "FeatureCollection",
+                "features": [{"type": "Feature", "geometry": dict(mapping(geometry)), "properties": feature_properties}
+                             for geometry, feature_properties in zip(self.geometries, self.properties)]}
+
+    def serialize(self):
+        if self._serialized is None:
+            self._serialized = json.dumps(self.to_geo_data())
+        return self._serialized
+
+    def vertex_count(self):
+        if self._vertex_count is None:
+            self._vertex_count = int(shapely.get_num_coordinates(self.geometries).sum())
+        return self._vertex_count
+
+    def content_hash(self):
+        """Returns the sha256 of the geometries and properties, which does not depend on the feature ids."""
+        if self._content_hash is None:
+            digest = hashlib.sha256()
+            for wkb in shapely.to_wkb(self.geometries):
+                digest.update(struct.pack("<Q", len(wkb)))
+                digest.update(wkb)
+            digest.update(json.dumps(self.properties, sort_keys=True).encode("utf-8"))
+            self._content_hash = digest.hexdigest()
+        return self._content_hash
+
+    def keep_content_hash(self, snapshot):
+        """Takes the content hash computed on a snapshot of this store (see copy) if the store did not change since."""
+        if self._content_hash is None and snapshot.store_id == self.store_id and snapshot.version == self.version:
+            self._content_hash = snapshot._content_hash
+
+    def simplified(self, tolerance):
+        """Returns a store with the geometries simplified without changing their topology."""
+        if tolerance not in self._simplified:
+            self._simplified[tolerance] = GeometryStore(shapely.simplify(self.geometries, tolerance,
+                                                                         preserve_topology=True), self.properties,
+                                                        self.ids)
+        return self._simplified[tolerance]
+
+    def features(self):
+        """Yields the GeoJSON string of every feature."""
+        for feature_id, geometry, feature_properties in zip(self.ids.tolist(), self.geometries, self.properties):
+            yield json.dumps({"type": "Feature", "id": feature_id, "geometry": dict(mapping(geometry)),
+                              "properties": feature_properties})
+
+    def feature_batches(self, max_batch_bytes):
+        """Yields (features count, FeatureCollection string) pairs of about max_batch_bytes each."""
+        batch = []
+        batch_bytes = 0
+        for feature in self.features():
+            batch.append(feature)
+            batch_bytes += len(feature)
+            if batch_bytes >= max_batch_bytes:
+                yield len(batch), GeometryStore.join_features(batch)
+                batch = []
+                batch_bytes = 0
+        if len(batch) > 0:
+            yield len(batch), GeometryStore.join_features(batch)
+
+    @staticmethod
+    def join_features(features):
+        return '{"type": "FeatureCollection", "features": [' + ", ".join(features) + ']}'
+
+    def copy(self):
+        """Returns a read-only snapshot sharing the geometries, not affected by later changes of this store.
+
+        The snapshot keeps the store id and version, so results computed from it can be matched
+        with the change log of this store.
+        """
+        store = GeometryStore()
+        store.geometries = self.geometries
+        store.properties = list(self.properties)
+        store.ids = self.ids
+        store.next_id = self.next_id
+        store.store_id = self.store_id
+        store.version = self.version
+        store._content_hash = self._content_hash
+        return store
+
+    def select(self, ids):
+        """Returns a store of the features with the given ids, keeping their ids."""
+        indexes = self.indexes(ids)
+        return GeometryStore(self.geometries[indexes], [self.properties[i] for i in indexes.tolist()],
+                             self.ids[indexes])
+
+    def indexes(self, ids):
+        """Returns the positions of the features with the given ids, skipping ids that are not in the store."""
+        if self._indexes is None:
+            self._indexes = {feature_id: i for i, feature_id in enumerate(self.ids.tolist())}
+        return np.array([self._indexes[feature_id] for feature_id in ids if feature_id in self._indexes],
+                        dtype='intp')
+
+    def set_features(self, geometries, properties=None):
+        self.geometries = GeometryStore.to_array(geometries)
+        if properties is None:
+            properties = [{} for _ in range(len(self.geometries))]
+        self.properties = list(properties)
+        self.ids = np.arange(self.next_id, self.next_id + len(self.geometries), dtype='int64')
+        self.next_id += len(self.geometries)
+        self.invalidate()
+        # every feature changed, nothing to log
+        self.changes = []
+        self.log_start = self.version
+
+    def extend(self, other):
+        """Appends the features of other with new ids and returns the ids."""
+        ids = np.arange(self.next_id, self.next_id + len(other), dtype='int64')
+        self.next_id += len(other)
+        self.geometries = np.concatenate((self.geometries, other.geometries))
+        self.properties.extend(other.properties)
+        self.ids = np.concatenate((self.ids, ids))
+        self.invalidate()
+        self.log_changes((feature_id, None) for feature_id in ids.tolist())
+        return ids
+
+    def update(self, ids, geometries, properties=None):
+        """Replaces the geometries (and properties, if given) of the features with the given ids."""
+        indexes = self.indexes(ids)
+        if len(indexes) != len(ids):
+            raise KeyError("Feature not found")
+        old_geometries = self.geometries[indexes]
+        # the array is shared with snapshots and is never changed in place
+        self.geometries = self.geometries.copy()
+        self.geometries[indexes] = GeometryStore.to_array(geometries)
+        if properties is not None:
+            for index, feature_properties in zip(indexes.tolist(), properties):
+                self.properties[index] = feature_properties
+        self.invalidate()
+        self.log_changes(zip(self.ids[indexes].tolist(), old_geometries))
+
+    def remove(self, ids):
+        """Removes the features with the given ids."""
+        indexes = self.indexes(ids)
+        removed = list(zip(self.ids[indexes].tolist(), self.geometries[indexes]))
+        keep = np.ones(len(self.geometries), dtype=bool)
+        keep[indexes] = False
+        self.geometries = self.geometries[keep]
+        self.properties = [feature_properties for feature_properties, kept in zip(self.properties, keep.tolist())
+                           if kept]
+        self.ids = self.ids[keep]
+        self.invalidate()
+        self.log_changes(removed)
+
+    def log_changes(self, changes):
+        """Logs (feature id, geometry before the change) pairs under the current version."""
+        version = self.version
+        self.changes.extend((version, feature_id, geometry) for feature_id, geometry in changes)
+        if len(self.changes) > GeometryStore.MAX_LOGGED_CHANGES:
+            dropped = self.changes[:len(self.changes) - GeometryStore.MAX_LOGGED_CHANGES]
+            self.changes = self.changes[len(dropped):]
+            self.log_start = dropped[-1][0]
+
+    def changes_since(self, version):
+        """Returns {feature id: geometry before the first change or None} of the features changed after
+        version, or None if those changes are no longer logged.
+        """
+        if version < self.log_start:
+            return None
+        changed = {}
+        for change_version, feature_id, geometry in self.changes:
+            if change_version > version and feature_id not in changed:
+                changed[feature_id] = geometry
+        return changed
+
+    def invalidate(self):
+        self.version += 1
+        self._serialized = None
+        self._vertex_count = None
+        self._indexes = None
+        self._content_hash = None
+        self._simplified = {}
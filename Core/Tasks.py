@@ -0,0 +1,84 @@
+import threading
+from PyQt5.QtCore import QObject, QRunnable, pyqtSignal
+from Core.Exceptions import OperationCancelledException
+
+
+class TaskSignals(QObject):
+    # created on the GUI thread, so the connected callbacks run there when emitted from a worker
+    progress = pyqtSignal(int, int)
+    result = pyqtSignal(object)
+    partial = pyqtSignal(object)
+    error = pyqtSignal(object)
+
+
+class Task(QRunnable):
+    """Runs function(progress, cancelled) on a thread pool and applies its result on the GUI thread.
+
+    function gets a progress(done, total) callback and a cancelled() check and returns the result.
+    apply(result) is called on the GUI thread, then finished(error) with None on success,
+    OperationCancelledException when the task was cancelled or the exception that was raised.
+
+    With partial set, function returns an iterable whose items are passed to partial(item) on the
+    GUI thread as soon as they are ready; apply then gets None.
+    """
+
+    def __init__(self, function, apply, progress=None, finished=None, partial=None):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.function = function
+        self.apply = apply
+        self.finished = finished
+        self.partial = partial
+        # raised by partial, reported instead of the cancellation it causes
+        self.partial_error = None
+        self.cancel_event = threading.Event()
+        self.signals = TaskSignals()
+        if progress is not None:
+            self.signals.progress.connect(progress)
+        self.signals.result.connect(self.on_result)
+        self.signals.partial.connect(self.on_partial)
+        self.signals.error.connect(self.on_finished)
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def is_cancelled(self):
+        return self.cancel_event.is_set()
+
+    def run(self):
+        try:
+            result = self.function(self.signals.progress.emit, self.is_cancelled)
+            if self.partial is not None:
+                for item in result:
+                    self.signals.partial.emit(item)
+                result = None
+        except Exception as ex:
+            self.signals.error.emit(ex)
+        else:
+            self.signals.result.emit(result)
+
+    def on_partial(self, item):
+        if self.is_cancelled():
+            return
+        try:
+            self.partial(item)
+        except Exception as ex:
+            self.partial_error = ex
+            self.cancel()
+
+    def on_result(self, result):
+        if self.is_cancelled():
+            self.on_finished(OperationCancelledException("Operation is cancelled"))
+            return
+        try:
+            self.apply(result)
+        except Exception as ex:
+            self.on_finished(ex)
+        else:
+            self.on_finished(None)
+
+    def on_finished(self, error):
+        if self.partial_error is not None:
+            error = self.partial_error
+        if self.finished is not None:
+            self.finished(error)
@@ -9,9 +9,11 @@ DEFAULT_HTML = """
         </script>
     
     <script src="https://cdn.jsdelivr.net/npm/leaflet@1.5.1/dist/leaflet.js"></script>
+    <script src="https://unpkg.com/leaflet.vectorgrid@1.3.0/dist/Leaflet.VectorGrid.bundled.min.js"></script>
     <script src="https://cdnjs.cloudflare.com/ajax/libs/jquery/3.4.1/jquery.min.js"></script>
     <script src="https://maxcdn.bootstrapcdn.com/bootstrap/3.2.0/js/bootstrap.min.js"></script>
     <script src="https://cdnjs.cloudflare.com/ajax/libs/Leaflet.awesome-markers/2.0.2/leaflet.awesome-markers.js"></script>
+    <script src="qrc:///qtwebchannel/qwebchannel.js"></script>
     <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/leaflet@1.5.1/dist/leaflet.css"/>
     <link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/3.2.0/css/bootstrap.min.css"/>
     <link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/3.2.0/css/bootstrap-theme.min.css"/>
@@ -41,6 +43,53 @@ DEFAULT_HTML = """
 </body>
 <script>
     var layers = {};
+    // Python object the map reports clicks to
+    var bridge = null;
+    if (typeof QWebChannel !== "undefined") {
+        new QWebChannel(qt.webChannelTransport, function(channel) {
+            bridge = channel.objects.bridge;
+            // levels shown before the bridge was ready
+            for (var name in layers) {
+                if (layers[name].levels && layers[name].currentLevel) {
+                    requestLevel(layers[name], layers[name].currentLevel);
+                }
+            }
+        });
+    }
+
+    // every layer has a pane of its own, the pane z-index keeps the layer order of the registry
+    function layerPane(name, zIndex) {
+        var paneName = "layer-" + name;
+        var pane = mainMap.getPane(paneName) || mainMap.createPane(paneName);
+        pane.style.zIndex = zIndex;
+        return paneName;
+    }
+
+    // features of a detail level are sent by Python when the level is shown for the first time
+    function requestLevel(group, level) {
+        if (!level.requested && bridge) {
+            level.requested = true;
+            bridge.level_requested(group.name, group.levels.indexOf(level));
+        }
+    }
+
+    function updateLevelOfDetail(group) {
+        var zoom = mainMap.getZoom();
+        for (var i = 0; i < group.levels.length; i++) {
+            var level = group.levels[i];
+            if (zoom >= level.minZoom && zoom <= level.maxZoom) {
+                if (group.currentLevel !== level) {
+                    if (group.currentLevel) {
+                        group.removeLayer(group.currentLevel.layer);
+                    }
+                    group.addLayer(level.layer);
+                    group.currentLevel = level;
+                }
+                requestLevel(group, level);
+                return;
+            }
+        }
+    }
 </script>
 """
 
@@ -54,6 +103,18 @@ MAP_CREATION_SCRIPT = """
             preferCanvas: false,
         }
     );
+    mainMap.on("click", function(e) {
+        if (bridge) {
+            bridge.map_clicked(e.latlng.lat, e.latlng.lng, mainMap.getZoom());
+        }
+    });
+    mainMap.on("zoomend", function() {
+        for (var name in layers) {
+            if (layers[name].levels) {
+                updateLevelOfDetail(layers[name]);
+            }
+        }
+    });
 """
 
 OSM_TILE_CREATION_SCRIPT = """
@@ -72,21 +133,107 @@ OSM_TILE_CREATION_SCRIPT = """
     );
 """
 
+LOCAL_TILE_CREATION_SCRIPT = """
+    var mapTileLayer = L.tileLayer("gismin://%s/{z}/{x}/{y}.png",
+        {
+            "attribution": "Data by &copy; <a href='http://openstreetmap.org'>OpenStreetMap</a>, under <a href='http://www.openstreetmap.org/copyright'>ODbL</a>.",
+            "detectRetina": false,
+            "maxNativeZoom": 18,
+            "maxZoom": 18,
+            "minZoom": 0,
+            "noWrap": false,
+            "opacity": 1,
+            "tms": false
+        }
+    );
+"""
+
+MAP_BOUNDS_SCRIPT = """
+    [[mainMap.getBounds().getSouth(), mainMap.getBounds().getWest()],
+     [mainMap.getBounds().getNorth(), mainMap.getBounds().getEast()]];
+"""
+
 ADD_TILE_TO_MAP_SCRIPT = """
     mapTileLayer.addTo(mainMap);
 """
 
 GEOJSON_LAYER_CREATION_SCRIPT = """
-    layers["%s"] = L.geoJson(null, { onEachFeature: (feature, layer) => { layer.on({ click: function(e) { mainMap.fitBounds(e.target.getBounds()); }}); }});
+    layers["%s"] = L.geoJson(null, { pane: layerPane("%s", %d), pointToLayer: (feature, latlng) => L.marker(latlng, { pane: layers["%s"].options.pane }), onEachFeature: (feature, layer) => { layer.on({ click: function(e) { mainMap.fitBounds(e.target.getBounds()); }}); }});
     layers["%s"].addTo(mainMap);
 """
 
 GEOJSON_LAYER_ADD_DATA_SCRIPT = """
-    layers["%s"].addData(%s);
+    if (layers["%s"]) {
+        layers["%s"].addData(%s);
+    }
+"""
+
+GEOJSON_LAYER_REMOVE_FEATURES_SCRIPT = """
+    if (layers["%s"]) {
+        var removedIds = new Set(%s);
+        layers["%s"].eachLayer(function(featureLayer) {
+            if (removedIds.has(featureLayer.feature.id)) {
+                layers["%s"].removeLayer(featureLayer);
+            }
+        });
+    }
+"""
+
+LOD_LAYER_CREATION_SCRIPT = """
+    layers["%s"] = L.featureGroup();
+    layers["%s"].pane = layerPane("%s", %d);
+    layers["%s"].name = "%s";
+    layers["%s"].levels = [];
+    layers["%s"].addTo(mainMap);
+"""
+
+LOD_LEVEL_CREATION_SCRIPT = """
+    layers["%s"].levels.push({
+        minZoom: %d,
+        maxZoom: %d,
+        layer: L.geoJson(null, { pane: layers["%s"].pane, pointToLayer: (feature, latlng) => L.marker(latlng, { pane: layers["%s"].pane }), onEachFeature: (feature, layer) => { layer.on({ click: function(e) { mainMap.fitBounds(e.target.getBounds()); }}); }})
+    });
+    updateLevelOfDetail(layers["%s"]);
+"""
+
+LOD_LEVEL_ADD_DATA_SCRIPT = """
+    if (layers["%s"]) {
+        layers["%s"].levels[%d].layer.addData(%s);
+    }
+"""
+
+VECTOR_TILE_LAYER_CREATION_SCRIPT = """
+    layers["%s"] = L.vectorGrid.protobuf("%s",
+        {
+            "rendererFactory": L.canvas.tile,
+            "pane": layerPane("%s", %d),
+            "maxNativeZoom": 18,
+            "maxZoom": 18,
+            "vectorTileLayerStyles": {
+                "%s": {"weight": 3, "color": "#3388ff", "fill": true, "fillColor": "#3388ff", "fillOpacity": 0.2, "radius": 4}
+            }
+        }
+    );
+    layers["%s"].addTo(mainMap);
 """
 
 RASTER_LAYER_CREATION_SCRIPT = """
-    layers["%s"] = L.imageOverlay(createLayerData, %s);
+    layers["%s"] = L.imageOverlay(createLayerData, %s, { pane: layerPane("%s", %d) });
+    layers["%s"].addTo(mainMap);
+"""
+
+RASTER_TILE_LAYER_CREATION_SCRIPT = """
+    layers["%s"] = L.tileLayer("%s",
+        {
+            "pane": layerPane("%s", %d),
+            "minNativeZoom": %d,
+            "maxNativeZoom": %d,
+            "maxZoom": 18,
+            "bounds": %s,
+            "noWrap": true,
+            "tms": false
+        }
+    );
     layers["%s"].addTo(mainMap);
 """
 
@@ -107,10 +254,6 @@ HIDE_LAYER_SCRIPT = """
     }
 """
 
-BRING_TO_BACK_SCRIPT = """
-    layers["%s"].bringToBack();
-"""
-
-BRING_TO_FRONT_SCRIPT = """
-    layers["%s"].bringToFront();
+SET_LAYER_Z_INDEX_SCRIPT = """
+    layerPane("%s", %d);
 """
\ No newline at end of file
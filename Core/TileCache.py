@@ -0,0 +1,307 @@
+import os
+import sqlite3
+import threading
+import time
+import urllib.request
+from collections import OrderedDict
+from Core.Exceptions import TileSeedingException
+from Core.Tiles import lon_lat_to_meters, meters_to_tile
+
+DEFAULT_STORE_PATH = os.path.join(os.path.expanduser("~"), ".gismin", "tiles", "openstreetmap")
+OSM_TILE_URL = "https://tile.openstreetmap.org/{z}/{x}/{y}.png"
+USER_AGENT = "GISmin tile cache"
+# on-disk stores delete the least recently used tiles above this size
+STORE_BYTES = 512 * 1024 * 1024
+# the usage policy of tile.openstreetmap.org forbids bulk downloads, seeding is for small areas only
+MAX_SEED_TILES = 250
+
+
+class DirectoryTileStore:
+    """Tiles stored as root/z/x/y.png, bounded by max_bytes. Reading a tile updates its mtime, which
+    orders the tiles for eviction in the next sessions.
+
+    The sizes of the tiles are kept in an index in least recently used order, so writes never walk
+    the tree. The tiles already on disk are indexed once, on a thread of their own.
+    """
+
+    def __init__(self, root, max_bytes=STORE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # {tile path: size} from the least to the most recently used tile
+        self.index = OrderedDict()
+        self.size = 0
+        self.indexed = False
+        threading.Thread(target=self.index_stored_tiles, daemon=True).start()
+
+    def tile_path(self, zoom, x, y):
+        return os.path.join(self.root, str(zoom), str(x), "%d.png" % y)
+
+    def get(self, zoom, x, y):
+        path = self.tile_path(zoom, x, y)
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+            os.utime(path)
+        except OSError:
+            return None
+        with self.lock:
+            self.size += len(data) - self.index.pop(path, 0)
+            self.index[path] = len(data)
+        return data
+
+    def has(self, zoom, x, y):
+        return os.path.exists(self.tile_path(zoom, x, y))
+
+    def put(self, zoom, x, y, data):
+        path = self.tile_path(zoom, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = "%s.%d.tmp" % (path, threading.get_ident())
+        with open(temporary_path, 'wb') as file:
+            file.write(data)
+        with self.lock:
+            os.replace(temporary_path, path)
+            self.size += len(data) - self.index.pop(path, 0)
+            self.index[path] = len(data)
+            if self.indexed and self.size > self.max_bytes:
+                self.evict()
+
+    def entries(self):
+        """Returns (modification time, size, path) of the stored tiles."""
+        entries = []
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                if name.endswith(".png"):
+                    path = os.path.join(directory, name)
+                    try:
+                        file_stat = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((file_stat.st_mtime_ns, file_stat.st_size, path))
+        return entries
+
+    def index_stored_tiles(self):
+        entries = sorted(self.entries())
+        with self.lock:
+            # tiles used since the store was opened are already indexed and stay the most recent
+            index = OrderedDict((path, entry_size) for _, entry_size, path in entries if path not in self.index)
+            index.update(self.index)
+            self.index = index
+            self.size = sum(index.values())
+            self.indexed = True
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        # down to 90% of the limit, so the next writes do not evict again
+        target = self.max_bytes * 0.9
+        while self.size > target and len(self.index) > 0:
+            path, entry_size = self.index.popitem(last=False)
+            self.size -= entry_size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class MBTilesStore:
+    """Tiles stored in an MBTiles (SQLite) file, bounded by max_bytes. Rows are kept in the TMS order of
+    the format; the last use of every tile is kept in a table of its own, which MBTiles readers ignore.
+    """
+
+    def __init__(self, path, max_bytes=STORE_BYTES):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, "
+                                    "tile_row INTEGER, tile_data BLOB)")
+            self.connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_index "
+                                    "ON tiles (zoom_level, tile_column, tile_row)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS tile_usage (zoom_level INTEGER, tile_column INTEGER, "
+                                    "tile_row INTEGER, used INTEGER, size INTEGER, "
+                                    "PRIMARY KEY (zoom_level, tile_column, tile_row))")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS tile_usage_index ON tile_usage (used)")
+            # tiles written before usage was tracked are the first to go
+            self.connection.execute("INSERT OR IGNORE INTO tile_usage SELECT zoom_level, tile_column, tile_row, 0, "
+                                    "length(tile_data) FROM tiles")
+            self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM tile_usage").fetchone()[0]
+
+    @staticmethod
+    def tms_row(zoom, y):
+        return (2 ** zoom) - 1 - y
+
+    def get(self, zoom, x, y):
+        key = (zoom, x, MBTilesStore.tms_row(zoom, y))
+        with self.lock:
+            row = self.connection.execute("SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? "
+                                          "AND tile_row = ?", key).fetchone()
+            if row is not None:
+                with self.connection:
+                    self.connection.execute("UPDATE tile_usage SET used = ? WHERE zoom_level = ? AND tile_column = ? "
+                                            "AND tile_row = ?", (time.time_ns(),) + key)
+        return bytes(row[0]) if row is not None else None
+
+    def has(self, zoom, x, y):
+        with self.lock:
+            row = self.connection.execute("SELECT 1 FROM tiles WHERE zoom_level = ? AND tile_column = ? "
+                                          "AND tile_row = ?", (zoom, x, MBTilesStore.tms_row(zoom, y))).fetchone()
+        return row is not None
+
+    def put(self, zoom, x, y, data):
+        key = (zoom, x, MBTilesStore.tms_row(zoom, y))
+        with self.lock, self.connection:
+            previous = self.connection.execute("SELECT size FROM tile_usage WHERE zoom_level = ? "
+                                               "AND tile_column = ? AND tile_row = ?", key).fetchone()
+            if previous is not None:
+                self.size -= previous[0]
+            self.connection.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)", key + (sqlite3.Binary(data),))
+            self.connection.execute("INSERT OR REPLACE INTO tile_usage VALUES (?, ?, ?, ?, ?)",
+                                    key + (time.time_ns(), len(data)))
+            self.size += len(data)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        target = self.max_bytes * 0.9
+        evicted = []
+        for zoom, column, row, size in self.connection.execute("SELECT zoom_level, tile_column, tile_row, size "
+                                                               "FROM tile_usage ORDER BY used"):
+            if self.size <= target:
+                break
+            evicted.append((zoom, column, row))
+            self.size -= size
+        self.connection.executemany("DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                                    evicted)
+        self.connection.executemany("DELETE FROM tile_usage WHERE zoom_level = ? AND tile_column = ? "
+                                    "AND tile_row = ?", evicted)
+
+    def close(self):
+        self.connection.close()
+
+
+def open_tile_store(path):
+    if path.endswith(".mbtiles"):
+        return MBTilesStore(path)
+    return DirectoryTileStore(path)
+
+
+class LRUCache:
+    """In-memory cache bounded by the total size of the stored bytes values."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.items.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self.items[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self.items.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class CachedTileProvider:
+    """Serves tiles from memory, then from the on-disk store, then from upstream_url if it is set.
+
+    Downloaded tiles are written to the store, so the provider keeps working offline for every
+    area that was viewed or seeded before.
+    """
+
+    content_type = b"image/png"
+
+    def __init__(self, store, upstream_url=None, max_memory_bytes=64 * 1024 * 1024):
+        self.store = store
+        self.upstream_url = upstream_url
+        self.memory = LRUCache(max_memory_bytes)
+
+    def get(self, zoom, x, y):
+        """Returns the tile if it is available locally, otherwise None."""
+        key = (zoom, x, y)
+        data = self.memory.get(key)
+        if data is None:
+            data = self.store.get(zoom, x, y)
+            if data is not None:
+                self.memory.put(key, data)
+        return data
+
+    def upstream_tile_url(self, zoom, x, y):
+        if self.upstream_url is None:
+            return None
+        return self.upstream_url.format(z=zoom, x=x, y=y)
+
+    def add(self, zoom, x, y, data):
+        self.store.put(zoom, x, y, data)
+        self.memory.put((zoom, x, y), data)
+
+    def fetch(self, zoom, x, y, timeout=10):
+        """Returns the tile, downloading it if needed. Blocks, so it is meant for worker threads."""
+        data = self.get(zoom, x, y)
+        if data is None and self.upstream_url is not None:
+            request = urllib.request.Request(self.upstream_tile_url(zoom, x, y), headers={"User-Agent": USER_AGENT})
+            try:
+                with urllib.request.urlopen(request, timeout=timeout) as response:
+                    data = response.read()
+            except OSError:
+                return None
+            self.add(zoom, x, y, data)
+        return data
+
+    @staticmethod
+    def seed_ranges(bounds, min_zoom, max_zoom):
+        """Returns (zoom, first x, first y, last x, last y) of the tiles of bounds for every zoom."""
+        (south, west), (north, east) = bounds
+        min_x, min_y = lon_lat_to_meters(west, south)
+        max_x, max_y = lon_lat_to_meters(east, north)
+        ranges = []
+        for zoom in range(min_zoom, max_zoom + 1):
+            first_x, first_y = meters_to_tile(min_x, max_y, zoom)
+            last_x, last_y = meters_to_tile(max_x, min_y, zoom)
+            ranges.append((zoom, first_x, first_y, last_x, last_y))
+        return ranges
+
+    @staticmethod
+    def seed_count(bounds, min_zoom, max_zoom):
+        return sum((last_x - first_x + 1) * (last_y - first_y + 1)
+                   for _, first_x, first_y, last_x, last_y in CachedTileProvider.seed_ranges(bounds, min_zoom, max_zoom))
+
+    def seed(self, bounds, min_zoom, max_zoom, progress=None, cancelled=None):
+        """Downloads the missing tiles of bounds ([[south, west], [north, east]]) for the zoom range.
+
+        Raises TileSeedingException for more than MAX_SEED_TILES tiles. Returns the number of tiles
+        that could not be loaded.
+        """
+        tiles_count = CachedTileProvider.seed_count(bounds, min_zoom, max_zoom)
+        if tiles_count > MAX_SEED_TILES:
+            raise TileSeedingException("Too many tiles to download: %d, at most %d are allowed"
+                                       % (tiles_count, MAX_SEED_TILES))
+        tiles = [(zoom, x, y) for zoom, first_x, first_y, last_x, last_y in self.seed_ranges(bounds, min_zoom, max_zoom)
+                 for x in range(first_x, last_x + 1) for y in range(first_y, last_y + 1)]
+        failed_count = 0
+        for i, (zoom, x, y) in enumerate(tiles):
+            if cancelled is not None and cancelled():
+                break
+            if not self.store.has(zoom, x, y) and self.fetch(zoom, x, y) is None:
+                failed_count += 1
+            if progress is not None:
+                progress(i + 1, len(tiles))
+        return failed_count
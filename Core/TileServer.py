@@ -0,0 +1,92 @@
+from PyQt5.QtCore import QBuffer, QIODevice, QUrl
+from PyQt5.QtNetwork import QNetworkAccessManager, QNetworkRequest, QNetworkReply
+from PyQt5.QtWebEngineCore import QWebEngineUrlScheme, QWebEngineUrlSchemeHandler, QWebEngineUrlRequestJob
+from Core.TileCache import USER_AGENT
+
+SCHEME = b"gismin"
+
+
+def register_scheme():
+    """Registers gismin:// URLs. Must be called before the QApplication is created."""
+    scheme = QWebEngineUrlScheme(SCHEME)
+    scheme.setSyntax(QWebEngineUrlScheme.Syntax.Host)
+    scheme.setFlags(QWebEngineUrlScheme.SecureScheme | QWebEngineUrlScheme.LocalAccessAllowed |
+                    QWebEngineUrlScheme.CorsEnabled)
+    QWebEngineUrlScheme.registerScheme(scheme)
+
+
+class TileSchemeHandler(QWebEngineUrlSchemeHandler):
+    """Serves gismin://<provider>/<z>/<x>/<y>.<extension> from the registered tile providers.
+
+    A provider answers get(zoom, x, y) with locally available data or None. Missing tiles are
+    downloaded asynchronously from provider.upstream_tile_url(zoom, x, y) when it returns a url.
+    """
+
+    instance = None
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.providers = {}
+        self.network = QNetworkAccessManager(self)
+
+    @staticmethod
+    def install(profile):
+        if TileSchemeHandler.instance is None:
+            TileSchemeHandler.instance = TileSchemeHandler()
+        if profile.urlSchemeHandler(SCHEME) is None:
+            profile.installUrlSchemeHandler(SCHEME, TileSchemeHandler.instance)
+        return TileSchemeHandler.instance
+
+    def add_provider(self, name, provider):
+        self.providers[name] = provider
+
+    def remove_provider(self, name):
+        self.providers.pop(name, None)
+
+    def requestStarted(self, job):
+        url = job.requestUrl()
+        provider = self.providers.get(url.host())
+        try:
+            zoom, x, y = url.path().strip("/").split("/")
+            zoom, x, y = int(zoom), int(x), int(y.split(".")[0])
+        except ValueError:
+            job.fail(QWebEngineUrlRequestJob.UrlInvalid)
+            return
+        if provider is None:
+            job.fail(QWebEngineUrlRequestJob.UrlNotFound)
+            return
+        data = provider.get(zoom, x, y)
+        if data is not None:
+            TileSchemeHandler.reply(job, data, provider.content_type)
+            return
+        upstream_url = provider.upstream_tile_url(zoom, x, y)
+        if upstream_url is None:
+            job.fail(QWebEngineUrlRequestJob.UrlNotFound)
+            return
+        request = QNetworkRequest(QUrl(upstream_url))
+        request.setRawHeader(b"User-Agent", USER_AGENT.encode("utf-8"))
+        reply = self.network.get(request)
+        reply.finished.connect(lambda: self.on_upstream_finished(reply, job, provider, zoom, x, y))
+
+    def on_upstream_finished(self, reply, job, provider, zoom, x, y):
+        reply.deleteLater()
+        if reply.error() == QNetworkReply.NoError:
+            data = bytes(reply.readAll())
+            provider.add(zoom, x, y, data)
+        else:
+            data = None
+        # the page may have dropped the request while the tile was downloading
+        try:
+            if data is not None:
+                TileSchemeHandler.reply(job, data, provider.content_type)
+            else:
+                job.fail(QWebEngineUrlRequestJob.RequestFailed)
+        except RuntimeError:
+            pass
+
+    @staticmethod
+    def reply(job, data, content_type):
+        buffer = QBuffer(job)
+        buffer.setData(data)
+        buffer.open(QIODevice.ReadOnly)
+        job.reply(content_type, buffer)
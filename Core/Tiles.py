@@ -0,0 +1,190 @@
+import json
+import math
+import os
+import pathlib
+import tempfile
+import uuid
+import numpy as np
+from Core.Utilities import write_png
+
+TILE_SIZE = 256
+MAX_ZOOM = 18
+# half of the EPSG:3857 world width in meters
+ORIGIN_SHIFT = math.pi * 6378137.0
+PYRAMID_FILE = "pyramid.json"
+
+
+def tiles_cache_directory(*parts):
+    return os.path.join(tempfile.gettempdir(), "GISmin", *parts)
+
+
+def tile_meters(zoom):
+    return 2 * ORIGIN_SHIFT / (2 ** zoom)
+
+
+def lon_lat_to_meters(lon, lat):
+    x = lon * ORIGIN_SHIFT / 180.0
+    lat = max(min(lat, 85.0511287798), -85.0511287798)
+    y = math.log(math.tan((90.0 + lat) * math.pi / 360.0)) * 6378137.0
+    return x, y
+
+
+def meters_to_lon_lat(x, y):
+    lon = x * 180.0 / ORIGIN_SHIFT
+    lat = math.degrees(2 * math.atan(math.exp(y / 6378137.0)) - math.pi / 2)
+    return lon, lat
+
+
+def meters_to_tile(x, y, zoom):
+    size = tile_meters(zoom)
+    tiles_count = 2 ** zoom
+    tile_x = min(max(int((x + ORIGIN_SHIFT) // size), 0), tiles_count - 1)
+    tile_y = min(max(int((ORIGIN_SHIFT - y) // size), 0), tiles_count - 1)
+    return tile_x, tile_y
+
+
+def tile_bounds(tile_x, tile_y, zoom):
+    """Returns (min x, min y, max x, max y) of the XYZ tile in EPSG:3857 meters."""
+    size = tile_meters(zoom)
+    min_x = -ORIGIN_SHIFT + tile_x * size
+    max_y = ORIGIN_SHIFT - tile_y * size
+    return min_x, max_y - size, min_x + size, max_y
+
+
+class RasterPyramid:
+    """XYZ tile directory of a raster: path/z/x/y.png for zooms from min_zoom to max_zoom."""
+
+    def __init__(self, path, min_zoom, max_zoom):
+        self.path = path
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+
+    def url_template(self):
+        return pathlib.Path(self.path).as_uri() + "/{z}/{x}/{y}.png"
+
+    @classmethod
+    def open(cls, path):
+        try:
+            with open(os.path.join(path, PYRAMID_FILE), 'r') as file:
+                description = json.load(file)
+        except (OSError, ValueError):
+            return None
+        return cls(path, description["min_zoom"], description["max_zoom"])
+
+    def write_description(self):
+        with open(os.path.join(self.path, PYRAMID_FILE), 'w') as file:
+            json.dump({"min_zoom": self.min_zoom, "max_zoom": self.max_zoom}, file)
+
+
+def build_raster_pyramid(source_path, bounds, key, min_zoom=None, max_zoom=None):
+    """Cuts an image placed at bounds ([[upper, left], [lower, right]] in degrees) into XYZ tiles.
+
+    The image is warped to EPSG:3857 with internal overviews, so tiles of every zoom are read from
+    the closest overview. Tiles are cached by key in the temporary directory and reused.
+    """
+    # imported here, so the tile math works without GDAL
+    from osgeo import gdal
+    output_dir = tiles_cache_directory("rasters", key)
+    pyramid = RasterPyramid.open(output_dir)
+    if pyramid is not None:
+        return pyramid
+    os.makedirs(output_dir, exist_ok=True)
+    gdal.UseExceptions()
+
+    (upper, left), (lower, right) = [[float(value) for value in bound] for bound in bounds]
+    source = gdal.Open(source_path)
+    translate_options = {"format": "VRT", "outputBounds": [left, upper, right, lower], "outputSRS": "EPSG:4326"}
+    first_band = source.GetRasterBand(1)
+    if first_band.GetColorTable() is not None:
+        translate_options["rgbExpand"] = "rgba"
+    elif first_band.DataType != gdal.GDT_Byte:
+        translate_options["outputType"] = gdal.GDT_Byte
+        translate_options["scaleParams"] = [[]]
+    georeferenced_path = "/vsimem/%s.vrt" % uuid.uuid4().hex
+    georeferenced = gdal.Translate(georeferenced_path, source, **translate_options)
+
+    warped_path = os.path.join(output_dir, "warped.tif")
+    warped = gdal.Warp(warped_path, georeferenced, format="GTiff", dstSRS="EPSG:3857", dstAlpha=True,
+                       multithread=True, creationOptions=["TILED=YES", "COMPRESS=DEFLATE", "BIGTIFF=IF_SAFER"])
+    georeferenced = None
+    gdal.Unlink(georeferenced_path)
+
+    pixel_size = warped.GetGeoTransform()[1]
+    if max_zoom is None:
+        max_zoom = min(max(int(math.ceil(math.log2(tile_meters(0) / TILE_SIZE / pixel_size))), 0), MAX_ZOOM)
+    if min_zoom is None:
+        extent = max(warped.RasterXSize, warped.RasterYSize) * pixel_size
+        min_zoom = min(max(int(math.floor(math.log2(tile_meters(0) / extent))), 0), max_zoom)
+
+    overview_factors = []
+    factor = 2
+    while max(warped.RasterXSize, warped.RasterYSize) / factor >= TILE_SIZE:
+        overview_factors.append(factor)
+        factor *= 2
+    if len(overview_factors) > 0:
+        warped.BuildOverviews("AVERAGE", overview_factors)
+
+    min_x, min_y = lon_lat_to_meters(left, lower)
+    max_x, max_y = lon_lat_to_meters(right, upper)
+    for zoom in range(min_zoom, max_zoom + 1):
+        first_x, first_y = meters_to_tile(min_x, max_y, zoom)
+        last_x, last_y = meters_to_tile(max_x, min_y, zoom)
+        for tile_x in range(first_x, last_x + 1):
+            for tile_y in range(first_y, last_y + 1):
+                tile = read_tile(warped, tile_x, tile_y, zoom)
+                if tile is None:
+                    continue
+                tile_dir = os.path.join(output_dir, str(zoom), str(tile_x))
+                os.makedirs(tile_dir, exist_ok=True)
+                with open(os.path.join(tile_dir, "%d.png" % tile_y), 'wb') as file:
+                    file.write(write_png(tile))
+
+    warped = None
+    os.remove(warped_path)
+    pyramid = RasterPyramid(output_dir, min_zoom, max_zoom)
+    pyramid.write_description()
+    return pyramid
+
+
+def read_tile(dataset, tile_x, tile_y, zoom):
+    """Reads the tile as a TILE_SIZE x TILE_SIZE x 4 uint8 array, or None if it is fully transparent.
+
+    The dataset must be in EPSG:3857 with the alpha band last.
+    """
+    from osgeo import gdal
+    origin_x, pixel_width, _, origin_y, _, pixel_height = dataset.GetGeoTransform()
+    pixel_height = -pixel_height
+    min_x, _, _, max_y = tile_bounds(tile_x, tile_y, zoom)
+    size = tile_meters(zoom)
+    # tile window in dataset pixels
+    window_x = (min_x - origin_x) / pixel_width
+    window_y = (origin_y - max_y) / pixel_height
+    window_width = size / pixel_width
+    window_height = size / pixel_height
+    read_x0 = max(window_x, 0)
+    read_y0 = max(window_y, 0)
+    read_x1 = min(window_x + window_width, dataset.RasterXSize)
+    read_y1 = min(window_y + window_height, dataset.RasterYSize)
+    if read_x1 <= read_x0 or read_y1 <= read_y0:
+        return None
+    # the same window in tile pixels
+    tile_x0 = int(round((read_x0 - window_x) / window_width * TILE_SIZE))
+    tile_y0 = int(round((read_y0 - window_y) / window_height * TILE_SIZE))
+    tile_x1 = int(round((read_x1 - window_x) / window_width * TILE_SIZE))
+    tile_y1 = int(round((read_y1 - window_y) / window_height * TILE_SIZE))
+    if tile_x1 <= tile_x0 or tile_y1 <= tile_y0:
+        return None
+    data = dataset.ReadAsArray(int(read_x0), int(read_y0),
+                               max(int(round(read_x1 - read_x0)), 1), max(int(round(read_y1 - read_y0)), 1),
+                               buf_xsize=tile_x1 - tile_x0, buf_ysize=tile_y1 - tile_y0,
+                               resample_alg=gdal.GRIORA_Average)
+    alpha = data[-1]
+    if not alpha.any():
+        return None
+    colors = data[:-1]
+    if len(colors) < 3:
+        colors = np.repeat(colors[:1], 3, axis=0)
+    tile = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype='uint8')
+    tile[tile_y0:tile_y1, tile_x0:tile_x1, :3] = colors[:3].transpose((1, 2, 0))
+    tile[tile_y0:tile_y1, tile_x0:tile_x1, 3] = alpha
+    return tile
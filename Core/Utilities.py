@@ -1,10 +1,12 @@
 import os
 import io
 import base64
+import hashlib
 import numpy as np
 import struct
 import zlib
 import json
+from Core.Colormaps import Colormap
 from urllib.parse import urlparse, uses_netloc, uses_params, uses_relative
 
 
@@ -21,9 +23,13 @@ def _is_url(url):
 
 
 def write_png(data, origin='upper', colormap=None):
-    if colormap is None:
-        def colormap(x):
-            return x, x, x, 1
+    """Encodes an array as PNG.
+
+    For single band data colormap may be a Colormap, a name of a color ramp or a callable that
+    maps one value to an RGB(A) tuple. The callable is applied value by value and is much slower.
+    """
+    if isinstance(colormap, str):
+        colormap = Colormap(colormap)
 
     arr = np.atleast_3d(data)
     height, width, nblayers = arr.shape
@@ -34,12 +40,18 @@ def write_png(data, origin='upper', colormap=None):
     assert arr.shape == (height, width, nblayers)
 
     if nblayers == 1:
-        arr = np.array(list(map(colormap, arr.ravel())))
-        nblayers = arr.shape[1]
-        if nblayers not in [3, 4]:
-            raise ValueError('colormap must provide colors of r'
-                             'length 3 (RGB) or 4 (RGBA)')
-        arr = arr.reshape((height, width, nblayers))
+        if colormap is None:
+            arr = arr.astype('float64')
+            arr = np.concatenate((arr, arr, arr, np.ones((height, width, 1))), axis=2)
+        elif isinstance(colormap, Colormap):
+            arr = colormap(arr[:, :, 0])
+        else:
+            arr = np.array(list(map(colormap, arr.ravel())))
+            if arr.ndim != 2 or arr.shape[1] not in [3, 4]:
+                raise ValueError('colormap must provide colors of r'
+                                 'length 3 (RGB) or 4 (RGBA)')
+            arr = arr.reshape((height, width, arr.shape[1]))
+        nblayers = arr.shape[2]
     assert arr.shape == (height, width, nblayers)
 
     if nblayers == 3:
@@ -57,8 +69,9 @@ def write_png(data, origin='upper', colormap=None):
     if origin == 'lower':
         arr = arr[::-1, :, :]
 
-    raw_data = b''.join([b'\x00' + arr[i, :, :].tobytes()
-                         for i in range(height)])
+    # every scanline starts with the "no filter" byte
+    raw_data = np.concatenate((np.zeros((height, 1), dtype='uint8'), arr.reshape((height, width * 4))),
+                              axis=1).tobytes()
 
     def png_pack(png_tag, data):
         chunk_head = png_tag + data
@@ -78,30 +91,33 @@ def image_to_data(path, colormap=None, origin='upper'):
         file_format = os.path.splitext(path)[-1][1:]
         with io.open(path, 'rb') as f:
             img = f.read()
-        b64encoded = base64.b64encode(img).decode('utf-8')
-        url = 'data:image/{};base64,{}'.format(file_format, b64encoded)
+        url = bytes_to_data_url(img, file_format)
     elif 'ndarray' in path.__class__.__name__:
         img = write_png(path, origin=origin, colormap=colormap)
-        b64encoded = base64.b64encode(img).decode('utf-8')
-        url = 'data:image/png;base64,{}'.format(b64encoded)
+        url = bytes_to_data_url(img, 'png')
     else:
         url = json.loads(json.dumps(path))
     return url.replace('\n', ' ')
 
 
+def file_hash(path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with io.open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def bytes_to_data_url(data, file_format):
+    return 'data:image/{};base64,{}'.format(file_format, base64.b64encode(data).decode('utf-8'))
+
+
+def data_url_to_bytes(url):
+    """Returns the image format and the decoded bytes of a base64 data url."""
+    header, encoded = url.split(',', 1)
+    file_format = header[len('data:image/'):].split(';')[0]
+    return file_format, base64.b64decode(encoded)
+
+
 def split_data_to_blocks(data, block_length):
-    blocks = []
-    tmp_block = ""
-    for i in range(0, len(data)):
-        tmp_block += data[i]
-        if (i + 1) % block_length == 0:
-            blocks.append(tmp_block)
-            tmp_block = ""
-        print(len(data) - i)
-    if len(tmp_block) > 0:
-        blocks.append(tmp_block)
-    #while len(data) > 0:
-    #    blocks.append(data[0:block_length])
-    #    data = data[block_length:]
-    #    print(len(data))
-    return blocks
+    return [data[i:i + block_length] for i in range(0, len(data), block_length)]
@@ -0,0 +1,218 @@
+import json
+import math
+import struct
+import numpy as np
+import shapely
+from shapely.geometry.polygon import orient
+from shapely.strtree import STRtree
+from Core.Tiles import ORIGIN_SHIFT, tile_bounds, tile_meters
+from Core.TileCache import LRUCache
+
+EXTENT = 4096
+# part of the tile added around it before clipping, so lines and outlines continue past its edges
+BUFFER = 64 / 4096
+
+POINT = 1
+LINESTRING = 2
+POLYGON = 3
+
+MOVE_TO = 1
+LINE_TO = 2
+CLOSE_PATH = 7
+
+
+def to_mercator(coordinates):
+    x = coordinates[:, 0] * ORIGIN_SHIFT / 180.0
+    latitudes = np.clip(coordinates[:, 1], -85.0511287798, 85.0511287798)
+    y = np.log(np.tan((90.0 + latitudes) * math.pi / 360.0)) * 6378137.0
+    return np.stack((x, y), axis=1)
+
+
+def varint(value):
+    encoded = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            encoded.append(byte | 0x80)
+        else:
+            encoded.append(byte)
+            return bytes(encoded)
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 31)
+
+
+def field_key(number, wire_type):
+    return varint((number << 3) | wire_type)
+
+
+def length_delimited(number, data):
+    return field_key(number, 2) + varint(len(data)) + data
+
+
+def varint_field(number, value):
+    return field_key(number, 0) + varint(value)
+
+
+def packed(number, values):
+    return length_delimited(number, b"".join(varint(value) for value in values))
+
+
+def encode_value(value):
+    if isinstance(value, bool):
+        return varint_field(7, int(value))
+    if isinstance(value, int):
+        if value >= 0:
+            return varint_field(5, value)
+        return varint_field(6, (value << 1) ^ (value >> 63))
+    if isinstance(value, float):
+        return field_key(3, 1) + struct.pack("<d", value)
+    if not isinstance(value, str):
+        value = json.dumps(value)
+    return length_delimited(1, value.encode("utf-8"))
+
+
+class GeometryEncoder:
+    """Builds the command integers of one feature geometry in tile coordinates."""
+
+    def __init__(self):
+        self.commands = []
+        self.x = 0
+        self.y = 0
+
+    def move(self, points, command):
+        self.commands.append((command & 0x7) | (len(points) << 3))
+        for x, y in points:
+            self.commands.append(zigzag(x - self.x))
+            self.commands.append(zigzag(y - self.y))
+            self.x, self.y = x, y
+
+    def add_points(self, points):
+        if len(points) > 0:
+            self.move(points, MOVE_TO)
+
+    def add_line(self, points):
+        if len(points) >= 2:
+            self.move(points[:1], MOVE_TO)
+            self.move(points[1:], LINE_TO)
+
+    def add_ring(self, points):
+        # the closing point is implied by ClosePath
+        points = points[:-1]
+        if len(points) >= 3:
+            self.move(points[:1], MOVE_TO)
+            self.move(points[1:], LINE_TO)
+            self.commands.append(CLOSE_PATH | (1 << 3))
+
+
+def tile_points(coordinates):
+    """Rounds tile coordinates to integers and drops repeated points."""
+    points = []
+    for x, y in np.round(coordinates).astype('int64').tolist():
+        if len(points) == 0 or points[-1] != (x, y):
+            points.append((x, y))
+    return points
+
+
+def encode_geometry(geometry):
+    """Returns (geometry type, commands) pairs of a geometry already in tile coordinates."""
+    geometry_type = geometry.geom_type
+    if geometry_type == "GeometryCollection":
+        return [part for child in geometry.geoms for part in encode_geometry(child)]
+    encoder = GeometryEncoder()
+    if geometry_type in ["Point", "MultiPoint"]:
+        encoder.add_points(tile_points(shapely.get_coordinates(geometry)))
+        feature_type = POINT
+    elif geometry_type in ["LineString", "MultiLineString", "LinearRing"]:
+        for line in getattr(geometry, "geoms", [geometry]):
+            encoder.add_line(tile_points(np.asarray(line.coords)))
+        feature_type = LINESTRING
+    else:
+        for polygon in getattr(geometry, "geoms", [geometry]):
+            # with y pointing down exterior rings must have a positive area (clockwise on screen)
+            polygon = orient(polygon, sign=1.0)
+            encoder.add_ring(tile_points(np.asarray(polygon.exterior.coords)))
+            for interior in polygon.interiors:
+                encoder.add_ring(tile_points(np.asarray(interior.coords)))
+        feature_type = POLYGON
+    if len(encoder.commands) == 0:
+        return []
+    return [(feature_type, encoder.commands)]
+
+
+class VectorTileProvider:
+    """Cuts a GeometryStore into Mapbox Vector Tiles on request and caches them by z/x/y.
+
+    The store is projected to EPSG:3857 and indexed once; both are rebuilt when it changes.
+    """
+
+    content_type = b"application/x-protobuf"
+
+    def __init__(self, store, layer_name, max_memory_bytes=64 * 1024 * 1024):
+        self.store = store
+        self.layer_name = layer_name
+        self.cache = LRUCache(max_memory_bytes)
+        self.version = None
+        self.geometries = None
+        self.tree = None
+
+    def prepare(self):
+        if self.version != self.store.version:
+            self.geometries = shapely.transform(self.store.geometries, to_mercator)
+            self.tree = STRtree(self.geometries)
+            self.cache = LRUCache(self.cache.max_bytes)
+            self.version = self.store.version
+
+    def upstream_tile_url(self, zoom, x, y):
+        return None
+
+    def get(self, zoom, x, y):
+        self.prepare()
+        data = self.cache.get((zoom, x, y))
+        if data is None:
+            data = self.encode_tile(zoom, x, y)
+            self.cache.put((zoom, x, y), data)
+        return data
+
+    def encode_tile(self, zoom, x, y):
+        min_x, min_y, max_x, max_y = tile_bounds(x, y, zoom)
+        size = tile_meters(zoom)
+        margin = size * BUFFER
+        indexes = np.sort(self.tree.query(shapely.box(min_x - margin, min_y - margin,
+                                                      max_x + margin, max_y + margin)))
+        clipped = shapely.clip_by_rect(self.geometries[indexes], min_x - margin, min_y - margin,
+                                       max_x + margin, max_y + margin)
+        # one tile pixel is the finest detail the tile can show
+        clipped = shapely.simplify(clipped, size / EXTENT)
+
+        def to_tile(coordinates):
+            return np.stack(((coordinates[:, 0] - min_x) / size * EXTENT,
+                             (max_y - coordinates[:, 1]) / size * EXTENT), axis=1)
+
+        keys = {}
+        values = {}
+        features = []
+        for index, geometry in zip(indexes.tolist(), clipped):
+            if geometry is None or geometry.is_empty:
+                continue
+            tags = []
+            for key, value in self.store.properties[index].items():
+                if value is None:
+                    continue
+                value_key = (type(value).__name__, json.dumps(value, sort_keys=True))
+                tags.append(keys.setdefault(key, len(keys)))
+                tags.append(values.setdefault(value_key, (len(values), value))[0])
+            for feature_type, commands in encode_geometry(shapely.transform(geometry, to_tile)):
+                features.append(varint_field(1, index + 1) + packed(2, tags) + varint_field(3, feature_type) +
+                                packed(4, commands))
+        if len(features) == 0:
+            return b""
+        layer = [varint_field(15, 2), length_delimited(1, self.layer_name.encode("utf-8"))]
+        layer.extend(length_delimited(2, feature) for feature in features)
+        layer.extend(length_delimited(3, key.encode("utf-8")) for key in keys)
+        layer.extend(length_delimited(4, encode_value(value)) for _, value in sorted(values.values(),
+                                                                                         key=lambda item: item[0]))
+        layer.append(varint_field(5, EXTENT))
+        return length_delimited(3, b"".join(layer))
@@ -1,35 +1,92 @@
-import geojson
-from Core.Exceptions import LayerAddingException, MapCreatingException, FileOpeningException, LayerNotFoundException
+from Core.Exceptions import LayerAddingException, MapCreatingException, FileOpeningException, LayerNotFoundException,\
+    NotVectorLayer, OperationCancelledException
+from Core.Layers import VectorLayer, RasterLayer, LayerRegistry
+from Core.GeoJSONReader import read_feature_batches
+from Core.Lineage import Lineage
+from Core.Project import save_project, ProjectFile
+from Core.ResultCache import ResultCache, DEFAULT_RESULTS_PATH
+from Core.SpatialIndex import LayerIndex
+from Core.Storage import GeometryStore
+from Core.Tasks import Task
+from Core.Profiling import profiler, profiled
+from Core.Tiles import build_raster_pyramid
 from Core.Utilities import image_to_data
-from Core.Layers import VectorLayer, RasterLayer
+from Core.TileCache import CachedTileProvider, open_tile_store, DEFAULT_STORE_PATH, OSM_TILE_URL, MAX_SEED_TILES
+from Core.TileServer import TileSchemeHandler
+from Core.VectorTiles import VectorTileProvider
 from Core.Templates import DEFAULT_HTML, MAP_CREATION_SCRIPT, OSM_TILE_CREATION_SCRIPT, ADD_TILE_TO_MAP_SCRIPT,\
-    GEOJSON_LAYER_CREATION_SCRIPT, GEOJSON_LAYER_ADD_DATA_SCRIPT, REMOVE_LAYER_SCRIPT, RASTER_LAYER_CREATION_SCRIPT,\
-    SHOW_LAYER_SCRIPT, HIDE_LAYER_SCRIPT, BRING_TO_BACK_SCRIPT, BRING_TO_FRONT_SCRIPT
-from Core import Computing
-from PyQt5.QtCore import QDir, QUrl
+    LOCAL_TILE_CREATION_SCRIPT, MAP_BOUNDS_SCRIPT,\
+    GEOJSON_LAYER_CREATION_SCRIPT, GEOJSON_LAYER_ADD_DATA_SCRIPT, GEOJSON_LAYER_REMOVE_FEATURES_SCRIPT,\
+    LOD_LAYER_CREATION_SCRIPT, LOD_LEVEL_CREATION_SCRIPT,\
+    LOD_LEVEL_ADD_DATA_SCRIPT, VECTOR_TILE_LAYER_CREATION_SCRIPT, REMOVE_LAYER_SCRIPT, RASTER_LAYER_CREATION_SCRIPT,\
+    RASTER_TILE_LAYER_CREATION_SCRIPT, SHOW_LAYER_SCRIPT, HIDE_LAYER_SCRIPT, SET_LAYER_Z_INDEX_SCRIPT
+from Core import Overlay
+from Core.Bridge import MapBridge
+from PyQt5.QtCore import QDir, QUrl, QTimer, QThreadPool
+from PyQt5.QtWebChannel import QWebChannel
 from PyQt5.QtWidgets import QMessageBox
+import hashlib
+import json
 import os
+import threading
 
 
 class View:
-    TILES_STRING_TO_SCRIPT = {"OpenStreetMap": OSM_TILE_CREATION_SCRIPT}
+    TILES_STRING_TO_SCRIPT = {"OpenStreetMap": OSM_TILE_CREATION_SCRIPT,
+                              "OpenStreetMap (cached)": LOCAL_TILE_CREATION_SCRIPT % "basemap"}
+    TRANSFER_BATCH_BYTES = 4 * 1024 * 1024
+    # vector layers with fewer vertices are always sent at full resolution
+    LOD_MIN_VERTICES = 100000
+    # highest zooms of the bands that get a simplified copy, full resolution is used above the last one
+    LOD_ZOOM_BANDS = [4, 8, 12]
+    MAX_ZOOM = 18
+    # vector layers with more features are rendered as vector tiles unless set otherwise
+    VECTOR_TILES_MIN_FEATURES = 50000
+    VECTOR_TILES_LAYER_NAME = "features"
+    # features closer to a map click than this many pixels are taken as clicked
+    CLICK_TOLERANCE_PIXELS = 4
+    # keep computed results in DEFAULT_RESULTS_PATH across sessions, writing every result there
+    RESULTS_ON_DISK = False
+    # files shown as a composite read at the display resolution instead of being sent as they are
+    SCENE_EXTENSIONS = [".xml", ".tif", ".tiff"]
 
     def __init__(self, window, map_tiles="OpenStreetMap", save_file_path=None, ui=None):
         if map_tiles not in View.TILES_STRING_TO_SCRIPT.keys(): #["OpenStreetMap", "Mapbox Bright", "Mapbox Control Room", "Stamen"]:
             raise MapCreatingException("Undefined map tiles")
-        self.layers = []
+        self.layers = LayerRegistry()
+        # active feature transfers to the web view by layer name
+        self.transfers = {}
+        # files being read into layers by layer name
+        self.readings = {}
+        # tile pyramids being built on worker threads by layer name
+        self.pyramid_tasks = {}
+        # operations running on worker threads
+        self.tasks = set()
+        # results of buffer and intersection by their inputs and parameters, on disk only if RESULTS_ON_DISK is set
+        self.results = ResultCache(directory=DEFAULT_RESULTS_PATH if View.RESULTS_ON_DISK else None)
+        # spatial indexes of vector layers by layer name, built on the first query
+        self.indexes = {}
+        # {layer name: feature ids} under the last map click
+        self.clicked_features = {}
         self.save_file_path = save_file_path
         self.ui = ui
         self.map_tiles = map_tiles
         self.window = window
+        self.tile_server = TileSchemeHandler.install(self.window.page().profile())
+        if self.map_tiles == "OpenStreetMap (cached)":
+            self.basemap_provider()
+        self.bridge = MapBridge(self)
+        self.channel = QWebChannel()
+        self.channel.registerObject("bridge", self.bridge)
+        self.window.page().setWebChannel(self.channel)
         self.window.setHtml(DEFAULT_HTML)
         self.window.loadFinished.connect(self.on_load_finished)
 
     def on_load_finished(self, status):
         if status:
             if self.save_file_path is None:
-                self.window.page().runJavaScript(MAP_CREATION_SCRIPT + View.TILES_STRING_TO_SCRIPT[self.map_tiles] +
-                                                 ADD_TILE_TO_MAP_SCRIPT)
+                self.run_script(MAP_CREATION_SCRIPT + View.TILES_STRING_TO_SCRIPT[self.map_tiles] +
+                                ADD_TILE_TO_MAP_SCRIPT)
             else:
                 try:
                     self.load(self.save_file_path)
@@ -42,24 +99,29 @@ class View:
                 else:
                     self.ui.project_opened(True, self.window)
 
+    def run_script(self, script, callback=None):
+        """Runs JavaScript in the map page; every script sent to the web view goes through here."""
+        profiler.add_js_bytes(len(script))
+        if callback is None:
+            self.window.page().runJavaScript(script)
+        else:
+            self.window.page().runJavaScript(script, callback)
+
     def has_layer(self, layer_name, return_layer=False):
-        index = -1
-        for i in range(0, len(self.layers)):
-            if self.layers[i].name == layer_name:
-                index = i
         if return_layer:
-            if index == -1:
-                return None
-            else:
-                return self.layers[index]
-        else:
-            return index != -1
+            return self.layers.get(layer_name)
+        return layer_name in self.layers
 
     def add_map_layer(self, layer_name, map_type):
         if self.has_layer(layer_name):
             raise LayerAddingException("Layer with this name is already added")
 
-    def add_raster_layer(self, layer_name, file_path, upper_left_bound, lower_right_bound, data=None):
+    @profiled("view")
+    def add_raster_layer(self, layer_name, file_path, upper_left_bound, lower_right_bound, data=None,
+                         as_tiles=False, progress=None, finished=None):
+        """Adds a raster layer. Scenes (see is_scene) are read on a worker thread: their Task is returned and
+        the layer is added when it finishes, progress and finished work as in start_buffer_layer.
+        """
         if not self.check_layer_name(layer_name):
             raise LayerAddingException("Incorrect layer name")
         if self.has_layer(layer_name):
@@ -68,171 +130,745 @@ class View:
             raise FileOpeningException("File not found!")
         else:
             bounds = [upper_left_bound, lower_right_bound]
-            string_bounds = "[[" + str(bounds[0][0]) + ", " + str(bounds[0][1]) + "], [" +\
-                            str(bounds[1][0]) + ", " + str(bounds[1][1]) + "]]"
-            if data is None:
-                data = image_to_data(file_path)
-            file = open("create_layer.js", 'w')
-            file.writelines(['var createLayerData = "' + data + '";\n1',
-                            RASTER_LAYER_CREATION_SCRIPT % (layer_name, string_bounds, layer_name)])
-            file.close()
-            path = QDir.current().filePath("create_layer.js")
-            local = QUrl.fromLocalFile(path).toString()
-            self.window.page().runJavaScript('$("head").append("<script src=\'%s\'></script>");' % local)
-            self.layers.append(RasterLayer(layer_name, data, bounds))
-
-    def add_vector_layer(self, layer_name, file_path, data=None):
+            if data is None and View.is_scene(file_path, as_tiles):
+                return self.start_scene_layer(layer_name, file_path, bounds, progress, finished)
+            elif data is None:
+                layer = RasterLayer(layer_name, None, bounds, file_path, as_tiles)
+            else:
+                layer = RasterLayer(layer_name, data, bounds)
+            self.layers.add(layer)
+            self.push_layer(layer)
+
+    @staticmethod
+    def is_scene(file_path, as_tiles=False):
+        """Whether the file is added as a composite: ESPA scenes always, (Geo)TIFFs unless they are tiled."""
+        from Core.Rasters import is_espa_metadata
+        extension = os.path.splitext(file_path)[1].lower()
+        return is_espa_metadata(file_path) or (extension in View.SCENE_EXTENSIONS and not as_tiles)
+
+    def start_scene_layer(self, layer_name, file_path, bounds, progress=None, finished=None):
+        """Builds the RGB composite of a scene on a worker thread and adds it as a layer placed by the
+        georeferencing of the scene, or at bounds if it has none.
+        """
+        # GDAL is only needed for rasters
+        from Core.Rasters import read_metadata, composite
+        try:
+            metadata = read_metadata(file_path)
+        except Exception:
+            raise FileOpeningException("File can't be read!")
+
+        def build(task_progress, cancelled):
+            try:
+                image, scene_bounds = composite(metadata, progress=task_progress, cancelled=cancelled)
+            except OperationCancelledException:
+                raise
+            except Exception:
+                raise FileOpeningException("File can't be read!")
+            return image_to_data(image), scene_bounds if scene_bounds is not None else bounds
+
+        def add(result):
+            # the name may have been taken while the composite was built
+            if self.has_layer(layer_name):
+                raise LayerAddingException("Layer with this name is already added")
+            layer = RasterLayer(layer_name, result[0], result[1])
+            self.layers.add(layer)
+            self.push_layer(layer)
+
+        return self.run_task(build, add, progress, finished)
+
+    @profiled("view")
+    def add_vector_layer(self, layer_name, file_path, data=None, progress=None):
         if not self.check_layer_name(layer_name):
             raise LayerAddingException("Incorrect layer name")
         if self.has_layer(layer_name):
             raise LayerAddingException("Layer with this name is already added")
         if data is None:
+            self.read_vector_file(layer_name, file_path, progress)
+            return
+        layer = VectorLayer(layer_name, data)
+        self.layers.add(layer)
+        self.push_layer(layer, progress)
+
+    @profiled("view")
+    def read_vector_file(self, layer_name, file_path, progress=None):
+        """Adds a GeoJSON or newline-delimited GeoJSON file as a layer without reading it at once.
+
+        Features are parsed, added to the layer store and sent to the web view batch by batch,
+        returning to the event loop between batches. progress is called with the read and the
+        total file size. Large layers are rendered again as tiles or detail levels once read.
+        """
+        if not os.path.exists(file_path):
+            raise FileOpeningException("File not found!")
+        batches = read_feature_batches(file_path, View.TRANSFER_BATCH_BYTES)
+        try:
+            first_batch = next(batches, ([], 0))
+            store = GeometryStore.from_features(first_batch[0])
+        except Exception:
+            raise FileOpeningException("File can't be read!")
+        layer = VectorLayer(layer_name)
+        layer.store = store
+        self.layers.add(layer)
+        self.run_script(GEOJSON_LAYER_CREATION_SCRIPT %
+                        (layer_name, layer_name, self.layers.z_index(layer_name), layer_name, layer_name))
+        layer.on_map = True
+        self.push_features(layer_name, store)
+        file_size = os.path.getsize(file_path)
+        if progress is not None:
+            progress(first_batch[1], file_size)
+        reading = object()
+        self.readings[layer_name] = reading
+
+        def read_next_batch():
+            if self.readings.get(layer_name) is not reading:
+                batches.close()
+                return
             try:
-                geo_file = open(file_path, 'r')
-                geo_data = geojson.load(geo_file)
-                geo_file.close()
+                with profiler.span("View.read_vector_file batch", "view", layer=layer_name):
+                    batch = next(batches, None)
+                    batch_store = GeometryStore.from_features(batch[0]) if batch is not None else None
+                    profiler.annotate(features=len(batch_store) if batch_store is not None else 0)
             except Exception:
-                raise FileOpeningException("File can't be read!")
+                batches.close()
+                del self.readings[layer_name]
+                if self.ui is not None:
+                    self.ui.show_message("File was read only partially: %s" % file_path, "Error!",
+                                         QMessageBox.Critical)
+                return
+            if batch is None:
+                del self.readings[layer_name]
+                self.finish_extending(layer)
+                return
+            self.extend_layer(layer, batch_store)
+            if progress is not None:
+                progress(batch[1], file_size)
+            QTimer.singleShot(0, read_next_batch)
+
+        QTimer.singleShot(0, read_next_batch)
+
+    def extend_layer(self, layer, store):
+        """Adds a batch of features to a layer that is filled batch by batch, see finish_extending."""
+        ids = layer.store.extend(store)
+        # a layer that turned out large is only rendered once it is complete
+        if layer.on_map and not layer.level_of_detail and not self.use_vector_tiles(layer):
+            self.push_features(layer.name, GeometryStore(store.geometries, store.properties, ids))
+
+    def finish_extending(self, layer):
+        """Renders a layer filled by extend_layer again if it is large and updates the layers computed from it."""
+        if layer.level_of_detail or self.use_vector_tiles(layer) or self.detail_levels(layer.store) is not None:
+            self.update_vector_layer(layer.name)
+        self.refresh_derived(layer.name)
+
+    @profiled("view")
+    def push_layer(self, layer, progress=None):
+        """Creates the layer in the web view, decoding its data if it was not loaded yet."""
+        profiler.annotate(layer=layer.name, type=layer.type)
+        # the layer is created in a pane of its own, whose z-index keeps it in the registry order
+        z_index = self.layers.z_index(layer.name)
+        if layer.type == "raster":
+            string_bounds = "[[" + str(layer.bounds[0][0]) + ", " + str(layer.bounds[0][1]) + "], [" +\
+                            str(layer.bounds[1][0]) + ", " + str(layer.bounds[1][1]) + "]]"
+            if layer.tiled and layer.gdal_path() is not None:
+                if layer.pyramid is None:
+                    # the layer is created in the web view once its tiles are cut
+                    self.start_pyramid(layer)
+                    return
+                self.run_script(RASTER_TILE_LAYER_CREATION_SCRIPT %
+                                (layer.name, layer.pyramid.url_template(), layer.name, z_index,
+                                 layer.pyramid.min_zoom, layer.pyramid.max_zoom, string_bounds, layer.name))
             else:
-                self.layers.append(VectorLayer(layer_name, str(geo_data)))
-                self.window.page().runJavaScript(GEOJSON_LAYER_CREATION_SCRIPT % (layer_name, layer_name))
-                self.window.page().runJavaScript(GEOJSON_LAYER_ADD_DATA_SCRIPT % (layer_name, str(geo_data)))
+                data = layer.data
+                profiler.add_js_bytes(len(data))
+                file = open("create_layer.js", 'w')
+                file.writelines(['var createLayerData = "' + data + '";\n1',
+                                RASTER_LAYER_CREATION_SCRIPT %
+                                 (layer.name, string_bounds, layer.name, z_index, layer.name)])
+                file.close()
+                path = QDir.current().filePath("create_layer.js")
+                local = QUrl.fromLocalFile(path).toString()
+                self.run_script('$("head").append("<script src=\'%s\'></script>");' % local)
+        elif self.use_vector_tiles(layer):
+            layer.level_of_detail = False
+            host = View.vector_tiles_host(layer.name)
+            self.tile_server.add_provider(host, VectorTileProvider(layer.store, View.VECTOR_TILES_LAYER_NAME))
+            # the version restarts when the layer gets a new store, the store id tells the stores apart
+            url = "gismin://%s/{z}/{x}/{y}.pbf?store=%d&version=%d" % (host, layer.store.store_id,
+                                                                        layer.store.version)
+            self.run_script(VECTOR_TILE_LAYER_CREATION_SCRIPT %
+                            (layer.name, url, layer.name, z_index, View.VECTOR_TILES_LAYER_NAME, layer.name))
         else:
-            self.layers.append(VectorLayer(layer_name, data))
-            self.window.page().runJavaScript(GEOJSON_LAYER_CREATION_SCRIPT % (layer_name, layer_name))
-            self.window.page().runJavaScript(GEOJSON_LAYER_ADD_DATA_SCRIPT % (layer_name, str(data)))
+            if profiler.enabled:
+                profiler.annotate(features=len(layer.store), vertices=layer.store.vertex_count())
+            levels = self.detail_levels(layer.store)
+            layer.level_of_detail = levels is not None
+            if levels is None:
+                self.run_script(GEOJSON_LAYER_CREATION_SCRIPT %
+                                (layer.name, layer.name, z_index, layer.name, layer.name))
+                self.push_features(layer.name, layer.store, progress)
+            else:
+                # levels are created empty, the map asks for the features of a level when it shows it
+                layer.levels = levels
+                layer.sent_levels = set()
+                self.run_script(LOD_LAYER_CREATION_SCRIPT %
+                                ((layer.name,) * 3 + (z_index,) + (layer.name,) * 4))
+                for min_zoom, max_zoom, _ in levels:
+                    self.run_script(LOD_LEVEL_CREATION_SCRIPT %
+                                    (layer.name, min_zoom, max_zoom, layer.name, layer.name, layer.name))
+        layer.on_map = True
+
+    def start_pyramid(self, layer):
+        """Builds the tile pyramid of a tiled raster on a worker thread, then shows the layer if it still should be."""
+        if layer.name in self.pyramid_tasks:
+            return
+        path, bounds = layer.gdal_path(), layer.bounds
+
+        def apply(pyramid):
+            layer.pyramid = pyramid
+            if self.layers.get(layer.name) is layer and layer.is_visible and not layer.on_map:
+                self.push_layer(layer)
+
+        def finished(error):
+            if self.pyramid_tasks.get(layer.name) is task:
+                del self.pyramid_tasks[layer.name]
+            if error is not None and not isinstance(error, OperationCancelledException) and self.ui is not None:
+                self.ui.show_message("Raster tiles can't be built: %s" % getattr(error, "message", str(error)),
+                                     "Error!", QMessageBox.Critical)
+
+        # hashing the file for the cache key reads all of it, so it is done on the worker thread too
+        task = self.run_task(lambda progress, cancelled: build_raster_pyramid(path, bounds, layer.tiles_key()),
+                             apply, finished=finished)
+        self.pyramid_tasks[layer.name] = task
+
+    @staticmethod
+    def use_vector_tiles(layer):
+        if layer.vector_tiles is not None:
+            return layer.vector_tiles
+        return len(layer.store) >= View.VECTOR_TILES_MIN_FEATURES
 
+    @staticmethod
+    def vector_tiles_host(layer_name):
+        return "layer-" + hashlib.sha1(layer_name.encode("utf-8")).hexdigest()[:16]
+
+    @profiled("view")
+    def set_vector_tiles(self, layer_name, vector_tiles):
+        layer = self.has_layer(layer_name, True)
+        if layer is None:
+            raise LayerNotFoundException("Layer not found")
+        layer.vector_tiles = vector_tiles
+        self.update_vector_layer(layer_name)
+
+    @staticmethod
+    def zoom_tolerance(zoom):
+        """Returns the size of a screen pixel at the zoom in degrees."""
+        return 360.0 / (256 * 2 ** zoom)
+
+    def detail_levels(self, store):
+        """Returns (min zoom, max zoom, tolerance) levels of a large layer, or None if it is sent as is.
+
+        Geometries of a level are simplified with its tolerance, the pixel size of the highest zoom
+        of its band, when it is sent (see push_level); the last level has no tolerance and is the
+        full resolution store, which computing operations keep working on.
+        """
+        if store.vertex_count() < View.LOD_MIN_VERTICES:
+            return None
+        levels = []
+        min_zoom = 0
+        for max_zoom in View.LOD_ZOOM_BANDS:
+            levels.append((min_zoom, max_zoom, View.zoom_tolerance(max_zoom)))
+            min_zoom = max_zoom + 1
+        levels.append((min_zoom, View.MAX_ZOOM, None))
+        return levels
+
+    def push_level(self, layer_name, level):
+        """Sends the features of a detail level the map shows for the first time."""
+        layer = self.has_layer(layer_name, True)
+        if layer is None or layer.type != "vector" or not layer.on_map or not layer.level_of_detail or \
+                level in layer.sent_levels or not 0 <= level < len(layer.levels):
+            return
+        layer.sent_levels.add(level)
+        tolerance = layer.levels[level][2]
+        self.push_features(layer_name, layer.store if tolerance is None else layer.store.simplified(tolerance),
+                           level=level)
+
+    @profiled("view")
+    def push_features(self, layer_name, store, progress=None, level=None):
+        """Sends features to the web view in bounded batches, returning to the event loop between them.
+
+        progress is called with the sent and the total features count after each batch. level is
+        the index of the detail level of the layer the features are added to.
+        """
+        transfer = object()
+        self.transfers.setdefault(layer_name, set()).add(transfer)
+        batches = store.feature_batches(View.TRANSFER_BATCH_BYTES)
+        total_count = len(store)
+        sent_count = [0]
+
+        def send_next_batch():
+            if transfer not in self.transfers.get(layer_name, ()):
+                return
+            batch = next(batches, None)
+            if batch is None:
+                self.transfers[layer_name].discard(transfer)
+                return
+            count, data = batch
+            with profiler.span("View.push_features batch", "view", layer=layer_name, features=count):
+                if level is None:
+                    self.run_script(GEOJSON_LAYER_ADD_DATA_SCRIPT % (layer_name, layer_name, data))
+                else:
+                    self.run_script(LOD_LEVEL_ADD_DATA_SCRIPT % (layer_name, layer_name, level, data))
+            sent_count[0] += count
+            if progress is not None:
+                progress(sent_count[0], total_count)
+            QTimer.singleShot(0, send_next_batch)
+
+        send_next_batch()
+
+    def cancel_transfers(self, layer_name):
+        self.transfers.pop(layer_name, None)
+
+    @profiled("view")
     def remove_layer(self, layer_name):
         layer = self.has_layer(layer_name, True)
         if layer is None:
             raise LayerNotFoundException("Layer not found")
-        self.layers.remove(layer)
-        self.window.page().runJavaScript(REMOVE_LAYER_SCRIPT % (layer_name, layer_name))
+        self.layers.remove(layer_name)
+        self.cancel_transfers(layer_name)
+        self.readings.pop(layer_name, None)
+        self.indexes.pop(layer_name, None)
+        pyramid_task = self.pyramid_tasks.pop(layer_name, None)
+        if pyramid_task is not None:
+            pyramid_task.cancel()
+        self.tile_server.remove_provider(View.vector_tiles_host(layer_name))
+        if layer.on_map:
+            self.run_script(REMOVE_LAYER_SCRIPT % (layer_name, layer_name))
 
     @staticmethod
     def check_layer_name(layer_name):
         layer_name = layer_name.replace(" ", "")
         return len(layer_name) > 0
 
+    @profiled("view")
     def set_visible(self, layer_name, is_visible):
         layer = self.has_layer(layer_name, True)
         if layer is None:
             raise LayerNotFoundException("Layer not found")
         layer.is_visible = is_visible
-        if layer.is_visible:
-            self.window.page().runJavaScript(SHOW_LAYER_SCRIPT % (layer_name, layer_name))
+        if not layer.on_map:
+            if layer.is_visible:
+                self.push_layer(layer)
+        elif layer.is_visible:
+            self.run_script(SHOW_LAYER_SCRIPT % (layer_name, layer_name))
         else:
-            self.window.page().runJavaScript(HIDE_LAYER_SCRIPT % (layer_name, layer_name))
+            self.run_script(HIDE_LAYER_SCRIPT % (layer_name, layer_name))
 
+    @profiled("view")
     def bring_to_back(self, layer_name):
         layer = self.has_layer(layer_name, True)
         if layer is None:
             raise LayerNotFoundException("Layer not found")
-        self.window.page().runJavaScript(BRING_TO_BACK_SCRIPT % layer_name)
+        self.layers.move_to_back(layer_name)
+        if layer.on_map:
+            self.run_script(SET_LAYER_Z_INDEX_SCRIPT % (layer_name, self.layers.z_index(layer_name)))
 
+    @profiled("view")
     def bring_to_front(self, layer_name):
         layer = self.has_layer(layer_name, True)
         if layer is None:
             raise LayerNotFoundException("Layer not found")
-        self.window.page().runJavaScript(BRING_TO_FRONT_SCRIPT % layer_name)
+        self.layers.move_to_front(layer_name)
+        if layer.on_map:
+            self.run_script(SET_LAYER_Z_INDEX_SCRIPT % (layer_name, self.layers.z_index(layer_name)))
+
+    def basemap_provider(self):
+        """Returns the provider of the cached basemap, opening the local tile store on the first call."""
+        if "basemap" not in self.tile_server.providers:
+            self.tile_server.add_provider("basemap", CachedTileProvider(open_tile_store(DEFAULT_STORE_PATH),
+                                                                        OSM_TILE_URL))
+        return self.tile_server.providers["basemap"]
+
+    @profiled("view")
+    def seed_basemap(self, min_zoom, max_zoom, progress=None, cancelled=None):
+        """Downloads the basemap tiles of the visible area into the local tile store in a background thread.
 
-    def load_splitted_data(self, blocks, variable_name):
-        self.window.page().runJavaScript("""
-            var %s = "";
-        """ % variable_name)
-        for block in blocks:
-            self.window.page().runJavaScript("""
-                %s += "%s";
-            """ % (variable_name, block))
+        progress and cancelled are called from that thread, progress with the processed and the total
+        tiles count. Areas of more than TileCache.MAX_SEED_TILES tiles are refused with a message.
+        """
+        provider = self.basemap_provider()
 
+        def start(bounds):
+            tiles_count = CachedTileProvider.seed_count(bounds, min_zoom, max_zoom)
+            if tiles_count > MAX_SEED_TILES:
+                if self.ui is not None:
+                    self.ui.show_message("Too many tiles to download: %d, at most %d are allowed. Zoom in or "
+                                         "lower the maximum zoom." % (tiles_count, MAX_SEED_TILES),
+                                         "Error!", QMessageBox.Critical)
+                return
+            threading.Thread(target=provider.seed, args=(bounds, min_zoom, max_zoom, progress, cancelled),
+                             daemon=True).start()
+
+        self.run_script(MAP_BOUNDS_SCRIPT, start)
+
+    @profiled("view")
     def save(self):
         try:
-            file = open(self.save_file_path, 'w')
-            lines = ['[GISmin save]\n', self.map_tiles + "\n"]
-            for layer in self.layers:
-                lines.append(layer.to_save() + "\n")
-            file.writelines(lines)
-            file.close()
+            save_project(self.save_file_path, self.map_tiles, self.layers)
             self.ui.show_message("File saved!", "Success", QMessageBox.Information)
         except Exception:
             self.ui.show_message("Error occurred", "Error", QMessageBox.Critical)
 
+    @profiled("view")
     def load(self, path):
+        project = ProjectFile(path)
         try:
-            file = open(path, 'r')
-        except Exception:
-            raise FileOpeningException("File can't be read!")
-        try:
-            lines = file.readlines()
-            if lines[0] != "[GISmin save]\n":
-                file.close()
-                raise FileOpeningException("File is not save file")
-            lines[1] = lines[1].replace("\n", "")
-            if lines[1] not in View.TILES_STRING_TO_SCRIPT.keys():  # ["OpenStreetMap", "Mapbox Bright", "Mapbox Control Room", "Stamen"]:
-                file.close()
+            if project.map_tiles not in View.TILES_STRING_TO_SCRIPT.keys():  # ["OpenStreetMap", "Mapbox Bright", "Mapbox Control Room", "Stamen"]:
                 raise MapCreatingException("Undefined map tiles")
-            self.map_tiles = lines[1]
-            self.window.page().runJavaScript(MAP_CREATION_SCRIPT + View.TILES_STRING_TO_SCRIPT[self.map_tiles] +
-                                             ADD_TILE_TO_MAP_SCRIPT)
-            for i in range(2, len(lines)):
-                line = lines[i]
-                splitted_line = line.split("|splitter|")
-                splitted_line[-1] = splitted_line[-1].replace("\n", "")
-                if splitted_line[0] == "raster":
-                    self.add_raster_layer(splitted_line[1], "", [splitted_line[3], splitted_line[4]],
-                                          [splitted_line[5], splitted_line[6]], splitted_line[7])
-                    if splitted_line[2] == "False":
-                        self.set_visible(splitted_line[1], False)
-                    else:
-                        self.set_visible(splitted_line[1], True)
-                elif splitted_line[0] == "vector":
-                    self.add_vector_layer(splitted_line[1], "", splitted_line[3])
-                    if splitted_line[2] == "False":
-                        self.set_visible(splitted_line[1], False)
-                    else:
-                        self.set_visible(splitted_line[1], True)
-
+            self.map_tiles = project.map_tiles
+            if self.map_tiles == "OpenStreetMap (cached)":
+                self.basemap_provider()
+            self.run_script(MAP_CREATION_SCRIPT + View.TILES_STRING_TO_SCRIPT[self.map_tiles] +
+                            ADD_TILE_TO_MAP_SCRIPT)
+            for description in project.layers:
+                if description["type"] == "raster" and "path" in description:
+                    file_path = project.resolve_path(description)
+                    if file_path is None:
+                        raise FileOpeningException("Raster file not found: %s" % description["path"])
+                    signature = (description["size"], description["mtime"]) \
+                        if "size" in description and "mtime" in description else None
+                    layer = RasterLayer(description["name"], None, description["bounds"], file_path,
+                                        description.get("tiled", False), description.get("hash"), signature)
+                elif description["type"] == "raster":
+                    layer = RasterLayer(description["name"], None, description["bounds"],
+                                        tiled=description.get("tiled", False))
+                elif description["type"] == "vector":
+                    layer = VectorLayer(description["name"])
+                    layer.vector_tiles = description.get("vector_tiles")
+                    if "lineage" in description:
+                        # the computed versions are not saved, so the first refresh computes the layer in full
+                        layer.lineage = Lineage.from_manifest(description["lineage"])
+                else:
+                    continue
+                if not self.check_layer_name(layer.name):
+                    raise LayerAddingException("Incorrect layer name: %s" % layer.name)
+                if self.has_layer(layer.name):
+                    raise LayerAddingException("Layer %s is added more than once" % layer.name)
+                if "path" not in description:
+                    layer.source = (project, description)
+                layer.is_visible = description["visible"]
+                self.layers.add(layer)
+            # visible layers are decoded after the map is shown, hidden ones on first use
+            for layer in self.layers:
+                if layer.is_visible:
+                    QTimer.singleShot(0, lambda layer=layer: self.show_loaded_layer(layer))
+        except (MapCreatingException, FileOpeningException, LayerAddingException):
+            project.close()
+            raise
         except Exception:
-            file.close()
+            project.close()
             raise FileOpeningException("Bad file!")
-        file.close()
 
-    def update_vector_layer(self, layer_name, data):
-        if not self.has_layer(layer_name):
+    def show_loaded_layer(self, layer):
+        if self.layers.get(layer.name) is layer and layer.is_visible and not layer.on_map:
+            self.push_layer(layer)
+
+    @profiled("view")
+    def update_vector_layer(self, layer_name, progress=None):
+        layer = self.has_layer(layer_name, True)
+        if layer is None:
             raise LayerNotFoundException("Layer not found")
-        self.window.page().runJavaScript(REMOVE_LAYER_SCRIPT % (layer_name, layer_name))
-        self.window.page().runJavaScript(GEOJSON_LAYER_CREATION_SCRIPT % (layer_name, layer_name))
-        self.window.page().runJavaScript(GEOJSON_LAYER_ADD_DATA_SCRIPT % (layer_name, str(data)))
+        if not layer.on_map:
+            return
+        self.cancel_transfers(layer_name)
+        self.run_script(REMOVE_LAYER_SCRIPT % (layer_name, layer_name))
+        layer.on_map = False
+        if layer.is_visible:
+            self.push_layer(layer, progress)
 
+    @profiled("view")
+    def append_features(self, layer, store):
+        # features added by hand are not part of the computed result
+        layer.lineage = None
+        ids = layer.store.extend(store)
+        if layer.on_map:
+            if layer.level_of_detail or self.use_vector_tiles(layer) or \
+                    self.detail_levels(layer.store) is not None:
+                self.update_vector_layer(layer.name)
+            else:
+                self.push_features(layer.name, GeometryStore(store.geometries, store.properties, ids))
+        self.refresh_derived(layer.name)
+
+    def vector_layer(self, layer_name):
+        layer = self.has_layer(layer_name, True)
+        if layer is None:
+            raise LayerNotFoundException("Layer not found")
+        if layer.type != "vector":
+            raise NotVectorLayer("Layer type is not vector")
+        return layer
+
+    @profiled("view")
+    def update_features(self, layer_name, ids, geometries, properties=None):
+        """Replaces features of a vector layer by id and updates the layers computed from it."""
+        layer = self.vector_layer(layer_name)
+        layer.lineage = None
+        layer.store.update(ids, geometries, properties)
+        self.push_changes(layer, list(ids), layer.store.select(ids))
+        self.refresh_derived(layer_name)
+
+    @profiled("view")
+    def remove_features(self, layer_name, ids):
+        """Removes features of a vector layer by id and updates the layers computed from it."""
+        layer = self.vector_layer(layer_name)
+        layer.lineage = None
+        layer.store.remove(ids)
+        self.push_changes(layer, list(ids), GeometryStore())
+        self.refresh_derived(layer_name)
+
+    def push_changes(self, layer, removed_ids, added):
+        """Removes features from the web view by id and sends the added ones.
+
+        Layers rendered as tiles or detail levels, or still being sent, are rendered again instead.
+        """
+        if not layer.on_map:
+            return
+        if layer.level_of_detail or self.use_vector_tiles(layer) or len(self.transfers.get(layer.name, ())) > 0 \
+                or self.detail_levels(layer.store) is not None:
+            self.update_vector_layer(layer.name)
+            return
+        profiler.annotate(removed_features=len(removed_ids), added_features=len(added))
+        if len(removed_ids) > 0:
+            self.run_script(GEOJSON_LAYER_REMOVE_FEATURES_SCRIPT %
+                            (layer.name, json.dumps([int(feature_id) for feature_id in removed_ids]), layer.name,
+                             layer.name))
+        if len(added) > 0:
+            self.push_features(layer.name, added)
+
+    @profiled("view")
+    def refresh_derived(self, layer_name, refreshed=None):
+        """Brings the layers computed from layer_name (and the ones computed from them) up to date.
+
+        Only the result features of changed source features are computed again and sent to the map.
+        """
+        if refreshed is None:
+            refreshed = set()
+        refreshed.add(layer_name)
+        for layer in self.layers:
+            if layer.type != "vector" or layer.lineage is None or layer_name not in layer.lineage.sources or \
+                    layer.name in refreshed:
+                continue
+            if self.refresh_layer(layer):
+                self.refresh_derived(layer.name, refreshed)
+
+    def refresh_layer(self, layer):
+        """Updates a derived layer from its sources. Returns whether it changed."""
+        sources = [self.layers.get(name) for name in layer.lineage.sources]
+        # a removed source leaves the layer as it was computed last
+        if any(source is None or source.type != "vector" for source in sources) or layer.lineage.is_current(sources):
+            return False
+        profiler.annotate(layer=layer.name)
+        changes = layer.lineage.update(layer.store, sources)
+        if changes is not None:
+            self.push_changes(layer, *changes)
+            return True
+        store, source_ids = layer.lineage.compute(sources, cache=self.results)
+        layer.store.set_features(store.geometries, store.properties)
+        layer.lineage.record(sources, layer.store, source_ids)
+        self.update_vector_layer(layer.name)
+        return True
+
+    @profiled("view")
     def buffer_layer(self, layer_name, distance, segments=1, cap_style=1,
-                     join_style=1, mitre_limit=1.0, result_layer_name=None):
+                     join_style=1, mitre_limit=1.0, result_layer_name=None, workers=None):
         layer = self.has_layer(layer_name, True)
         if layer is None:
             raise LayerNotFoundException("Layer not found")
 
-        buffer_result = Computing.buffer(layer, distance, segments,
-                                         cap_style, join_style, mitre_limit)
+        lineage = View.buffer_lineage(layer_name, distance, segments, cap_style, join_style, mitre_limit)
+        buffer_result, source_ids = lineage.compute([layer], workers, cache=self.results)
+        self.apply_result(buffer_result, layer_name, result_layer_name, lineage, [layer], source_ids)
+
+    @profiled("view")
+    def intersect_layers(self, first_layer_name, second_layer_name, result_layer_name, dissolve=True,
+                         workers=None):
+        first_layer = self.has_layer(first_layer_name, True)
+        second_layer = self.has_layer(second_layer_name, True)
+        if first_layer is None or second_layer is None:
+            raise LayerNotFoundException("Layer not found")
+
+        lineage = Lineage("intersection", {"dissolve": dissolve}, [first_layer_name, second_layer_name])
+        intersection_result, source_ids = lineage.compute([first_layer, second_layer], workers, cache=self.results)
+        self.apply_result(intersection_result, None, result_layer_name, lineage, [first_layer, second_layer],
+                          source_ids)
+
+    @staticmethod
+    def buffer_lineage(layer_name, distance, segments, cap_style, join_style, mitre_limit):
+        return Lineage("buffer", {"distance": distance, "segments": segments, "cap_style": cap_style,
+                                  "join_style": join_style, "mitre_limit": mitre_limit}, [layer_name])
+
+    @profiled("view")
+    def apply_result(self, store, layer_name, result_layer_name, lineage=None, source_layers=None, source_ids=None):
+        """Writes an operation result over layer_name, or adds it to result_layer_name if that is set.
+
+        A new result layer keeps the lineage of the result, computed from source_layers, and is
+        updated when they change.
+        """
+        if source_layers is not None:
+            # snapshots computed the hashes of their stores for the result cache
+            for source_layer in source_layers:
+                layer = self.layers.get(source_layer.name)
+                if layer is not None and layer.type == "vector" and layer.store is not source_layer.store:
+                    layer.store.keep_content_hash(source_layer.store)
         if result_layer_name is None:
-            layer.data = buffer_result
-            self.update_vector_layer(layer_name, layer.data)
+            layer = self.has_layer(layer_name, True)
+            if layer is None:
+                raise LayerNotFoundException("Layer not found")
+            layer.store = store
+            layer.lineage = None
+            self.update_vector_layer(layer_name)
+            self.refresh_derived(layer_name)
         else:
-            if self.has_layer(result_layer_name):
-                self.window.page().runJavaScript(GEOJSON_LAYER_ADD_DATA_SCRIPT %
-                                                 (result_layer_name, str(buffer_result)))
+            result_layer = self.has_layer(result_layer_name, True)
+            if result_layer is not None:
+                self.append_features(result_layer, store)
             else:
-                self.add_vector_layer(result_layer_name, "", data=buffer_result)
+                self.add_vector_layer(result_layer_name, "", data=store)
+                if lineage is not None:
+                    result_layer = self.layers.get(result_layer_name)
+                    result_layer.lineage = lineage
+                    lineage.record(source_layers, result_layer.store, source_ids)
+                    # sources may have changed while a background operation was running
+                    self.refresh_derived(source_layers[0].name)
+
+    @profiled("view")
+    def start_buffer_layer(self, layer_name, distance, segments=1, cap_style=1, join_style=1, mitre_limit=1.0,
+                           result_layer_name=None, workers=None, progress=None, finished=None):
+        """Runs buffer_layer on a worker thread and returns its Task, which can be cancelled.
+
+        progress(done, total) and finished(error) are called on the GUI thread, see Task.
+        """
+        layer = self.snapshot(layer_name)
+        lineage = View.buffer_lineage(layer_name, distance, segments, cap_style, join_style, mitre_limit)
+        return self.run_task(lambda task_progress, cancelled: lineage.compute([layer], workers, task_progress,
+                                                                              cancelled, self.results),
+                             lambda result: self.apply_result(result[0], layer_name, result_layer_name, lineage,
+                                                              [layer], result[1]), progress, finished)
+
+    @profiled("view")
+    def start_intersect_layers(self, first_layer_name, second_layer_name, result_layer_name, dissolve=True,
+                               workers=None, progress=None, finished=None):
+        """Runs intersect_layers on a worker thread, see start_buffer_layer."""
+        first_layer = self.snapshot(first_layer_name)
+        second_layer = self.snapshot(second_layer_name)
+        lineage = Lineage("intersection", {"dissolve": dissolve}, [first_layer_name, second_layer_name])
+        return self.run_task(lambda task_progress, cancelled: lineage.compute(
+            [first_layer, second_layer], workers, task_progress, cancelled, self.results),
+            lambda result: self.apply_result(result[0], None, result_layer_name, lineage,
+                                             [first_layer, second_layer], result[1]), progress, finished)
 
-    def intersect_layers(self, first_layer_name, second_layer_name, result_layer_name):
+    @profiled("view")
+    def overlay_layers(self, operation, first_layer_name, second_layer_name, result_layer_name, workers=None):
+        """Overlays two layers (see Overlay.OPERATIONS) and adds the result to result_layer_name."""
         first_layer = self.has_layer(first_layer_name, True)
         second_layer = self.has_layer(second_layer_name, True)
         if first_layer is None or second_layer is None:
             raise LayerNotFoundException("Layer not found")
 
-        intersection_result = Computing.intersection(first_layer, second_layer)
+        overlay_result = Overlay.overlay_layers(operation, first_layer, second_layer, workers)
+        self.apply_result(overlay_result, None, result_layer_name)
 
-        if self.has_layer(result_layer_name):
-            self.window.page().runJavaScript(GEOJSON_LAYER_ADD_DATA_SCRIPT %
-                                             (result_layer_name, str(intersection_result)))
-        else:
-            self.add_vector_layer(result_layer_name, "", data=intersection_result)
+    @profiled("view")
+    def start_overlay_layers(self, operation, first_layer_name, second_layer_name, result_layer_name, workers=None,
+                             progress=None, finished=None):
+        """Runs overlay_layers on a worker thread, adding the result features to the map chunk by chunk.
+
+        Features computed before a cancellation stay in the result layer, see start_buffer_layer.
+        """
+        first_layer = self.snapshot(first_layer_name)
+        second_layer = self.snapshot(second_layer_name)
+        result_layer = self.has_layer(result_layer_name, True)
+        if result_layer is None:
+            self.add_vector_layer(result_layer_name, "", data=GeometryStore())
+            result_layer = self.layers.get(result_layer_name)
+        elif result_layer.type != "vector":
+            raise NotVectorLayer("Layer type is not vector")
+        result_layer.lineage = None
+
+        def add_batch(store):
+            if self.layers.get(result_layer_name) is not result_layer:
+                raise LayerNotFoundException("Layer not found")
+            with profiler.span("View.start_overlay_layers batch", "view", layer=result_layer_name,
+                               features=len(store)):
+                self.extend_layer(result_layer, store)
+
+        def on_finished(error):
+            if self.layers.get(result_layer_name) is result_layer:
+                self.finish_extending(result_layer)
+            if finished is not None:
+                finished(error)
+
+        return self.run_task(lambda task_progress, cancelled: Overlay.overlay(
+            operation, first_layer, second_layer, workers, task_progress, cancelled),
+            lambda result: None, progress, on_finished, add_batch)
+
+    def spatial_index(self, layer_name):
+        """Returns the LayerIndex of a vector layer, brought up to date with the layer features."""
+        layer = self.vector_layer(layer_name)
+        index = self.indexes.get(layer_name)
+        if index is None or not index.is_current(layer.store) and not index.update(layer.store):
+            with profiler.span("View.spatial_index build", "view", layer=layer_name, features=len(layer.store)):
+                index = LayerIndex(layer.store)
+            self.indexes[layer_name] = index
+        return index
+
+    @profiled("view")
+    def query_bbox(self, layer_name, min_x, min_y, max_x, max_y):
+        """Returns the ids of the features of a layer intersecting the box (in lon/lat)."""
+        return self.spatial_index(layer_name).bbox(min_x, min_y, max_x, max_y).tolist()
+
+    @profiled("view")
+    def query_point(self, layer_name, x, y, tolerance=0.0):
+        """Returns the ids of the features of a layer containing the point or closer to it than tolerance."""
+        return self.spatial_index(layer_name).at_point(x, y, tolerance).tolist()
+
+    @profiled("view")
+    def query_nearest(self, layer_name, x, y, k=1, max_distance=None):
+        """Returns (feature id, distance) pairs of the k features of a layer nearest to the point."""
+        ids, distances = self.spatial_index(layer_name).nearest(x, y, k, max_distance)
+        return list(zip(ids.tolist(), distances.tolist()))
+
+    @profiled("view")
+    def features_at(self, x, y, tolerance=0.0):
+        """Returns {layer name: feature ids} of the visible vector layers at the point."""
+        features = {}
+        for layer in self.layers:
+            # layers that were not loaded yet are not decoded for a click
+            if layer.type == "vector" and layer.is_visible and layer.is_loaded:
+                ids = self.query_point(layer.name, x, y, tolerance)
+                if len(ids) > 0:
+                    features[layer.name] = ids
+        return features
+
+    def on_map_clicked(self, lat, lng, zoom):
+        self.clicked_features = self.features_at(lng, lat, View.zoom_tolerance(zoom) * View.CLICK_TOLERANCE_PIXELS)
+        if self.ui is not None:
+            self.ui.show_clicked_features(self.clicked_features)
+
+    def snapshot(self, layer_name):
+        """Returns a copy of the layer that workers can read while the layer itself keeps changing."""
+        layer = self.has_layer(layer_name, True)
+        if layer is None:
+            raise LayerNotFoundException("Layer not found")
+        if layer.type != "vector":
+            return layer
+        copy = VectorLayer(layer.name)
+        copy.store = layer.store.copy()
+        return copy
+
+    def run_task(self, function, apply, progress=None, finished=None, partial=None):
+        def on_finished(error):
+            self.tasks.discard(task)
+            if finished is not None:
+                finished(error)
+
+        task = Task(function, apply, progress, on_finished, partial)
+        self.tasks.add(task)
+        QThreadPool.globalInstance().start(task)
+        return task
 
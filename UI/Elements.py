@@ -1,7 +1,10 @@
 from PyQt5 import uic
 from PyQt5.QtWidgets import QPushButton, QTabWidget, QDoubleSpinBox, QDialog, QFileDialog, QMessageBox,\
-    QListWidget, QComboBox, QSpinBox, QLineEdit, QCheckBox, QMenu, QAction
-from Core.Exceptions import FileOpeningException, LayerAddingException, LayerNotFoundException
+    QListWidget, QComboBox, QSpinBox, QLineEdit, QCheckBox, QMenu, QAction, QProgressBar, QTableWidget,\
+    QTableWidgetItem, QLabel
+from Core.Exceptions import FileOpeningException, LayerAddingException, LayerNotFoundException,\
+    OperationCancelledException, NotVectorLayer
+from Core.Profiling import profiler
 
 
 class Element:
@@ -20,7 +23,7 @@ class AddLayerWindow(Element):
                (QLineEdit, "rasterFilePathName"), (QPushButton, "openRasterFileButton"),
                (QPushButton, "addRasterLayerButton"), (QDoubleSpinBox, "upperBound"),
                (QDoubleSpinBox, "leftBound"), (QDoubleSpinBox, "lowerBound"),
-               (QDoubleSpinBox, "rightBound")]
+               (QDoubleSpinBox, "rightBound"), (QCheckBox, "rasterAsTiles")]
 
     def __init__(self, ui_path, parent, ui):
         self.parent = parent
@@ -43,9 +46,24 @@ class AddLayerWindow(Element):
     def open_raster_file(self):
         options = QFileDialog.Options()
         file_name, _ = QFileDialog.getOpenFileName(self.parent.element, "Open File", "",
-                                                   "IMG (*.jpeg *.jpg *.tiff *.tif *.bmp *.png)", options=options)
+                                                   "IMG (*.jpeg *.jpg *.tiff *.tif *.bmp *.png);;"
+                                                   "ESPA scene (*.xml)", options=options)
         if file_name:
             self.elements["rasterFilePathName"].setText(file_name)
+            self.fill_raster_bounds(file_name)
+
+    def fill_raster_bounds(self, file_name):
+        """Shows the bounds of a georeferenced raster, images without georeferencing keep the typed ones."""
+        from Core.Rasters import read_metadata
+        try:
+            bounds = read_metadata(file_name).bounds
+        except Exception:
+            return
+        if bounds is not None:
+            self.elements["upperBound"].setValue(bounds[0][0])
+            self.elements["leftBound"].setValue(bounds[0][1])
+            self.elements["lowerBound"].setValue(bounds[1][0])
+            self.elements["rightBound"].setValue(bounds[1][1])
 
     def show(self, tab=0):
         self.elements["layerTypeTabMenu"].setCurrentIndex(tab)
@@ -57,6 +75,7 @@ class AddLayerWindow(Element):
         self.elements["leftBound"].setValue(0.0)
         self.elements["lowerBound"].setValue(0.0)
         self.elements["rightBound"].setValue(0.0)
+        self.elements["rasterAsTiles"].setChecked(False)
         self.element.show()
 
     def hide(self):
@@ -69,7 +88,9 @@ class AddLayerWindow(Element):
                                           (self.elements["upperBound"].value(),
                                            self.elements["leftBound"].value()),
                                           (self.elements["lowerBound"].value(),
-                                           self.elements["rightBound"].value()))
+                                           self.elements["rightBound"].value()),
+                                          as_tiles=self.elements["rasterAsTiles"].isChecked(),
+                                          progress=self.show_raster_progress, finished=self.raster_layer_added)
         except FileOpeningException as ex:
             self.ui.show_message(ex.message, "Error!", QMessageBox.Critical, self.element)
         except LayerAddingException as ex:
@@ -78,6 +99,17 @@ class AddLayerWindow(Element):
             self.hide()
             self.ui.update_layers_list()
 
+    def show_raster_progress(self, done_count, total_count):
+        self.ui.main_window.element.statusBar().showMessage("Reading raster: %d%%" %
+                                                            (100 * done_count // max(total_count, 1)))
+
+    def raster_layer_added(self, error):
+        """Called when a raster read on a worker thread was added or failed."""
+        self.ui.main_window.element.statusBar().clearMessage()
+        self.ui.update_layers_list()
+        if error is not None and not isinstance(error, OperationCancelledException):
+            self.ui.show_message(getattr(error, "message", str(error)), "Error!", QMessageBox.Critical)
+
     def add_vector_layer(self):
         try:
             self.ui.view.add_vector_layer(self.elements['vectorLayerName'].text(),
@@ -127,6 +159,17 @@ class LayersWindow(Element):
             context_menu.addAction(bring_to_back_action)
             context_menu.addAction(bring_to_front_action)
 
+            layer = self.ui.view.has_layer(layer_name, True)
+            if layer.type == "vector":
+                vector_tiles_action = QAction("Render as vector tiles", context_menu)
+                vector_tiles_action.setCheckable(True)
+                # a layer that was not loaded yet is not decoded just to count its features
+                vector_tiles_action.setChecked(layer.vector_tiles if layer.vector_tiles is not None else
+                                               layer.is_loaded and self.ui.view.use_vector_tiles(layer))
+                vector_tiles_action.toggled.connect(
+                    lambda checked: self.ui.view.set_vector_tiles(layer_name, checked))
+                context_menu.addAction(vector_tiles_action)
+
             point.setY(point.y() + 50)
             context_menu.exec(self.elements["layersList"].mapToGlobal(point))
 
@@ -152,28 +195,96 @@ class LayersWindow(Element):
             self.ui.update_layers_list()
 
 
-class BufferWindow(Element):
+class OperationWindow(Element):
+    """Dialog that runs a view operation on a worker thread, showing its progress and allowing to cancel it.
+
+    Dialogs define start(), which starts the operation and returns its Task, or None if it was not started.
+    """
+
+    def __init__(self, objects, ui_path, parent, ui):
+        self.parent = parent
+        self.ui = ui
+        # running operation
+        self.task = None
+        super().__init__(objects, ui_path, QDialog(self.parent.element))
+
+    def initialize(self):
+        self.elements['performButton'].clicked.connect(self.perform)
+        self.elements['cancelButton'].clicked.connect(self.cancel)
+
+    def fill_layers_list(self, combo_box):
+        combo_box.clear()
+        for layer in self.ui.view.layers:
+            if layer.type == "vector":
+                combo_box.addItem(layer.name)
+
+    def hide(self):
+        self.element.hide()
+
+    def confirm_result_layer(self, result_layer_name):
+        result_layer = self.ui.view.has_layer(result_layer_name, True)
+        if result_layer is not None:
+            if result_layer.type != "vector":
+                self.ui.show_message("Result can't be added to not vector layer", "Error",
+                                     QMessageBox.Critical, self.element)
+                return False
+            question = "Result will be added to existing layer"
+        else:
+            question = "Result will be added to new layer"
+        result = QMessageBox.question(self.element, 'Confirmation', question,
+                                      QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+        return result == QMessageBox.Yes
+
+    def perform(self):
+        try:
+            self.task = self.start()
+            if self.task is not None:
+                self.set_running(True)
+        except (LayerNotFoundException, LayerAddingException, NotVectorLayer) as ex:
+            self.ui.show_message(ex.message, "Error", QMessageBox.Critical, self.element)
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.elements["cancelButton"].setEnabled(False)
+
+    def set_running(self, is_running):
+        self.elements["performButton"].setEnabled(not is_running)
+        self.elements["cancelButton"].setEnabled(is_running)
+        self.elements["progressBar"].setValue(0)
+
+    def show_progress(self, done_count, total_count):
+        self.elements["progressBar"].setMaximum(max(total_count, 1))
+        self.elements["progressBar"].setValue(done_count)
+
+    def finished(self, error):
+        self.task = None
+        self.set_running(False)
+        self.ui.update_layers_list()
+        if error is None:
+            self.hide()
+        elif not isinstance(error, OperationCancelledException):
+            self.ui.show_message(getattr(error, "message", str(error)), "Error", QMessageBox.Critical, self.element)
+
+
+class BufferWindow(OperationWindow):
     OBJECTS = [(QComboBox, "layerName"), (QDoubleSpinBox, "distance"), (QSpinBox, "segments"), (QComboBox, "capStyle"),
                (QComboBox, "joinStyle"), (QDoubleSpinBox, "mitreLimit"), (QPushButton, "performButton"),
-               (QCheckBox, "resultToAnotherLayer"), (QLineEdit, "resultLayerName")]
+               (QCheckBox, "resultToAnotherLayer"), (QLineEdit, "resultLayerName"), (QProgressBar, "progressBar"),
+               (QPushButton, "cancelButton")]
 
     def __init__(self, ui_path, parent, ui):
-        self.parent = parent
-        self.ui = ui
-        super().__init__(BufferWindow.OBJECTS, ui_path, QDialog(self.parent.element))
+        super().__init__(BufferWindow.OBJECTS, ui_path, parent, ui)
 
     def initialize(self):
+        super().initialize()
         self.elements["resultLayerName"].setEnabled(False)
         self.elements["resultToAnotherLayer"].stateChanged.connect(
             lambda state: self.elements["resultLayerName"].setEnabled(True) if state == 2 else
             self.elements["resultLayerName"].setEnabled(False))
-        self.elements['performButton'].clicked.connect(self.perform)
 
     def update_layers_list(self):
-        self.elements["layerName"].clear()
-        for layer in self.ui.view.layers:
-            if layer.type == "vector":
-                self.elements["layerName"].addItem(layer.name)
+        self.fill_layers_list(self.elements["layerName"])
 
     def show(self):
         self.update_layers_list()
@@ -185,52 +296,150 @@ class BufferWindow(Element):
         self.elements["resultToAnotherLayer"].setCheckState(0)
         self.elements["resultLayerName"].setText("")
         self.elements["resultLayerName"].setEnabled(False)
+        self.elements["progressBar"].setValue(0)
         self.element.show()
 
-    def hide(self):
-        self.element.hide()
+    def start(self):
+        layer_name = self.elements['layerName'].currentText()
+        distance = self.elements['distance'].value()
+        segments = self.elements['segments'].value()
+        cap_style = self.elements['capStyle'].currentIndex() + 1
+        join_style = self.elements['joinStyle'].currentIndex() + 1
+        mitre_limit = self.elements['mitreLimit'].value()
+        result_layer_name = None
+        if self.elements["resultToAnotherLayer"].checkState() == 2:
+            result_layer_name = self.elements["resultLayerName"].text()
+            if not self.confirm_result_layer(result_layer_name):
+                return None
+        return self.ui.view.start_buffer_layer(layer_name, distance, segments, cap_style, join_style, mitre_limit,
+                                               result_layer_name, progress=self.show_progress,
+                                               finished=self.finished)
+
+
+class IntersectionWindow(OperationWindow):
+    """Intersects every pair of features of two layers, keeping the properties of both features."""
+    OBJECTS = [(QComboBox, "firstLayerName"), (QComboBox, "secondLayerName"), (QLineEdit, "resultLayerName"),
+               (QPushButton, "performButton"), (QProgressBar, "progressBar"), (QPushButton, "cancelButton")]
 
-    def perform(self):
-        try:
-            layer_name = self.elements['layerName'].currentText()
-            distance = self.elements['distance'].value()
-            segments = self.elements['segments'].value()
-            cap_style = self.elements['capStyle'].currentIndex() + 1
-            join_style = self.elements['joinStyle'].currentIndex() + 1
-            mitre_limit = self.elements['mitreLimit'].value()
-            result_layer_name = None
-            if self.elements["resultToAnotherLayer"].checkState() == 2:
-                result_layer_name = self.elements["resultLayerName"].text()
-                result_layer = self.ui.view.has_layer(result_layer_name, True)
-                if result_layer is not None:
-                    if result_layer.type != "vector":
-                        self.ui.show_message("Result can't be added to not vector layer", "Error",
-                                             QMessageBox.Critical, self.element)
-                        return
-                    result = QMessageBox.question(self.element, 'Confirmation',
-                                                  "Result will be added to existing layer",
-                                                  QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
-                    if result == QMessageBox.No:
-                        return
-
-                else:
-                    result = QMessageBox.question(self.element, 'Confirmation',
-                                                  "Result will be added to new layer",
-                                                  QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
-                    if result == QMessageBox.No:
-                        return
-            self.ui.view.buffer_layer(layer_name, distance, segments, cap_style, join_style,
-                                      mitre_limit, result_layer_name)
-            self.ui.update_layers_list()
-            self.hide()
-        except LayerNotFoundException as ex:
-            self.ui.show_message(ex.message, "Error", QMessageBox.Critical, self.element)
-        except LayerAddingException as ex:
-            self.ui.show_message(ex.message, "Error", QMessageBox.Critical, self.element)
+    def __init__(self, ui_path, parent, ui):
+        super().__init__(IntersectionWindow.OBJECTS, ui_path, parent, ui)
+
+    def update_layers_list(self):
+        self.fill_layers_list(self.elements["firstLayerName"])
+        self.fill_layers_list(self.elements["secondLayerName"])
+
+    def show(self):
+        self.update_layers_list()
+        self.elements["resultLayerName"].setText("")
+        self.elements["progressBar"].setValue(0)
+        self.element.show()
+
+    def start(self):
+        result_layer_name = self.elements["resultLayerName"].text()
+        if not self.confirm_result_layer(result_layer_name):
+            return None
+        return self.ui.view.start_overlay_layers("intersection", self.elements["firstLayerName"].currentText(),
+                                                 self.elements["secondLayerName"].currentText(), result_layer_name,
+                                                 progress=self.show_progress, finished=self.finished)
+
+
+class CutWindow(OperationWindow):
+    """Cuts the features of a layer by another layer, keeping the parts inside or outside of it."""
+    OBJECTS = [(QComboBox, "layerName"), (QComboBox, "cutLayerName"), (QComboBox, "keepPart"),
+               (QLineEdit, "resultLayerName"), (QPushButton, "performButton"), (QProgressBar, "progressBar"),
+               (QPushButton, "cancelButton")]
+    # operations by the index of keepPart
+    OPERATIONS = ["cut", "difference"]
 
+    def __init__(self, ui_path, parent, ui):
+        super().__init__(CutWindow.OBJECTS, ui_path, parent, ui)
 
-class IntersectionWindow(Element):
-    OBJECTS = [(QComboBox, "firstLayerName"), (QComboBox, "secondLayerName"), (QLineEdit, "resultLayerName")]
+    def update_layers_list(self):
+        self.fill_layers_list(self.elements["layerName"])
+        self.fill_layers_list(self.elements["cutLayerName"])
 
-    def __init__(self):
-        pass
\ No newline at end of file
+    def show(self):
+        self.update_layers_list()
+        self.elements["keepPart"].setCurrentIndex(0)
+        self.elements["resultLayerName"].setText("")
+        self.elements["progressBar"].setValue(0)
+        self.element.show()
+
+    def start(self):
+        result_layer_name = self.elements["resultLayerName"].text()
+        if not self.confirm_result_layer(result_layer_name):
+            return None
+        return self.ui.view.start_overlay_layers(CutWindow.OPERATIONS[self.elements["keepPart"].currentIndex()],
+                                                 self.elements["layerName"].currentText(),
+                                                 self.elements["cutLayerName"].currentText(), result_layer_name,
+                                                 progress=self.show_progress, finished=self.finished)
+
+
+class DiagnosticsWindow(Element):
+    OBJECTS = [(QCheckBox, "profilingEnabled"), (QLabel, "jsBytesLabel"), (QTableWidget, "spansTable"),
+               (QTableWidget, "layersTable"), (QPushButton, "clearButton"), (QPushButton, "refreshButton"),
+               (QPushButton, "exportButton")]
+    SPANS_COLUMNS = ["Span", "Calls", "Total, ms", "Max, ms", "JS bytes"]
+    LAYERS_COLUMNS = ["Layer", "Type", "Features", "Vertices", "On map"]
+
+    def __init__(self, ui_path, parent, ui):
+        self.parent = parent
+        self.ui = ui
+        super().__init__(DiagnosticsWindow.OBJECTS, ui_path, QDialog(self.parent.element))
+
+    def initialize(self):
+        self.elements["spansTable"].setColumnCount(len(DiagnosticsWindow.SPANS_COLUMNS))
+        self.elements["spansTable"].setHorizontalHeaderLabels(DiagnosticsWindow.SPANS_COLUMNS)
+        self.elements["layersTable"].setColumnCount(len(DiagnosticsWindow.LAYERS_COLUMNS))
+        self.elements["layersTable"].setHorizontalHeaderLabels(DiagnosticsWindow.LAYERS_COLUMNS)
+        self.elements["profilingEnabled"].toggled.connect(
+            lambda checked: profiler.enable() if checked else profiler.disable())
+        self.elements["clearButton"].clicked.connect(self.clear)
+        self.elements["refreshButton"].clicked.connect(self.update)
+        self.elements["exportButton"].clicked.connect(self.export_trace)
+
+    def show(self):
+        self.elements["profilingEnabled"].setChecked(profiler.enabled)
+        self.update()
+        self.element.show()
+
+    def hide(self):
+        self.element.hide()
+
+    def clear(self):
+        profiler.clear()
+        self.update()
+
+    @staticmethod
+    def fill_table(table, rows):
+        table.setRowCount(len(rows))
+        for i, row in enumerate(rows):
+            for j, value in enumerate(row):
+                table.setItem(i, j, QTableWidgetItem(value))
+        table.resizeColumnsToContents()
+
+    def update(self):
+        results = self.ui.view.results.stats()
+        self.elements["jsBytesLabel"].setText("Sent to the map: %d bytes, result cache: %d hits, %d misses" %
+                                              (profiler.js_bytes, results["hits"], results["misses"]))
+        self.fill_table(self.elements["spansTable"],
+                        [[name, str(total["calls"]), "%.1f" % total["total_ms"], "%.1f" % total["max_ms"],
+                          str(total["js_bytes"])] for name, total in profiler.summary().items()])
+        rows = []
+        for layer in self.ui.view.layers:
+            # layers that were not loaded yet are not decoded just to be counted
+            if layer.type == "vector" and layer.is_loaded:
+                features, vertices = str(len(layer.store)), str(layer.store.vertex_count())
+            else:
+                features, vertices = "", ""
+            rows.append([layer.name, layer.type, features, vertices, "yes" if layer.on_map else "no"])
+        self.fill_table(self.elements["layersTable"], rows)
+
+    def export_trace(self):
+        file_name, _ = QFileDialog.getSaveFileName(self.element, "Export trace", "gismin-trace.json",
+                                                   "Chrome trace (*.json)")
+        if file_name:
+            try:
+                profiler.export_trace(file_name)
+            except OSError:
+                self.ui.show_message("File can't be written!", "Error!", QMessageBox.Critical, self.element)
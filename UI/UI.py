@@ -1,6 +1,7 @@
 from PyQt5.QtWidgets import QMainWindow, QMenuBar, QAction, QMessageBox, QFileDialog
 from PyQt5.QtWebEngineWidgets import QWebEngineView
-from UI.Elements import Element, AddLayerWindow, LayersWindow, BufferWindow
+from UI.Elements import Element, AddLayerWindow, LayersWindow, BufferWindow, IntersectionWindow, CutWindow,\
+    DiagnosticsWindow
 from Core.View import View
 import webbrowser
 
@@ -13,6 +14,9 @@ class UI:
         self.layers_window = LayersWindow("UI/LayersWindow.ui", self.main_window, self)
         self.add_layer_window = AddLayerWindow("UI/AddLayerWindow.ui", self.main_window, self)
         self.buffer_window = BufferWindow("UI/BufferWindow.ui", self.main_window, self)
+        self.intersection_window = IntersectionWindow("UI/IntersectionWindow.ui", self.main_window, self)
+        self.cut_window = CutWindow("UI/CutWindow.ui", self.main_window, self)
+        self.diagnostics_window = DiagnosticsWindow("UI/DiagnosticsWindow.ui", self.main_window, self)
 
         self.main_window.element.setCentralWidget(QWebEngineView())
 
@@ -28,6 +32,9 @@ class UI:
         self.layers_window.initialize()
         self.add_layer_window.initialize()
         self.buffer_window.initialize()
+        self.intersection_window.initialize()
+        self.cut_window.initialize()
+        self.diagnostics_window.initialize()
 
     def initialize_menu_bar(self):
         self.main_window.element.findChild(QAction, "actionNew_project").triggered.connect(self.new_project)
@@ -46,8 +53,14 @@ class UI:
 
         self.main_window.element.findChild(QAction, "actionBuffer").triggered. \
             connect(self.show_buffer_window)
+        self.main_window.element.findChild(QAction, "actionIntersection").triggered. \
+            connect(self.show_intersection_window)
+        self.main_window.element.findChild(QAction, "actionCut").triggered. \
+            connect(self.show_cut_window)
 
         self.main_window.element.findChild(QAction, "actionOpen_geojson_io").triggered.connect(UI.open_geojson_io)
+        self.main_window.element.findChild(QAction, "actionDiagnostics").triggered.\
+            connect(self.diagnostics_window.show)
 
     @staticmethod
     def open_geojson_io():
@@ -57,6 +70,8 @@ class UI:
         self.hide_layers_window()
         self.add_layer_window.hide()
         self.buffer_window.hide()
+        self.intersection_window.hide()
+        self.cut_window.hide()
         self.view = View(self.main_window.element.centralWidget(), ui=self)
         self.update_layers_list()
 
@@ -64,6 +79,8 @@ class UI:
         self.hide_layers_window()
         self.add_layer_window.hide()
         self.buffer_window.hide()
+        self.intersection_window.hide()
+        self.cut_window.hide()
         options = QFileDialog.Options()
         file_name, _ = QFileDialog.getOpenFileName(self.main_window.element, "Open File", "",
                                                    "GISmin (*.gismin)", options=options)
@@ -113,9 +130,21 @@ class UI:
     def show_buffer_window(self):
         self.buffer_window.show()
 
+    def show_intersection_window(self):
+        self.intersection_window.show()
+
+    def show_cut_window(self):
+        self.cut_window.show()
+
     def update_layers_list(self):
         self.layers_window.update_layers_list()
         self.buffer_window.update_layers_list()
+        self.intersection_window.update_layers_list()
+        self.cut_window.update_layers_list()
+
+    def show_clicked_features(self, features):
+        message = "; ".join("%s: %d features" % (layer_name, len(ids)) for layer_name, ids in features.items())
+        self.main_window.element.statusBar().showMessage(message)
 
     def show_message(self, string, caption, icon, parent=None):
         if parent is None:
@@ -0,0 +1,27 @@
+from Core.Batch import run_jobs
+from Core.Exceptions import BatchJobException
+import argparse
+import sys
+
+# Headless entry point: python batch.py job.json [job.json ...] [--jobs N] [--workers N]
+# See Core/Batch.py for the job file format.
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run GISmin buffer/intersection jobs without the GUI")
+    parser.add_argument("job_files", nargs="+", help="JSON job files")
+    parser.add_argument("--jobs", type=int, default=1, help="number of jobs run in parallel")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes of every operation")
+    args = parser.parse_args()
+    failed = False
+    try:
+        for job_file, counts, error in run_jobs(args.job_files, args.jobs, args.workers):
+            if error is not None:
+                failed = True
+                print("%s: %s" % (job_file, error), file=sys.stderr)
+            else:
+                print("%s: %s" % (job_file, ", ".join("%s (%d features)" % item for item in counts.items())),
+                      file=sys.stderr)
+    except BatchJobException as e:
+        print(e.message, file=sys.stderr)
+        failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,46 @@
+from Benchmarks.Suite import run_suite, compare, CASES, DEFAULT_CONFIG
+import argparse
+import json
+import sys
+
+# Headless benchmarks of the core hot paths:
+# python benchmark.py [--cases buffer_polygons,write_png_rgb] [--features N] [--output report.json]
+#                     [--baseline previous.json --tolerance 0.2]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run GISmin benchmarks and write a JSON report")
+    parser.add_argument("--cases", help="comma separated case names: " + ", ".join(name for name, _ in CASES))
+    parser.add_argument("--features", type=int, default=DEFAULT_CONFIG["features"])
+    parser.add_argument("--vertices", type=int, default=DEFAULT_CONFIG["vertices"])
+    parser.add_argument("--raster-size", type=int, default=DEFAULT_CONFIG["raster_size"])
+    parser.add_argument("--layers", type=int, default=DEFAULT_CONFIG["layers"], help="layers of saved projects")
+    parser.add_argument("--workers", type=int, default=DEFAULT_CONFIG["workers"])
+    parser.add_argument("--repeat", type=int, default=DEFAULT_CONFIG["repeat"])
+    parser.add_argument("--output", help="report file, stdout by default")
+    parser.add_argument("--baseline", help="report to compare the medians with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    config = {"features": args.features, "vertices": args.vertices, "raster_size": args.raster_size,
+              "layers": args.layers, "workers": args.workers, "repeat": args.repeat}
+    names = args.cases.split(",") if args.cases else None
+
+    def log(result):
+        if "seconds" in result:
+            print("%-22s %10.4f s" % (result["name"], result["seconds"]["median"]), file=sys.stderr)
+        else:
+            print("%-22s skipped: %s" % (result["name"], result["skipped"]), file=sys.stderr)
+
+    report = run_suite(config, names, log)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            regressions = compare(report, json.load(file), args.tolerance)
+        for name, baseline_median, median in regressions:
+            print("%s: %.4f s -> %.4f s" % (name, baseline_median, median), file=sys.stderr)
+        sys.exit(1 if len(regressions) > 0 else 0)